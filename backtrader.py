@@ -4,24 +4,19 @@
 - 个股盈利 20% 即卖出
 根据 settings.py 中配置的起始时间，回溯个股在该策略下的收益和回撤情况
 """
-import os.path
-
-import matplotlib
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 from loguru import logger
 
-from settings import START_DATE, DUMP_DIR, STOCK_CODE, STOCK_NAME, BID_PRICE, TAKE_PROFIT, PLOT
-
-matplotlib.rcParams['font.sans-serif'] = ['SimHei']  # 设置中文字体
-matplotlib.rcParams['axes.unicode_minus'] = False  # 正常显示负号
-
-# /home/rhino/s/a/backtrader_YYYY-MM-DD_HH-mm-ss_ssssss.log
-logger.add(os.path.join(DUMP_DIR, 'backtrader_{time:YYYYMMDD}.log'),
-           rotation="50 MB",
-           retention="3 days",
-           compression="gz",
-           enqueue=True)
+from settings import START_DATE, STOCK_CODE, STOCK_NAME, BID_PRICE, TAKE_PROFIT, PLOT, SWEEP_BATCH_SIZE, \
+    TIMEFRAME
+from dataset import resolve, PERIODS_PER_YEAR
+from logs import add_sink
+from memo import MEMO
+from metrics import timed
+from plotting import pyplot
+from report import current
+from result import BacktestResult
 
 
 def get_max_drawdown(equity_series):
@@ -36,86 +31,212 @@ def get_max_drawdown(equity_series):
     return max_dd
 
 
+def _find_first_at_or_above(close, start, target):
+    """
+    从 start 开始查找第一个收盘价 >= target 的位置
+    窗口按倍数扩张，开销与持仓天数成正比，而不是与总交易日成正比
+    :param close: 收盘价数组
+    :param start: 起始下标
+    :param target: 目标价格
+    :return: 下标，找不到返回 -1
+    """
+    n = len(close)
+    step = 64
+    while start < n:
+        stop = min(start + step, n)
+        hit = np.flatnonzero(close[start:stop] >= target)
+        if hit.size:
+            return start + int(hit[0])
+        start = stop
+        step *= 2
+    return -1
+
+
+def simulate(close, bid_price, take_profit=TAKE_PROFIT):
+    """
+    低于目标价买入、达到止盈比例卖出的事件跳跃式模拟
+    买点通过预先计算的候选买点 + searchsorted 定位，卖点通过数组查找定位，
+    资金曲线按区间切片赋值，计算量与交易笔数成正比
+    :param close: 收盘价数组
+    :param bid_price: 目标买入价，可以是标量，也可以是与 close 等长的数组
+    :param take_profit: 止盈比例，如 1.2
+    :return: (资金曲线, 买入下标数组, 卖出下标数组)
+    """
+    close = np.asarray(close, dtype=float)
+    n = len(close)
+    equity = np.empty(n)
+    entries = np.flatnonzero(close < bid_price)
+
+    capital = 1.0
+    pos = 0
+    buy_idx, sell_idx = [], []
+    while pos < n:
+        k = np.searchsorted(entries, pos)
+        if k == len(entries):
+            # 之后再也没有买点，空仓到最后
+            equity[pos:] = capital
+            break
+
+        b = int(entries[k])
+        equity[pos:b] = capital
+        buy_price = close[b]
+
+        s = _find_first_at_or_above(close, b + 1, buy_price * take_profit)
+        if s < 0:
+            # 一直持有到最后也没有止盈
+            equity[b:] = capital * close[b:] / buy_price
+            break
+
+        equity[b:s] = capital * close[b:s] / buy_price
+        capital *= close[s] / buy_price
+        equity[s] = capital
+        buy_idx.append(b)
+        sell_idx.append(s)
+        pos = s + 1
+
+    return equity, np.asarray(buy_idx, dtype=np.int64), np.asarray(sell_idx, dtype=np.int64)
+
+
+def simulate_batch(close, bid_prices, take_profits, batch_size=SWEEP_BATCH_SIZE):
+    """
+    批量模拟多组（收盘价序列, 目标买入价, 止盈比例）
+    - close 为一维时，同一条收盘价序列上模拟多组参数
+    - close 为二维时，每一列是一条收盘价路径，每条路径对应一组参数
+    逐日推进，每一步对一批组合做向量运算，不保留完整资金曲线，
+    只在推进过程中累计最终净值和最大回撤，口径与 get_max_drawdown 一致
+    :param close: 收盘价数组，或形状为 (交易日数, 路径数) 的矩阵
+    :param bid_prices: 目标买入价，数组或标量
+    :param take_profits: 止盈比例，数组或标量
+    :param batch_size: 每批组合的数量
+    :return: (最终净值数组, 最大回撤数组, 交易笔数数组)
+    """
+    close = np.asarray(close, dtype=float)
+    k = close.shape[1] if close.ndim == 2 else np.asarray(bid_prices).size
+    bid_prices = np.broadcast_to(np.asarray(bid_prices, dtype=float), (k,))
+    take_profits = np.broadcast_to(np.asarray(take_profits, dtype=float), (k,))
+
+    final = np.empty(k)
+    max_dd = np.empty(k)
+    trades = np.empty(k, dtype=np.int64)
+
+    for lo in range(0, k, batch_size):
+        hi = min(lo + batch_size, k)
+        bid = bid_prices[lo:hi]
+        tp = take_profits[lo:hi]
+
+        capital = np.ones(hi - lo)
+        buy_price = np.ones(hi - lo)
+        holding = np.zeros(hi - lo, dtype=bool)
+        peak = np.zeros(hi - lo)
+        dd = np.zeros(hi - lo)
+        count = np.zeros(hi - lo, dtype=np.int64)
+        equity = capital
+
+        # price 是标量（同一条序列）或向量（每列一条路径），按整批向量更新
+        for price in (close[:, lo:hi] if close.ndim == 2 else close):
+            # 持仓的先判断止盈，当天买入的不判断
+            sell = holding & (price >= buy_price * tp)
+            capital = np.where(sell, capital * (price / buy_price), capital)
+            holding[sell] = False
+            count += sell
+
+            buy = ~holding & ~sell & (price < bid)
+            buy_price = np.where(buy, price, buy_price)
+            holding[buy] = True
+
+            equity = np.where(holding, capital * price / buy_price, capital)
+            peak = np.fmax(peak, equity)
+            dd = np.fmin(dd, equity / peak - 1)
+
+        final[lo:hi] = equity
+        max_dd[lo:hi] = dd
+        trades[lo:hi] = count
+
+    return final, max_dd, trades
+
+
+def _backtest(dates, close, bid_price, stock_code, stock_name, bid_label, take_profit, periods_per_year):
+    """
+    模拟交易并构造结果，结果只取决于参数，可以按内容缓存
+    :return: BacktestResult
+    """
+    equity, buy_idx, sell_idx = simulate(close, bid_price, take_profit)
+    return BacktestResult.from_simulation(stock_code, stock_name, bid_label, take_profit,
+                                          dates, close, equity, buy_idx, sell_idx, periods_per_year)
+
+
+@timed("get_return")
 def get_return(stock_code=STOCK_CODE,
                stock_name=STOCK_NAME,
                bid_price=BID_PRICE,
-               start_date=START_DATE):
+               start_date=START_DATE,
+               data=None,
+               take_profit=TAKE_PROFIT,
+               verbose=True,
+               timeframe=TIMEFRAME):
+    """
+    回溯低于目标买入价买入、达到止盈比例卖出的收益和回撤
+    :param stock_code: 如 588000 或 601398
+    :param stock_name: 如 科创50 或 工商银行
+    :param bid_price: 目标买入价，也可以是按日期索引的 Series（滚动的目标买入价）
+    :param start_date: 回溯开始时间
+    :param data: 日线 DataFrame 或 Dataset，为空时从缓存读取
+    :param take_profit: 止盈比例
+    :param verbose: 是否输出指标和交易明细，批量回溯时关闭
+    :param timeframe: daily、weekly 或 monthly，周线、月线由日线重采样，在收盘价上判断买卖
+    :return: BacktestResult
+    """
     # 1. 获取万华化学的历史数据（前复权）
-    df = pd.read_csv(f"{os.path.join(DUMP_DIR, stock_code)}_{stock_name}.csv")
-    df.set_index("date", inplace=True)
+    df = resolve(data, stock_code, timeframe).set_index("date")
 
     # 2. 筛选 2018-01-01 以后的数据
     df = df[df.index >= start_date]
 
-    # 3. 初始化变量
-    equity_curve = []
-    capital = 1.0  # 初始资金
-    holding = False
-    buy_price = 0.0
-    buy_date = None
-    hold_days = 0
-
-    trades = []  # 记录每笔交易信息
-
-    # 4. 模拟交易
-    for date, row in df.iterrows():
-        price = row["close"]
-        current_date = date
-
-        if not holding:
-            if price < bid_price:
-                buy_price = price
-                buy_date = current_date
-                holding = True
-                hold_days = 1
-        else:
-            hold_days += 1
-            if price >= buy_price * TAKE_PROFIT:
-                sell_price = price
-                sell_date = current_date
-                capital *= sell_price / buy_price
-                holding = False
-
-                trades.append({
-                    "buy_date": buy_date,
-                    "sell_date": sell_date,
-                    "buy_price": buy_price,
-                    "sell_price": sell_price,
-                    "hold_days": hold_days
-                })
-
-                hold_days = 0
-                buy_price = 0.0
-                buy_date = None
-
-        # 记录每日资金曲线
-        equity_curve.append(capital if not holding else capital * price / buy_price)
-    df["equity"] = equity_curve
+    # 滚动的目标买入价按日期对齐，前面没有数据的交易日为 NaN，不会买入
+    if isinstance(bid_price, pd.Series):
+        bid_label = f"滚动（最新 {bid_price.iloc[-1]}）"
+        bid_price = bid_price.reindex(df.index).to_numpy(dtype=float)
+    else:
+        bid_label = bid_price
+
+    # 3. 模拟交易，按买卖事件跳跃，而不是逐日遍历
+    # 资金曲线和交易按列保存，总收益、年化、最大回撤在其中计算
+    # 交易日、收盘价（已按 start_date 截取）、目标买入价、止盈比例不变时直接使用上次的结果
+    close = df["close"].to_numpy(dtype=float)
+    result = MEMO.call("get_return/2", _backtest, df.index.to_numpy(), close, bid_price,
+                       stock_code=stock_code, stock_name=stock_name, bid_label=bid_label, take_profit=take_profit,
+                       periods_per_year=PERIODS_PER_YEAR[timeframe])
+    equity = result.equity
+
+    # 报告模式下只提交渲染任务，不等待
+    report = current()
+    if report is not None:
+        report.add_backtest(result, close)
 
     if PLOT:
-        # 5. 可视化
-        df[["close", "equity"]].plot(figsize=(12, 6))
-        plt.title(f"{stock_code}_{stock_name} 策略回测（<{bid_price} 买，+20% 卖）")
+        # 4. 可视化
+        plt = pyplot()
+        pd.DataFrame({"close": close, "equity": equity}, index=df.index).plot(figsize=(12, 6))
+        plt.title(f"{stock_code}_{stock_name} 策略回测（<{bid_label} 买，+{take_profit - 1:.0%} 卖）")
         plt.ylabel("价格 / 策略净值")
         plt.grid(True)
         plt.tight_layout()
         plt.show()
 
-    # 计算总收益、年化、最大回撤
-    total_return = df["equity"].iloc[-1] - 1
-    trading_days = len(df)
-    annual_return = (df["equity"].iloc[-1]) ** (252 / trading_days) - 1
-    max_drawdown = get_max_drawdown(df["equity"])
-    # 输出指标
-    logger.info(f"目标买入价：{bid_price}，"
-                f"总收益率: {total_return:.2%}，"
-                f"年化收益率: {annual_return:.2%}，"
-                f"最大回撤: {max_drawdown:.2%}")
+    if verbose:
+        # 输出指标
+        logger.info(f"目标买入价：{bid_label}，"
+                    f"总收益率: {result.total_return:.2%}，"
+                    f"年化收益率: {result.annual_return:.2%}，"
+                    f"最大回撤: {result.max_drawdown:.2%}")
+
+        # 打印买入卖出时间，买入卖出价格，持仓天数
+        print(result.trades_frame())
 
-    # 打印买入卖出时间，买入卖出价格，持仓天数
-    trades_df = pd.DataFrame(trades)
-    print(trades_df)
+    return result
 
 
 if __name__ == '__main__':
+    # /home/rhino/s/a/backtrader_YYYYMMDD.log
+    add_sink('backtrader')
     get_return()
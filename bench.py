@@ -0,0 +1,323 @@
+# -*- coding:utf-8 -*-
+"""
+性能基准
+不依赖东财接口，用固定随机种子生成模拟行情，测量分析热点在不同规模下的耗时
+- 随机游走：对数收益率服从正态分布
+- 状态切换：牛市、熊市、震荡三种状态按马尔可夫链切换，settings.CRASHES 中的时间段强制为暴跌状态
+- 单证券：1k ~ 1M 根 K 线，测量 compute_distribution、simulate、get_return、get_max_drawdown 等
+- 全市场：1 ~ 5000 个证券，测量逐个计算分布和批量判断提醒规则
+- 启动：用 python -X importtime 在新进程中测量各入口模块的导入耗时
+结果写入 json 文件，--compare 与之前的结果对比，找出变慢的环节
+python bench.py --quick
+python bench.py --compare /home/rhino/s/a/bench/bench_2025-07-17.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from backtrader import simulate, simulate_batch, get_max_drawdown, get_return
+from historical_range import compute_distribution, compute_volume_profile, rolling_distribution
+from memo import MEMO
+from rules import build_rules, evaluate
+from settings import CRASHES, DUMP_DIR, TODAY
+
+# 单证券的 K 线数量
+BAR_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+# 全市场的证券数量
+UNIVERSE_SIZES = [1, 10, 100, 1_000, 5_000]
+# 全市场测试中每个证券的 K 线数量，约 8 年日线
+UNIVERSE_BARS = 2_000
+
+# 对数价格在起始价格上下 log(PRICE_BAND) 倍之间反射，长序列不会漂移到不现实的价格
+PRICE_BAND = 4.0
+# 逐日推进的环节超过这个 K 线数量时不测
+SLOW_STAGE_BARS = 100_000
+
+# 测量导入耗时的入口模块
+IMPORT_MODULES = ["notify", "historical_range", "backtrader", "sweep", "screener"]
+# 导入耗时长、应当只在用到时才导入的模块
+HEAVY_MODULES = ["akshare", "baostock", "matplotlib"]
+
+# 状态切换模型的日收益率均值和波动率：牛市、熊市、震荡、暴跌
+REGIMES = {
+    "bull": (0.0010, 0.015),
+    "bear": (-0.0008, 0.020),
+    "flat": (0.0, 0.010),
+    "crash": (-0.0040, 0.035),
+}
+# 状态转移矩阵，每天保持当前状态的概率较大
+TRANSITIONS = np.array([
+    [0.990, 0.005, 0.005],
+    [0.008, 0.985, 0.007],
+    [0.006, 0.006, 0.988],
+])
+
+
+def _dates(n, start):
+    # 交易日超过 pandas 时间范围时改用分钟线的时间轴
+    freq = 'B' if n <= 50_000 else 'min'
+    return pd.date_range(start, periods=n, freq=freq)
+
+
+def _reflect(log_path, band=PRICE_BAND):
+    # 三角波折叠，折叠点之外的日收益率不变
+    a = np.log(band)
+    return np.abs(np.mod(log_path - a, 4 * a) - 2 * a) - a
+
+
+def synthetic_bars(n, seed=0, kind="regime", start="2001-01-01", price=10.0):
+    """
+    生成模拟日线
+    :param n: K 线数量
+    :param seed: 随机种子，相同参数生成的数据完全相同
+    :param kind: random_walk 或 regime
+    :param start: 起始日期
+    :param price: 起始价格
+    :return: DataFrame，列与本地存储相同
+    """
+    rng = np.random.default_rng(seed)
+    dates = _dates(n, start)
+
+    if kind == "random_walk":
+        mu = np.zeros(n)
+        sigma = np.full(n, 0.02)
+    else:
+        # 马尔可夫链生成状态序列
+        names = ["bull", "bear", "flat"]
+        cum = np.cumsum(TRANSITIONS, axis=1)
+        u = rng.random(n)
+        state = np.empty(n, dtype=np.int64)
+        state[0] = 2
+        for t in range(1, n):
+            state[t] = np.searchsorted(cum[state[t - 1]], u[t])
+        mu = np.array([REGIMES[names[s]][0] for s in range(3)])[state]
+        sigma = np.array([REGIMES[names[s]][1] for s in range(3)])[state]
+
+        # 历史暴跌时间段
+        for crash_start, crash_end in CRASHES:
+            mask = (dates >= crash_start) & (dates < crash_end)
+            mu[mask], sigma[mask] = REGIMES["crash"]
+
+    log_ret = rng.normal(mu, sigma)
+    close = np.round(price * np.exp(_reflect(np.cumsum(log_ret))), 3)
+    spread = np.abs(rng.normal(0, 0.01, n))
+    volume = np.round(rng.lognormal(13, 0.5, n))
+    return pd.DataFrame({
+        "date": dates,
+        "open": np.round(close * (1 + rng.normal(0, 0.005, n)), 3),
+        "high": np.round(close * (1 + spread), 3),
+        "low": np.round(close * (1 - spread), 3),
+        "close": close,
+        "volume": volume,
+        "amount": volume * close,
+    })
+
+
+def synthetic_universe(n_symbols, bars=UNIVERSE_BARS, seed=0, price=10.0):
+    """
+    生成多个证券的模拟收盘价，随机游走，一次生成整个矩阵
+    :param n_symbols: 证券数量
+    :param bars: 每个证券的 K 线数量
+    :param seed:
+    :param price: 起始价格
+    :return: ndarray，形状为 (K 线数量, 证券数量)
+    """
+    rng = np.random.default_rng(seed)
+    log_ret = rng.normal(0, 0.02, (bars, n_symbols))
+    return np.round(price * np.exp(_reflect(np.cumsum(log_ret, axis=0))), 3)
+
+
+def _timeit(fn, repeat):
+    """
+    重复执行取最快的一次
+    :param fn:
+    :param repeat:
+    :return: 秒
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_series(sizes=BAR_SIZES, repeat=3, seed=0, kind="regime"):
+    """
+    单证券各环节耗时
+    :param sizes: K 线数量列表
+    :param repeat: 每项重复次数
+    :param seed:
+    :param kind: 模拟行情的类型，random_walk 或 regime
+    :return: [{"stage", "bars", "symbols", "seconds"}]
+    """
+    results = []
+    for n in sizes:
+        df = synthetic_bars(n, seed, kind)
+        close = df["close"].to_numpy()
+        dist = compute_distribution(close)
+        bid = dist["lowest_price"]
+        # 超过 10 万根时只跑一次
+        r = repeat if n <= 100_000 else 1
+
+        stages = {
+            "compute_distribution": lambda: compute_distribution(close),
+            "volume_profile": lambda: compute_volume_profile(close, df["volume"], (0.01, 0.02, 0.05)),
+            "simulate": lambda: simulate(close, bid),
+            "get_max_drawdown": lambda: get_max_drawdown(pd.Series(close)),
+            "get_return": lambda: get_return("bench", "bench", bid, start_date=str(df["date"].iloc[0].date()),
+                                             data=df, verbose=False),
+            "simulate_batch_100": lambda: simulate_batch(close, np.linspace(close.min(), close.max(), 100), 1.2),
+            "rolling_distribution": lambda: rolling_distribution(close),
+        }
+        for stage, fn in stages.items():
+            if stage in ("simulate_batch_100", "rolling_distribution") and n > SLOW_STAGE_BARS:
+                continue
+            seconds = _timeit(fn, r)
+            results.append({"stage": stage, "bars": n, "symbols": 1, "seconds": seconds})
+            logger.info(f"{stage:<24} {n:>9} 根 K 线 {seconds * 1000:>10.2f} ms")
+    return results
+
+
+def bench_universe(sizes=UNIVERSE_SIZES, bars=UNIVERSE_BARS, repeat=1, seed=0):
+    """
+    全市场各环节耗时
+    :param sizes: 证券数量列表
+    :param bars: 每个证券的 K 线数量
+    :param repeat:
+    :param seed:
+    :return: [{"stage", "bars", "symbols", "seconds"}]
+    """
+    results = []
+    matrix = synthetic_universe(max(sizes), bars, seed)
+    closes = {f"{j:06d}": matrix[:, j] for j in range(matrix.shape[1])}
+    for n in sizes:
+        codes = list(closes)[:n]
+
+        latest = {code: closes[code][-1] for code in codes}
+        position = [{"code": code, "name": code, "hold_price": closes[code][0]} for code in codes]
+        watchlist = [{"code": code, "name": code, "bid_price": closes[code].mean()} for code in codes]
+        rules = build_rules(position, watchlist)
+
+        stages = {
+            "screen_distribution": lambda: [compute_distribution(closes[code]) for code in codes],
+            "rules_evaluate": lambda: evaluate(rules, latest),
+        }
+        for stage, fn in stages.items():
+            seconds = _timeit(fn, repeat)
+            results.append({"stage": stage, "bars": bars, "symbols": n, "seconds": seconds})
+            logger.info(f"{stage:<24} {n:>9} 个证券 {seconds * 1000:>10.2f} ms")
+    return results
+
+
+def _import_seconds(module):
+    """
+    新进程中导入模块，解析 -X importtime 的输出
+    :param module:
+    :return: (累计导入秒数, 被导入的耗时模块)
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    code = f"import sys, {module}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, cwd=cwd)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    # import time: self [us] | cumulative | imported package
+    for line in reversed(proc.stderr.splitlines()):
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1e6, [m for m in proc.stdout.strip().split(',') if m]
+    return float('nan'), []
+
+
+def bench_imports(modules=IMPORT_MODULES, repeat=3):
+    """
+    各入口模块的冷启动导入耗时，每次都在新进程中测量
+    :param modules:
+    :param repeat:
+    :return: [{"stage", "bars", "symbols", "seconds", "heavy"}]
+    """
+    results = []
+    for module in modules:
+        try:
+            runs = [_import_seconds(module) for _ in range(repeat)]
+        except RuntimeError as e:
+            logger.error(f"导入 {module} 失败：{e}")
+            continue
+        seconds = min(r[0] for r in runs)
+        heavy = runs[0][1]
+        results.append({"stage": f"import_{module}", "bars": 0, "symbols": 0, "seconds": seconds, "heavy": heavy})
+        logger.info(f"import {module:<20} {seconds * 1000:>10.2f} ms，导入了 {heavy or '无'}")
+    return results
+
+
+def _version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(old_path, results, threshold=1.2):
+    """
+    与之前的结果对比，耗时超过 threshold 倍的记为变慢
+    :param old_path: 之前的结果文件
+    :param results: 本次结果
+    :param threshold:
+    :return: 变慢的环节
+    """
+    with open(old_path, encoding='utf-8') as f:
+        old = {(r["stage"], r["bars"], r["symbols"]): r["seconds"] for r in json.loads(f.read())["results"]}
+
+    slower = []
+    for r in results:
+        before = old.get((r["stage"], r["bars"], r["symbols"]))
+        if before and r["seconds"] > before * threshold:
+            slower.append({**r, "before": before, "ratio": r["seconds"] / before})
+            logger.warning(f"{r['stage']} {r['bars']} 根 K 线 {r['symbols']} 个证券 "
+                           f"变慢 {r['seconds'] / before:.2f} 倍")
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="分析热点的性能基准")
+    parser.add_argument('--quick', action='store_true', help="只跑小规模，用于快速检查")
+    parser.add_argument('--kind', default="regime", choices=["regime", "random_walk"], help="模拟行情的类型")
+    parser.add_argument('--repeat', type=int, default=3, help="每项重复次数，取最快的一次")
+    parser.add_argument('--output', default=os.path.join(DUMP_DIR, 'bench', f'bench_{TODAY}.json'),
+                        help="结果文件")
+    parser.add_argument('--compare', help="之前的结果文件，对比找出变慢的环节")
+    args = parser.parse_args()
+
+    # 测量的是计算本身，重复计时不能命中结果缓存
+    MEMO.enabled = False
+    series_sizes = BAR_SIZES[:2] if args.quick else BAR_SIZES
+    universe_sizes = UNIVERSE_SIZES[:3] if args.quick else UNIVERSE_SIZES
+    all_results = (bench_imports(repeat=args.repeat)
+                   + bench_series(series_sizes, args.repeat, kind=args.kind)
+                   + bench_universe(universe_sizes))
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, encoding='utf-8', mode='w') as f:
+        f.write(json.dumps({
+            "version": _version(),
+            "time": time.strftime('%Y-%m-%d %H:%M:%S'),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "kind": args.kind,
+            "results": all_results,
+        }, ensure_ascii=False, indent=2))
+    logger.info(f"结果已写入 {args.output}")
+
+    if args.compare:
+        compare(args.compare, all_results)
@@ -0,0 +1,185 @@
+# -*- coding:utf-8 -*-
+"""
+进程内行情缓存
+一次运行中 get_distribution、get_return、notify 都要读取同一个证券的日线，
+通过缓存保证每个证券只从本地存储读取一次
+- 按 (证券代码, 起始日期, 结束日期, 周期) 缓存 DataFrame
+- 按内存占用做 LRU 淘汰
+- 记录命中、未命中、实际读取次数
+周线、月线由本地存储的日线重采样得到，不需要重新获取
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from settings import DATASET_CACHE_BYTES
+from store import load_bars
+
+# 支持的周期，及每年的 K 线数量（年化、滚动窗口换算用）
+PERIODS_PER_YEAR = {"daily": 252, "weekly": 52, "monthly": 12}
+
+
+def resample(df, timeframe):
+    """
+    日线重采样成周线或月线，每根 K 线的日期为该周期最后一个交易日
+    按周期的分组起点 reduceat，一次得到全部 K 线；对周线、月线再次重采样结果不变
+    :param df: 日线 DataFrame，列为 date 和 store.COLUMNS，按日期升序
+    :param timeframe: daily、weekly 或 monthly
+    :return: DataFrame，列与 df 相同
+    """
+    if timeframe not in PERIODS_PER_YEAR:
+        raise ValueError(f"不支持的周期：{timeframe}")
+    if timeframe == "daily" or df.empty:
+        return df
+
+    dates = df["date"].to_numpy().astype('datetime64[D]')
+    if timeframe == "weekly":
+        # numpy 的周从星期四（1970-01-01）开始，偏移 3 天后同一周的星期一到星期日得到相同的键
+        key = (dates + 3).astype('datetime64[W]')
+    else:
+        key = dates.astype('datetime64[M]')
+    starts = np.flatnonzero(np.concatenate([[True], key[1:] != key[:-1]]))
+    ends = np.append(starts[1:], len(dates)) - 1
+
+    bars = {"date": pd.DatetimeIndex(dates[ends].astype('datetime64[ns]'))}
+    for col, how in (("open", "first"), ("high", np.fmax), ("low", np.fmin), ("close", "last"),
+                     ("volume", np.add), ("amount", np.add)):
+        if col not in df:
+            continue
+        values = df[col].to_numpy(dtype=float)
+        if how == "first":
+            bars[col] = values[starts]
+        elif how == "last":
+            bars[col] = values[ends]
+        else:
+            bars[col] = how.reduceat(values, starts)
+    return pd.DataFrame(bars)
+
+
+class DatasetCache:
+    """
+    按内存上限做 LRU 淘汰的 DataFrame 缓存
+    """
+
+    def __init__(self, max_bytes=DATASET_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, stock_code, start_date=None, end_date=None, timeframe="daily"):
+        """
+        读取 K 线，优先从缓存读取
+        带日期范围的请求未命中时，从整段历史中截取，不重复读取本地存储
+        周线、月线未命中时，从同一日期范围的日线重采样
+        :param stock_code: 如 588000 或 601398
+        :param start_date: 起始日期（含）
+        :param end_date: 结束日期（含）
+        :param timeframe: daily、weekly 或 monthly
+        :return: DataFrame，不要原地修改
+        """
+        key = (stock_code, start_date, end_date, timeframe)
+        with self._lock:
+            if key in self._frames:
+                self.hits += 1
+                self._frames.move_to_end(key)
+                return self._frames[key]
+            self.misses += 1
+
+            if timeframe != "daily":
+                df = resample(self.get(stock_code, start_date, end_date), timeframe)
+            elif start_date is None and end_date is None:
+                self.loads += 1
+                df = load_bars(stock_code)
+                if df is None:
+                    raise FileNotFoundError(f"{stock_code} 没有本地行情，请先执行 get_k_data")
+            else:
+                full = self.get(stock_code)
+                mask = pd.Series(True, index=full.index)
+                if start_date is not None:
+                    mask &= full["date"] >= start_date
+                if end_date is not None:
+                    mask &= full["date"] <= end_date
+                df = full[mask].reset_index(drop=True)
+
+            self._put(key, df)
+            return df
+
+    def _put(self, key, df):
+        size = int(df.memory_usage(deep=True).sum())
+        self._frames[key] = df
+        self._sizes[key] = size
+        self._bytes += size
+        while self._bytes > self.max_bytes and len(self._frames) > 1:
+            old, _ = self._frames.popitem(last=False)
+            self._bytes -= self._sizes.pop(old)
+            self.evictions += 1
+
+    def invalidate(self, stock_code):
+        """
+        本地存储更新后，丢弃该证券的所有缓存
+        :param stock_code:
+        :return:
+        """
+        with self._lock:
+            for key in [k for k in self._frames if k[0] == stock_code]:
+                del self._frames[key]
+                self._bytes -= self._sizes.pop(key)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "frames": len(self._frames),
+            "bytes": self._bytes,
+        }
+
+    def log_stats(self):
+        logger.info(f"行情缓存 命中 {self.hits} 次，未命中 {self.misses} 次，"
+                    f"读取本地存储 {self.loads} 次，淘汰 {self.evictions} 次，"
+                    f"占用 {self._bytes / 1024 / 1024:.1f} MB")
+
+
+# 进程内共享的缓存
+CACHE = DatasetCache()
+
+
+class Dataset:
+    """
+    行情句柄，只记录证券代码、日期范围和周期，真正用到时才从 CACHE 读取
+    """
+    __slots__ = ("stock_code", "start_date", "end_date", "timeframe")
+
+    def __init__(self, stock_code, start_date=None, end_date=None, timeframe="daily"):
+        self.stock_code = stock_code
+        self.start_date = start_date
+        self.end_date = end_date
+        self.timeframe = timeframe
+
+    def frame(self, timeframe=None):
+        return CACHE.get(self.stock_code, self.start_date, self.end_date, timeframe or self.timeframe)
+
+
+def resolve(data, stock_code, timeframe="daily"):
+    """
+    分析函数的 data 参数可以是 DataFrame、Dataset 或 None
+    :param data: DataFrame 为日线或已是 timeframe 的 K 线；Dataset 从缓存读取；None 按 stock_code 从缓存读取整段历史
+    :param stock_code:
+    :param timeframe: daily、weekly 或 monthly，日线按需重采样
+    :return: DataFrame
+    """
+    if data is None:
+        return CACHE.get(stock_code, timeframe=timeframe)
+    if isinstance(data, Dataset):
+        return data.frame(None if timeframe == "daily" else timeframe)
+    return resample(data, timeframe)
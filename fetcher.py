@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+"""
+并发获取行情
+- 线程池限制同时在途的请求数
+- 令牌桶限制请求速率，代替每个证券之后固定 time.sleep(10)
+- 东财在 vpn 下会断连，失败后按指数退避重试
+- 按完成顺序逐个返回，调用方分析已获取的证券时，其余证券仍在后台获取
+获取函数通过参数传入，可以换成本地模拟的数据源，注入延迟和失败来验证
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from loguru import logger
+
+from settings import FETCH_CONCURRENCY, FETCH_RATE, FETCH_BURST, FETCH_RETRIES, FETCH_BACKOFF
+
+
+class TokenBucket:
+    """
+    令牌桶，每秒补充 rate 个令牌，最多积攒 capacity 个
+    """
+
+    def __init__(self, rate=FETCH_RATE, capacity=FETCH_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        取一个令牌，没有令牌时阻塞等待
+        :return:
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# 当前线程正在使用的令牌桶，以及调用前预取、还没有被请求用掉的令牌
+_local = threading.local()
+
+
+def throttle():
+    """
+    数据源每次发起网络请求前调用，在 fetch_all 的线程中从令牌桶取一个令牌，其余线程中不限速
+    一次获取可能发起多个请求（如不复权和后复权），每个请求都要取令牌，实际请求速率不超过 rate
+    :return:
+    """
+    bucket = getattr(_local, 'bucket', None)
+    if bucket is None:
+        return
+    if _local.prepaid:
+        _local.prepaid = False
+        return
+    bucket.acquire()
+
+
+def call_with_retry(fn, *args, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF, bucket=None):
+    """
+    调用 fn，失败后按 backoff * 2^n 加随机抖动等待再重试
+    :param fn: 获取函数
+    :param args: 获取函数的参数
+    :param retries: 最多重试次数
+    :param backoff: 首次重试前等待的秒数
+    :param bucket: 令牌桶，每次调用（包括重试）前取一个令牌，fn 中第二个及之后的请求通过 throttle 再取令牌
+    :return: fn 的返回值，重试用尽后抛出最后一次的异常
+    """
+    for attempt in range(retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        _local.bucket, _local.prepaid = bucket, True
+        try:
+            return fn(*args)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            wait = backoff * 2 ** attempt * (1 + random.random() / 2)
+            logger.warning(f"获取失败：{e}，{wait:.1f} 秒后第 {attempt + 1} 次重试")
+        finally:
+            _local.bucket = None
+        time.sleep(wait)
+
+
+def fetch_all(items, fetch_fn,
+              concurrency=FETCH_CONCURRENCY,
+              rate=FETCH_RATE,
+              burst=FETCH_BURST,
+              retries=FETCH_RETRIES,
+              backoff=FETCH_BACKOFF):
+    """
+    并发获取，按完成顺序逐个返回
+    :param items: 待获取的证券列表，如 backtrader.json 中的每一项
+    :param fetch_fn: 获取函数，参数为 items 中的一项
+    :param concurrency: 最多同时在途的请求数
+    :param rate: 每秒最多发起的请求数
+    :param burst: 令牌桶容量，允许的突发请求数
+    :param retries: 每个证券最多重试次数
+    :param backoff: 首次重试前等待的秒数
+    :return: 生成器，每次返回 (item, 返回值, 异常)，成功时异常为 None
+    调用方中途 break 或抛出异常时，还没有开始的获取直接取消，不等待正在进行的获取
+    """
+    bucket = TokenBucket(rate, burst)
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        futures = {pool.submit(call_with_retry, fetch_fn, item,
+                               retries=retries, backoff=backoff, bucket=bucket): item
+                   for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -1,7 +1,7 @@
 # -*- coding:utf-8 -*-
 """
 从 backtrader.json 文件读取需要分析的证券代码（个股或 ETF）
-走 akshare 的东财接口获取历史交易数据，vpn 下东财会断连，需使用国内网络
+默认走 akshare 的东财接口获取历史交易数据（数据源见 providers.py），vpn 下东财会断连，需使用国内网络
 根据 settings.py 中配置的起始时间，回溯每日收盘价格
 找出
 - 停留时间最多的区间
@@ -10,106 +10,499 @@
 - 模拟 停留时间最多的区间 的最低价买入，回溯收益和回撤
 - 模拟 覆盖70%时间的“价值区间” 的最低价买入，回溯收益和回撤
 """
+import bisect
 import os
-import time
 
-import akshare as ak
-import matplotlib
 import numpy as np
 import pandas as pd
 from loguru import logger
-from matplotlib import pyplot as plt
 
-import json
 from backtrader import get_return
-from settings import START_DATE, DUMP_DIR, STOCK_CODE, STOCK_NAME, PLOT, TODAY
+from dataset import CACHE, resolve, PERIODS_PER_YEAR
+from fetcher import fetch_all
+from logs import add_sink
+from memo import MEMO
+from metrics import span, timed, write_summary
+from plotting import pyplot
+from providers import get_provider
+from registry import load_stocks
+from result import summarize
+import report
+from settings import START_DATE, DUMP_DIR, STOCK_CODE, STOCK_NAME, PLOT, TODAY, BIN_PCT, VALUE_AREA, SAVE_DATA, \
+    ROLLING_WINDOW, ROLLING_MIN_PERIODS, REPORT, ADJUST_CHECK_TICKS, \
+    TIMEFRAME
+from store import tail, append_bars, load_bars, reset, is_legacy, price_tick, hfq_tolerance
 from utils import clear_file
 
-matplotlib.rcParams['font.sans-serif'] = ['SimHei']  # 设置中文字体
-matplotlib.rcParams['axes.unicode_minus'] = False  # 正常显示负号
 
-# /home/rhino/s/a/app_YYYY-MM-DD_HH-mm-ss_ssssss.log
-logger.add(os.path.join(DUMP_DIR, 'app_{time:YYYYMMDD}.log'),
-           rotation="50 MB",
-           retention="3 days",
-           compression="gz",
-           enqueue=True)
+def _fetch_k_data(stock_code, start_date, full=False):
+    """
+    从数据源获取 start_date 到今天的不复权日线，以及逐日的后复权收盘价
+    :param stock_code: 如 588000 或 601398
+    :param start_date: 如 2018-01-01
+    :param full: 是否为全量下载，全量下载时同时获取前复权收盘价用于校验
+    :return: DataFrame，列为 providers.SCHEMA、hfq，全量下载时还有 qfq
+    """
+    with span("fetch", stock_code) as s:
+        df = get_provider().get_factor_bars(stock_code, start_date, TODAY, qfq=full)
+        s.rows = len(df)
+    return df
 
 
+def _check_qfq(stock_code, df):
+    """
+    由复权因子推算的前复权收盘价与数据源的前复权收盘价对比，相差超过 ADJUST_CHECK_TICKS 个最小价位时
+    删除本地存储并抛出异常，不让推算口径悄悄偏离数据源
+    :param stock_code: 如 588000 或 601398
+    :param df: _fetch_k_data 全量下载的结果，包含 qfq 列
+    :return:
+    """
+    derived = load_bars(stock_code, adjust="qfq").set_index('date')['close']
+    source = df.set_index(pd.to_datetime(df['date']))['qfq']
+    diff = (derived - source.reindex(derived.index)).abs().dropna()
+    limit = ADJUST_CHECK_TICKS * price_tick(stock_code)
+    if len(diff) and diff.max() > limit:
+        reset(stock_code)
+        raise ValueError(f"{stock_code} 由复权因子推算的前复权价与数据源不一致："
+                         f"{diff.idxmax():%Y-%m-%d} 相差 {diff.max():.4f} 元，超过 {limit:.4f} 元")
+
+
+@timed("get_k_data")
 def get_k_data(stock_code=STOCK_CODE, stock_name=STOCK_NAME):
     """
-    获取从 2018-01-01 到昨天的历史交易日数据
+    增量获取从 2018-01-01 到今天的历史交易日数据，写入本地存储
+    - 本地存储不复权价格和复权因子，除权除息不会改变已存储的历史，只会增加一段因子
+    - 从已存储的倒数第二个交易日开始获取，最后一天可能是盘中数据，会被覆盖
+    - 倒数第二个交易日的不复权收盘价或后复权收盘价与新获取的不一致，说明数据源修正了历史，重新下载全部历史
+    - 旧版存储（前复权价格或旧版因子格式）重新下载一次全部历史迁移成新格式
+    - 全量下载时校验推算的前复权价与数据源一致，见 _check_qfq
     :param stock_code: 如 588000 或 601398
     :param stock_name: 如 科创50 或 工商银行
     :return:
     """
-    df = ak.fund_etf_hist_em(symbol=stock_code,
-                             start_date=START_DATE.replace('-', ''),
-                             end_date=TODAY.replace('-', ''),
-                             period="daily",
-                             adjust="qfq")
+    if is_legacy(stock_code):
+        logger.info(f"{stock_code}_{stock_name} 本地存储为旧版格式，重新下载全部历史迁移为不复权价格和复权因子")
+        reset(stock_code)
 
-    df = df.rename(columns={"收盘": "close", "日期": "date"})
+    last = tail(stock_code)
+    full = last is None
+    if not full:
+        anchor = last.iloc[0]
+        df = _fetch_k_data(stock_code, anchor['date'].strftime('%Y-%m-%d'))
+        fetched = df.loc[pd.to_datetime(df['date']) == anchor['date']]
+        # 新获取的后复权价有取整误差，已存储的由因子推算，也有拟合误差
+        tol = hfq_tolerance(price_tick(stock_code), fetched['close'], fetched['hfq'])
+        if len(fetched) and not (np.isclose(fetched['close'].iloc[0], anchor['close'])
+                                 and abs(fetched['hfq'].iloc[0] - anchor['hfq']) <= tol[0]):
+            logger.warning(f"{stock_code}_{stock_name} 历史价格或复权因子已变化，重新下载全部历史")
+            reset(stock_code)
+            full = True
+    if full:
+        df = _fetch_k_data(stock_code, START_DATE, full=True)
 
-    df.to_csv(f"{os.path.join(DUMP_DIR, stock_code)}_{stock_name}.csv")
+    append_bars(stock_code, df, stock_name)
+    CACHE.invalidate(stock_code)
+    if full:
+        _check_qfq(stock_code, df)
 
+    # 需要留存数据时，额外导出一份 CSV 便于查看
+    if SAVE_DATA:
+        path = f"{os.path.join(DUMP_DIR, stock_code)}_{stock_name}.csv"
+        with span("write_csv", stock_code) as s:
+            df = load_bars(stock_code)
+            df.to_csv(path)
+            s.rows = len(df)
+            s.bytes_written = os.path.getsize(path)
+
+
+def get_spot_prices(stock_codes):
+    """
+    实时行情，东财一次请求拿到全部 ETF 或全部个股的最新价，不需要逐个获取历史数据
+    :param stock_codes: 证券代码列表，如 [588000, 601398]
+    :return: dict，证券代码 -> 最新价，停牌或没有报价的不在其中
+    """
+    with span("spot") as s:
+        prices = get_provider().get_spot(stock_codes)
+        s.rows = len(prices)
+    return prices
+
+
+def _round_edges(bins, precision=3):
+    """
+    区间边界按 pd.cut 标签口径取整：整数部分非零保留 precision 位小数，否则保留 precision 位有效数字
+    精度不足以区分相邻边界时逐位增加
+    :param bins:
+    :param precision:
+    :return:
+    """
+    bins = np.asarray(bins, dtype=float)
+    frac, whole = np.modf(bins)
+    keep = ~np.isfinite(bins) | (bins == 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        magnitude = np.floor(np.log10(np.abs(frac)))
+
+    for p in range(precision, 20):
+        digits = np.where(whole == 0, -magnitude - 1 + p, p)
+        digits[keep] = 0
+        edges = bins.copy()
+        for d in np.unique(digits[~keep]).astype(int):
+            mask = ~keep & (digits == d)
+            edges[mask] = np.around(bins[mask], d)
+        if len(np.unique(edges)) == len(bins):
+            return edges
+    return bins
 
-def get_distribution(stock_code=STOCK_CODE, stock_name=STOCK_NAME):
-    # 1. 读取收盘价数据
-    df = pd.read_csv(f"{os.path.join(DUMP_DIR, stock_code)}_{stock_name}.csv")
-    # 收盘价
-    prices = df['close']
 
-    # 3. 动态计算 bin 宽度（建议使用均价的 2%）
-    mean_price = prices.mean()
-    bin_width = mean_price * 0.02
-    min_price, max_price = prices.min(), prices.max()
+def _price_bins(prices, bin_pct):
+    """
+    动态计算 bin 边界，宽度为均价的 bin_pct，从最低价开始
+    :param prices: 收盘价数组
+    :param bin_pct: bin 宽度占均价的比例
+    :return:
+    """
+    return _bins(np.nanmean(prices), np.nanmin(prices), np.nanmax(prices), bin_pct)
 
+
+def _bins(mean_price, min_price, max_price, bin_pct):
+    """
+    由均价、最低价、最高价得到 bin 边界，分块计算时不需要完整的价格数组
+    :return:
+    """
+    bin_width = mean_price * bin_pct
     bins = np.arange(min_price, max_price + bin_width, bin_width)
+    if len(bins) < 2:
+        bins = np.array([min_price, min_price + bin_width])
+    return bins
 
-    # 4. 使用 pd.cut 分组统计频次
-    price_bins = pd.cut(prices, bins=bins, right=False)
-    freq = price_bins.value_counts().sort_index()
 
-    # 5. 输出停留时间最多的区间
-    top_zone = freq.idxmax()
-    top_days = freq.max()
-    logger.info(f"{stock_code}_{stock_name} 最密集价格区间：{top_zone}, "
-                f"共停留了 {top_days} 天")
+def _bin_index(prices, bins):
+    """
+    整数 bin 下标，左闭右开区间 [left, right)，与 pd.cut(prices, bins, right=False) 一致
+    :param prices:
+    :param bins:
+    :return: (下标, 是否落在区间内)
+    """
+    idx = np.searchsorted(bins, prices, side='right') - 1
+    valid = (idx >= 0) & (idx < len(bins) - 1)
+    return idx, valid
+
+
+def _value_area(weights, coverage):
+    """
+    按权重从大到小累加，覆盖 coverage 比例的区间
+    权重相同的 bin 按价格从低到高累加：覆盖比例的截止落在相同权重的几个 bin 之间时，保留价格较低的 bin；
+    权重最大的 bin 有多个时取价格最低的一个
+    :param weights: 每个 bin 的停留天数或成交量
+    :param coverage:
+    :return: (权重最大的 bin 下标, 是否在价值区间内)
+    """
+    top = int(np.argmax(weights))
+    # 稳定排序，相同权重保持 bin 的价格顺序，结果不依赖排序算法
+    order = np.argsort(-weights, kind='stable')
+    in_area = np.zeros(len(weights), dtype=bool)
+    in_area[order[np.cumsum(weights[order]) <= coverage * weights.sum()]] = True
+    if not in_area.any():
+        in_area[top] = True
+    return top, in_area
+
+
+def compute_distribution(prices, bin_pct=BIN_PCT, coverage=VALUE_AREA):
+    """
+    计算收盘价的停留时间分布
+    分组口径与 pd.cut(prices, bins, right=False) 一致，直接用 searchsorted 得到整数 bin 下标再 bincount
+    :param prices: 收盘价数组
+    :param bin_pct: bin 宽度占均价的比例
+    :param coverage: “价值区间”覆盖的交易日比例
+    :return: dict，包含 bins、counts、最密集区间、价值区间、当前价格百分位，区间边界按 pd.cut 标签口径取整
+    """
+    prices = np.asarray(prices, dtype=float)
+
+    # 动态计算 bin 宽度（建议使用均价的 2%）
+    bins = _price_bins(prices, bin_pct)
+
+    # 落在区间外的不计数
+    idx, valid = _bin_index(prices, bins)
+    counts = np.bincount(idx[valid], minlength=len(bins) - 1)
+
+    # 停留时间最多的区间，按停留天数从多到少累加，覆盖 70% 交易日的区间
+    top, in_area = _value_area(counts, coverage)
+    area = np.flatnonzero(in_area)
 
-    # 6. 输出覆盖70%时间的“价值区间”
-    cum_freq = freq.sort_values(ascending=False).cumsum()
-    total_days = freq.sum()
-    value_area = freq[cum_freq <= 0.7 * total_days]
+    # 当前价格在历史分布的百分位
+    current_price = prices[-1]
+    percentile = (prices < current_price).sum() / len(prices) * 100
+
+    edges = _round_edges(bins)
+    return {
+        "bins": bins,
+        "edges": edges,
+        "counts": counts,
+        "top_left": edges[top],
+        "top_right": edges[top + 1],
+        "top_days": int(counts[top]),
+        "lowest_price": edges[area[0]],
+        "highest_price": edges[area[-1] + 1],
+        "value_area_days": int(counts[in_area].sum()),
+        "total_days": int(counts.sum()),
+        "current_price": current_price,
+        "percentile": percentile,
+    }
+
+
+def stream_distribution(chunks, bin_pct=BIN_PCT, coverage=VALUE_AREA):
+    """
+    分块计算的价格分布，口径与 compute_distribution 相同，内存只与单个分块的大小有关
+    bin 边界取决于整体的均价、最低价、最高价，因此遍历两次：
+    第一次累计根数、价格总和、最低价、最高价，第二次按 bin 计数并累加成交量
+    :param chunks: 无参函数，每次调用返回一个新的迭代器，依次产出 (收盘价数组, 成交量数组)
+    :param bin_pct: bin 宽度占均价的比例
+    :param coverage: “价值区间”覆盖的 K 线比例
+    :return: dict，包含 compute_distribution 的各项，以及每个 bin 的成交量和成交量最大的区间
+    """
+    # 1. 第一遍：根数、总和、最低价、最高价、最新价
+    n, total, min_price, max_price, current_price = 0, 0.0, np.inf, -np.inf, np.nan
+    for prices, _ in chunks():
+        prices = np.asarray(prices, dtype=float)
+        prices = prices[~np.isnan(prices)]
+        if not len(prices):
+            continue
+        n += len(prices)
+        total += prices.sum()
+        min_price = min(min_price, prices.min())
+        max_price = max(max_price, prices.max())
+        current_price = prices[-1]
+    if not n:
+        raise ValueError("没有可以统计的价格")
+
+    # 2. 第二遍：按 bin 计数、累加成交量，统计低于最新价的根数
+    bins = _bins(total / n, min_price, max_price, bin_pct)
+    counts = np.zeros(len(bins) - 1, dtype=np.int64)
+    volumes = np.zeros(len(bins) - 1)
+    below = 0
+    for prices, vols in chunks():
+        prices = np.asarray(prices, dtype=float)
+        vols = np.nan_to_num(np.asarray(vols, dtype=float))
+        idx, valid = _bin_index(prices, bins)
+        counts += np.bincount(idx[valid], minlength=len(counts))
+        volumes += np.bincount(idx[valid], weights=vols[valid], minlength=len(volumes))
+        below += int((prices < current_price).sum())
+
+    top, in_area = _value_area(counts, coverage)
+    area = np.flatnonzero(in_area)
+    poc, _ = _value_area(volumes, coverage)
+    edges = _round_edges(bins)
+    return {
+        "bins": bins,
+        "edges": edges,
+        "counts": counts,
+        "volumes": volumes,
+        "top_left": edges[top],
+        "top_right": edges[top + 1],
+        "top_days": int(counts[top]),
+        "lowest_price": edges[area[0]],
+        "highest_price": edges[area[-1] + 1],
+        "value_area_days": int(counts[in_area].sum()),
+        "total_days": int(counts.sum()),
+        "poc_left": edges[poc],
+        "poc_right": edges[poc + 1],
+        "current_price": current_price,
+        "percentile": below / n * 100,
+    }
+
+
+def compute_volume_profile(prices, volumes, bin_pcts=(BIN_PCT,), coverage=VALUE_AREA):
+    """
+    按成交量加权的价格分布（成交量分布）
+    bin 边界与 compute_distribution 相同，结果中同时给出停留天数，两种分布可以逐个 bin 对照
+    多个 bin 宽度的下标拼接在一起，一次 bincount 得到全部分辨率的停留天数和成交量
+    :param prices: 收盘价数组
+    :param volumes: 成交量数组
+    :param bin_pcts: bin 宽度占均价的比例，可以有多个
+    :param coverage: “价值区间”覆盖的成交量比例
+    :return: dict，bin_pct -> 该分辨率的 bins、counts、volumes、成交量最大的区间（POC）、成交量价值区间
+    """
+    prices = np.asarray(prices, dtype=float)
+    volumes = np.asarray(volumes, dtype=float)
+    volumes = np.where(np.isnan(volumes), 0.0, volumes)
+
+    # 1. 每个分辨率的 bin 下标加上偏移量，拼成一个整数数组
+    all_bins, all_idx, all_weights, offsets = [], [], [], [0]
+    for bin_pct in bin_pcts:
+        bins = _price_bins(prices, bin_pct)
+        idx, valid = _bin_index(prices, bins)
+        all_bins.append(bins)
+        all_idx.append(idx[valid] + offsets[-1])
+        all_weights.append(volumes[valid])
+        offsets.append(offsets[-1] + len(bins) - 1)
+    idx = np.concatenate(all_idx)
+
+    # 2. 一次 bincount 得到全部分辨率的停留天数和成交量
+    counts = np.bincount(idx, minlength=offsets[-1])
+    volume_sum = np.bincount(idx, weights=np.concatenate(all_weights), minlength=offsets[-1])
+
+    # 3. 按分辨率切开，分别计算 POC 和 70% 成交量的价值区间
+    profiles = {}
+    for i, bin_pct in enumerate(bin_pcts):
+        lo, hi = offsets[i], offsets[i + 1]
+        vol = volume_sum[lo:hi]
+        poc, in_area = _value_area(vol, coverage)
+        area = np.flatnonzero(in_area)
+        edges = _round_edges(all_bins[i])
+        profiles[bin_pct] = {
+            "bins": all_bins[i],
+            "edges": edges,
+            "counts": counts[lo:hi],
+            "volumes": vol,
+            "poc_left": edges[poc],
+            "poc_right": edges[poc + 1],
+            "poc_volume": vol[poc],
+            "lowest_price": edges[area[0]],
+            "highest_price": edges[area[-1] + 1],
+            "value_area_volume": vol[in_area].sum(),
+            "total_volume": vol.sum(),
+        }
+    return profiles
+
+
+def rolling_distribution(prices,
+                         window=ROLLING_WINDOW,
+                         bin_pct=BIN_PCT,
+                         coverage=VALUE_AREA,
+                         min_periods=ROLLING_MIN_PERIODS):
+    """
+    滚动（或扩展）窗口的价格分布，每个交易日只使用当天及之前的数据，没有未来函数
+    - bin 宽度取前 min_periods 个交易日均价的 bin_pct，起点为其中的最低价，之后不再变化
+    - 窗口滑动时只对进入和离开窗口的那一天做 bin 计数的加减，不重新分组
+    - 窗口内价格用有序列表维护，百分位用二分查找
+    当天的值包含当天收盘价，用作买入价时需要 shift(1)
+    :param prices: 收盘价 Series 或数组
+    :param window: 窗口交易日数，为空时为扩展窗口
+    :param bin_pct: bin 宽度占均价的比例
+    :param coverage: “价值区间”覆盖的交易日比例
+    :param min_periods: 至少多少个交易日才开始输出
+    :return: DataFrame，列为 top_left、top_right、lowest_price、highest_price、percentile，索引与 prices 相同
+    """
+    index = prices.index if isinstance(prices, pd.Series) else None
+    prices = np.asarray(prices, dtype=float)
+    n = len(prices)
+    result = {col: np.full(n, np.nan) for col in ("top_left", "top_right", "lowest_price", "highest_price",
+                                                  "percentile")}
+    valid = ~np.isnan(prices)
+    if valid.sum() < min_periods:
+        return pd.DataFrame(result, index=index)
+
+    # 1. 固定的 bin 网格，只依赖前 min_periods 个交易日
+    warm = prices[valid][:min_periods]
+    bin_width = warm.mean() * bin_pct
+    origin = warm.min()
+    idx = np.zeros(n, dtype=np.int64)
+    idx[valid] = np.floor((prices[valid] - origin) / bin_width).astype(np.int64)
+    offset = idx[valid].min()
+    idx -= offset
+    counts = np.zeros(idx[valid].max() + 1, dtype=np.int64)
+    edges = _round_edges(origin + (np.arange(len(counts) + 1) + offset) * bin_width)
+
+    # 2. 逐日加入、移出窗口，增量维护 bin 计数和有序价格
+    window_prices = []
+    seen = 0
+    for t in range(n):
+        if valid[t]:
+            counts[idx[t]] += 1
+            bisect.insort(window_prices, prices[t])
+            seen += 1
+        if window is not None and t >= window and valid[t - window]:
+            counts[idx[t - window]] -= 1
+            del window_prices[bisect.bisect_left(window_prices, prices[t - window])]
+        if seen < min_periods or not valid[t]:
+            continue
 
-    # print("覆盖70%交易日的价值区间：")
-    # print(value_area.sort_index())
+        total = len(window_prices)
+        top, in_area = _value_area(counts, coverage)
+        area = np.flatnonzero(in_area)
 
-    # 6. “价值区间”最低价、最高价
-    lowest_price = value_area.index[0].left
-    highest_price = value_area.index[-1].right
+        result["top_left"][t] = edges[top]
+        result["top_right"][t] = edges[top + 1]
+        result["lowest_price"][t] = edges[area.min()]
+        result["highest_price"][t] = edges[area.max() + 1]
+        result["percentile"][t] = bisect.bisect_left(window_prices, prices[t]) / total * 100
 
-    # 7. 价值区间交易日合计
-    total_days_in_value_area = value_area.sum()
-    # print(f"覆盖比例：{total_days_in_value_area / total_days:.2%}")
+    return pd.DataFrame(result, index=index)
+
+
+@timed("get_distribution")
+def get_distribution(stock_code=STOCK_CODE, stock_name=STOCK_NAME, data=None, timeframe=TIMEFRAME):
+    """
+    输出价格分布，并模拟两个区间的最低价买入
+    :param stock_code: 如 588000 或 601398
+    :param stock_name: 如 科创50 或 工商银行
+    :param data: 日线 DataFrame 或 Dataset，为空时从缓存读取
+    :param timeframe: daily、weekly 或 monthly，周线、月线由日线重采样，停留时间按 K 线根数统计
+    :return: 三个目标买入价的 BacktestResult 列表
+    """
+    # 1. 读取收盘价数据，与两次回溯共用同一份
+    df = resolve(data, stock_code, timeframe)
+    # 收盘价
+    prices = df['close']
+
+    # 2. 统计价格分布，收盘价和参数不变时直接使用上次的结果
+    dist = MEMO.call("compute_distribution/2", compute_distribution, prices.to_numpy(dtype=float),
+                     bin_pct=BIN_PCT, coverage=VALUE_AREA)
+    if report.current() is not None:
+        report.current().add_distribution(stock_code, stock_name, dist)
+
+    # 3. 输出停留时间最多的区间
+    top_zone = f"[{dist['top_left']}, {dist['top_right']})"
+    logger.info(f"{stock_code}_{stock_name} 最密集价格区间：{top_zone}, "
+                f"共停留了 {dist['top_days']} 天")
+
+    # 4. 输出覆盖70%时间的“价值区间”最低价、最高价及交易日合计
     # 覆盖比例就不用输出了，肯定接近于 70%。因为计算的就是覆盖 70% 交易日的价值区间
+    lowest_price = dist['lowest_price']
+    highest_price = dist['highest_price']
     logger.info(f"{stock_code}_{stock_name} "
                 f"覆盖70%交易日的价值区间：[{lowest_price}, {highest_price}), "
-                f"共停留了 {total_days_in_value_area} 天, "
-                f"总交易日 {total_days} 天）")
+                f"共停留了 {dist['value_area_days']} 天, "
+                f"总交易日 {dist['total_days']} 天）")
 
-    # 7. 当前价格在历史分布的百分位
-    current_price = prices.iloc[-1]
-    percentile = (prices < current_price).sum() / len(prices) * 100
-    logger.info(f"{stock_code}_{stock_name} 当前价格：{current_price:.2f}，"
-                f"位于历史分布的第 {percentile:.2f} 百分位")
+    # 5. 当前价格在历史分布的百分位
+    logger.info(f"{stock_code}_{stock_name} 当前价格：{dist['current_price']:.2f}，"
+                f"位于历史分布的第 {dist['percentile']:.2f} 百分位")
+
+    # 6. 两个区间的最低价买入，回溯收益和回撤
+    results = [get_return(stock_code, stock_name, dist['top_left'], data=df, timeframe=timeframe),
+               get_return(stock_code, stock_name, lowest_price, data=df, timeframe=timeframe)]
+
+    # 7. 滚动“价值区间”的最低价买入，每天只用之前的数据，避免全历史分布带来的未来函数
+    # 窗口按交易日配置，周线、月线换算成相同时间跨度的 K 线根数
+    # ROLLING_WINDOW = None 时为扩展窗口，不需要换算
+    scale = PERIODS_PER_YEAR[timeframe] / PERIODS_PER_YEAR["daily"]
+    window = None if ROLLING_WINDOW is None else max(1, round(ROLLING_WINDOW * scale))
+    rolling = MEMO.call("rolling_distribution/2", rolling_distribution, df.set_index('date')['close'],
+                        window=window, bin_pct=BIN_PCT, coverage=VALUE_AREA,
+                        min_periods=max(1, round(ROLLING_MIN_PERIODS * scale)))
+    latest = rolling.iloc[-1]
+    logger.info(f"{stock_code}_{stock_name} "
+                f"滚动覆盖70%交易日的价值区间：[{latest['lowest_price']}, {latest['highest_price']}), "
+                f"当前价格位于滚动分布的第 {latest['percentile']:.2f} 百分位")
+    results.append(get_return(stock_code, stock_name, rolling['lowest_price'].shift(1), data=df,
+                              timeframe=timeframe))
 
-    # 8. 两个区间的最低价买入，回溯收益和回撤
-    get_return(stock_code, stock_name, top_zone.left)
-    get_return(stock_code, stock_name, lowest_price)
+    # 对比三个目标买入价
+    table = summarize(results)
+    table.insert(0, "source", ["top_zone", "value_area", "rolling"])
+    best = table.loc[table['total_return'].idxmax()]
+    logger.info(f"{stock_code}_{stock_name} 三个目标买入价的回溯对比，总收益率最高的是 {best['source']}：\n"
+                f"{table[['source', 'bid', 'total_return', 'annual_return', 'max_drawdown', 'trades']].to_string()}")
+
+    # 8. 成交量分布，与停留时间分布使用相同的 bin
+    profile = compute_volume_profile(prices, df['volume'])[BIN_PCT]
+    logger.info(f"{stock_code}_{stock_name} 成交量最大的价格区间：[{profile['poc_left']}, {profile['poc_right']}), "
+                f"覆盖70%成交量的价值区间：[{profile['lowest_price']}, {profile['highest_price']})")
 
     if PLOT:
-        # 8. 可视化频次分布
+        # 9. 可视化频次分布
+        freq = pd.Series(dist['counts'], index=pd.IntervalIndex.from_breaks(dist['edges'], closed='left'))
+        plt = pyplot()
         freq.plot(kind='bar', figsize=(16, 6))
         plt.title(f"{stock_code}_{stock_name} 自 {START_DATE} 日股价停留分布")
         plt.xlabel("价格区间（元）")
@@ -118,31 +511,44 @@ def get_distribution(stock_code=STOCK_CODE, stock_name=STOCK_NAME):
         plt.tight_layout()
         plt.show()
 
+    return results
+
 
 def get_stocks():
     """
     读取需要评估的证券信息
     :return:
     """
-    with open('json/backtrader.json', encoding='utf-8') as f:
-        return json.loads(f.read())
+    return load_stocks('json/backtrader.json')
 
 
 if __name__ == '__main__':
+    # /home/rhino/s/a/app_YYYYMMDD.log
+    add_sink('app')
     cs = get_stocks()
 
-    for comp in cs:
+    # 报告模式下图表在后台进程中渲染，运行结束时写出 HTML
+    if REPORT:
+        report.start()
+
+    # 并发获取，先获取到的证券先分析，其余证券继续在后台获取
+    for comp, _, err in fetch_all(cs, lambda c: get_k_data(f"{c.get('code')}", c.get('name'))):
         cs_code = comp.get('code')
         cs_name = comp.get('name')
         # cs_mkt = comp.get('market')
 
-        get_k_data(f"{cs_code}", cs_name)
-        get_distribution(f"{cs_code}", cs_name)
+        if err is not None:
+            logger.error(f"{cs_code}_{cs_name} 获取历史数据失败：{err}")
+            continue
 
-        time.sleep(10)
+        get_distribution(f"{cs_code}", cs_name)
 
     # 利用 settings.py 中的默认配置评估单个证券
     # get_k_data()
     # get_distribution()
 
+    report.finish()
+    CACHE.log_stats()
+    MEMO.log_stats()
+    write_summary()
     clear_file()
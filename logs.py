@@ -0,0 +1,28 @@
+# -*- coding:utf-8 -*-
+"""
+日志文件
+只在作为脚本运行时添加日志文件，被其他模块导入时不再启动写日志的后台线程
+"""
+import os.path
+
+from loguru import logger
+
+from settings import DUMP_DIR
+
+_sinks = {}
+
+
+def add_sink(prefix):
+    """
+    添加按天命名的日志文件，同一个前缀只添加一次
+    /home/rhino/s/a/{prefix}_YYYYMMDD.log
+    :param prefix: 如 app、backtrader、notify
+    :return: 日志文件的 sink id
+    """
+    if prefix not in _sinks:
+        _sinks[prefix] = logger.add(os.path.join(DUMP_DIR, f'{prefix}_{{time:YYYYMMDD}}.log'),
+                                    rotation="50 MB",
+                                    retention="3 days",
+                                    compression="gz",
+                                    enqueue=True)
+    return _sinks[prefix]
@@ -0,0 +1,198 @@
+# -*- coding:utf-8 -*-
+"""
+按内容寻址的结果缓存
+停牌、周末、中断后重跑时，大部分证券的日线没有变化，分布和回溯的结果也不会变化
+- 键为输入数组的字节和参数的 blake2b 哈希，输入或参数任何一处变化都会得到新的键，不需要主动失效
+- 结果用 pickle 保存在 MEMO_DIR 下，每个结果一个文件，先写唯一的临时文件再替换
+- 磁盘占用超过 MEMO_MAX_BYTES 时按最近使用时间淘汰
+计算逻辑变化时修改命名空间中的版本号，旧结果不会再被命中，之后被淘汰
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from settings import MEMO_ENABLED, MEMO_DIR, MEMO_MAX_BYTES
+
+
+def _array_bytes(arr):
+    """
+    数组内容的字节：数值、布尔和日期直接取内存中的字节
+    object 数组存的是对象指针，按元素哈希，元素不可哈希时按 pickle 计算
+    """
+    if arr.dtype.kind in 'biufcmM':
+        return np.ascontiguousarray(arr).view(np.uint8).data
+    try:
+        return pd.util.hash_array(arr.ravel()).data
+    except TypeError:
+        return pickle.dumps(arr.tolist(), protocol=4)
+
+
+def digest(namespace, *values, **params):
+    """
+    输入和参数的哈希
+    :param namespace: 命名空间，如 get_return/2
+    :param values: 输入，数组按 dtype、形状和内容计算，Series 再加上索引，其余按 repr 计算
+    :param params: 参数，按 json 计算，与顺序无关
+    :return: 32 位十六进制字符串
+    """
+    h = hashlib.blake2b(namespace.encode(), digest_size=16)
+    for value in values:
+        # Series 的索引也是输入的一部分
+        arrays = [value.index.to_numpy(), value.to_numpy()] if isinstance(value, pd.Series) else [value]
+        for arr in arrays:
+            if isinstance(arr, np.ndarray):
+                h.update(f"|{arr.dtype.str}{arr.shape}|".encode())
+                h.update(_array_bytes(arr))
+            else:
+                h.update(f"|{arr!r}|".encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    磁盘上的结果缓存，按占用大小做 LRU 淘汰
+    """
+
+    def __init__(self, memo_dir=MEMO_DIR, max_bytes=MEMO_MAX_BYTES, enabled=MEMO_ENABLED):
+        self.memo_dir = memo_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._entries = None
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key):
+        return os.path.join(self.memo_dir, key[:2], f"{key}.pkl")
+
+    def _scan(self):
+        """
+        第一次使用时扫描目录，记录每个结果的大小和最近使用时间
+        """
+        if self._entries is not None:
+            return
+        self._entries = {}
+        if os.path.exists(self.memo_dir):
+            for sub in os.scandir(self.memo_dir):
+                if not sub.is_dir():
+                    continue
+                for f in os.scandir(sub.path):
+                    if f.name.endswith('.pkl'):
+                        st = f.stat()
+                        self._entries[f.name[:-4]] = (st.st_size, st.st_mtime)
+        self._bytes = sum(size for size, _ in self._entries.values())
+
+    def get(self, key):
+        """
+        :param key: digest 的结果
+        :return: (是否命中, 结果)
+        """
+        with self._lock:
+            self._scan()
+            if key not in self._entries:
+                self.misses += 1
+                return False, None
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    value = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError) as e:
+                logger.warning(f"结果缓存 {key} 读取失败，重新计算：{e}")
+                self._remove(key)
+                self.misses += 1
+                return False, None
+            # 更新修改时间作为最近使用时间
+            os.utime(path)
+            self._entries[key] = (self._entries[key][0], os.path.getmtime(path))
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value):
+        with self._lock:
+            self._scan()
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 临时文件名唯一，多个进程同时写同一个键时不会互相覆盖
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f.name, path)
+
+            if key in self._entries:
+                self._bytes -= self._entries[key][0]
+            size = os.path.getsize(path)
+            self._entries[key] = (size, os.path.getmtime(path))
+            self._bytes += size
+            self._evict(keep=key)
+
+    def _remove(self, key):
+        size, _ = self._entries.pop(key)
+        self._bytes -= size
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep):
+        if self._bytes <= self.max_bytes:
+            return
+        for key, _ in sorted(self._entries.items(), key=lambda item: item[1][1]):
+            if self._bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self._remove(key)
+            self.evictions += 1
+
+    def call(self, namespace, fn, *values, **params):
+        """
+        有相同输入和参数的结果时直接返回，否则计算 fn(*values, **params) 并保存
+        :param namespace: 命名空间，如 compute_distribution/2
+        :param fn: 纯函数，结果只取决于 values 和 params
+        :param values: 位置参数，参与哈希
+        :param params: 关键字参数，参与哈希
+        :return: fn 的结果
+        """
+        if not self.enabled:
+            return fn(*values, **params)
+        key = digest(namespace, *values, **params)
+        hit, value = self.get(key)
+        if hit:
+            return value
+        value = fn(*values, **params)
+        self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._scan()
+            for key in list(self._entries):
+                self._remove(key)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries or {}),
+            "bytes": self._bytes,
+        }
+
+    def log_stats(self):
+        if not self.enabled:
+            return
+        logger.info(f"结果缓存 命中 {self.hits} 次，未命中 {self.misses} 次，淘汰 {self.evictions} 次，"
+                    f"占用 {self._bytes / 1024 / 1024:.1f} MB")
+
+
+# 进程内共享的结果缓存
+MEMO = ResultCache()
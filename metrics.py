@@ -0,0 +1,204 @@
+# -*- coding:utf-8 -*-
+"""
+运行耗时统计
+定时任务变慢时，日志看不出时间花在东财接口、读写文件、计算分布、回溯还是发邮件上
+在这些环节外面套一层 span，记录每个证券每个环节的耗时、处理行数和读写字节数，运行结束时输出汇总
+- with span("fetch", stock_code) as s: ... s.rows = len(df)
+- @timed("get_return") 以第一个参数作为证券代码
+未启用时 span 返回一个什么都不做的空对象，几乎没有开销
+只统计当前进程，进程池子进程中的环节不在其中
+"""
+import functools
+import json
+import os
+import threading
+import time
+
+from loguru import logger
+
+from settings import METRICS_ENABLED, METRICS_TOP_N, DUMP_DIR, TODAY
+
+_enabled = METRICS_ENABLED
+_records = []
+_lock = threading.Lock()
+
+
+class Span:
+    """
+    一个环节的一次执行
+    """
+    __slots__ = ("stage", "symbol", "rows", "bytes_read", "bytes_written", "seconds", "_start")
+
+    def __init__(self, stage, symbol=None):
+        self.stage = stage
+        self.symbol = symbol
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.seconds = 0.0
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._start
+        with _lock:
+            _records.append(self)
+
+    def to_dict(self):
+        return {
+            "stage": self.stage,
+            "symbol": self.symbol,
+            "seconds": self.seconds,
+            "rows": self.rows,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+        }
+
+
+class _NullSpan:
+    """
+    未启用时使用，赋值被忽略
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL = _NullSpan()
+
+
+def enable(flag=True):
+    global _enabled
+    _enabled = flag
+
+
+def enabled():
+    return _enabled
+
+
+def span(stage, symbol=None):
+    """
+    记录一个环节
+    :param stage: 环节名称，如 fetch、load_bars、send_mail
+    :param symbol: 证券代码，与证券无关的环节为空
+    :return: Span，未启用时返回空对象
+    """
+    if not _enabled:
+        return _NULL
+    return Span(stage, symbol)
+
+
+def timed(stage):
+    """
+    装饰器，整个函数记为一个环节，第一个参数（或 stock_code 参数）作为证券代码
+    :param stage:
+    :return:
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            symbol = args[0] if args else kwargs.get('stock_code')
+            with Span(stage, symbol):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def reset():
+    with _lock:
+        _records.clear()
+
+
+def records():
+    with _lock:
+        return list(_records)
+
+
+def summary(top_n=METRICS_TOP_N):
+    """
+    按环节和证券汇总
+    :param top_n: 最慢的 span 个数
+    :return: dict，stages、symbols、slowest
+    """
+    spans = records()
+    stages = {}
+    symbols = {}
+    for s in spans:
+        st = stages.setdefault(s.stage, {"count": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                         "rows": 0, "bytes_read": 0, "bytes_written": 0})
+        st["count"] += 1
+        st["seconds"] += s.seconds
+        st["max_seconds"] = max(st["max_seconds"], s.seconds)
+        st["rows"] += s.rows
+        st["bytes_read"] += s.bytes_read
+        st["bytes_written"] += s.bytes_written
+
+        if s.symbol is None:
+            continue
+        sym = symbols.setdefault(str(s.symbol), {})
+        sym_st = sym.setdefault(s.stage, {"seconds": 0.0, "rows": 0, "bytes_read": 0, "bytes_written": 0})
+        sym_st["seconds"] += s.seconds
+        sym_st["rows"] += s.rows
+        sym_st["bytes_read"] += s.bytes_read
+        sym_st["bytes_written"] += s.bytes_written
+
+    slowest = sorted(spans, key=lambda s: s.seconds, reverse=True)[:top_n]
+    return {
+        "stages": dict(sorted(stages.items(), key=lambda kv: kv[1]["seconds"], reverse=True)),
+        "symbols": symbols,
+        "slowest": [s.to_dict() for s in slowest],
+    }
+
+
+def format_table(spans):
+    """
+    最慢的 span 转成便于在日志中查看的表格
+    :param spans: summary 结果中的 slowest
+    :return:
+    """
+    lines = [f"{'环节':<20}{'证券':<12}{'耗时(ms)':>12}{'行数':>10}{'读(KB)':>10}{'写(KB)':>10}"]
+    for s in spans:
+        lines.append(f"{s['stage']:<20}{str(s['symbol'] or '-'):<12}{s['seconds'] * 1000:>12.2f}{s['rows']:>10}"
+                     f"{s['bytes_read'] / 1024:>10.1f}{s['bytes_written'] / 1024:>10.1f}")
+    return "\n".join(lines)
+
+
+def write_summary(path=None, top_n=METRICS_TOP_N):
+    """
+    运行结束时写出汇总 json，并在日志中输出最慢的 top_n 个 span，未启用时什么都不做
+    :param path: 为空时写到 DUMP_DIR/metrics 目录
+    :param top_n:
+    :return: 文件路径，未启用时返回 None
+    """
+    if not _enabled:
+        return None
+
+    result = summary(top_n)
+    if path is None:
+        # 放在子目录中，不会被 clear_file 清理
+        metrics_dir = os.path.join(DUMP_DIR, 'metrics')
+        os.makedirs(metrics_dir, exist_ok=True)
+        path = os.path.join(metrics_dir, f"metrics_{TODAY}_{time.strftime('%H%M%S')}.json")
+
+    with open(path, encoding='utf-8', mode='w') as f:
+        f.write(json.dumps(result, ensure_ascii=False, indent=2))
+
+    for stage, st in result["stages"].items():
+        logger.info(f"{stage} 共 {st['count']} 次，耗时 {st['seconds']:.3f} 秒，最长 {st['max_seconds']:.3f} 秒")
+    logger.info(f"最慢的 {len(result['slowest'])} 个环节：\n{format_table(result['slowest'])}")
+    return path
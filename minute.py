@@ -0,0 +1,192 @@
+# -*- coding:utf-8 -*-
+"""
+分钟线存储和分块分析
+一年的 1 分钟线约 6 万根，多年的数据一次读入再构造 DataFrame 内存占用太大
+- 每个证券一个目录，每月一个分区文件 {MINUTE_DIR}/{证券代码}/YYYY-MM.npz，时间为 datetime64[m]，其余列为 float64
+- 东财只保留最近几个交易日的分钟线，每天获取一次，与已有分区合并，同一时间以新数据为准
+- 读取用生成器逐个分区产出，分析在分区上流式进行，内存只与单个分区的大小有关
+python minute.py               获取 backtrader.json 中证券的分钟线并输出分钟级价格分布
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from historical_range import get_stocks, stream_distribution
+from logs import add_sink
+from metrics import span, write_summary
+from providers import get_provider
+from settings import MINUTE_DIR, MINUTE_PERIOD, TODAY, BIN_PCT, VALUE_AREA
+
+# 存储的列，date 之外都是 float64
+COLUMNS = ["open", "high", "low", "close", "volume", "amount"]
+# 没有分钟线时，第一次获取往前回溯的天数，东财只保留最近几个交易日
+FIRST_FETCH_DAYS = 10
+
+
+def _symbol_dir(stock_code):
+    return os.path.join(MINUTE_DIR, stock_code)
+
+
+def partitions(stock_code, start_date=None, end_date=None):
+    """
+    已存储的月份分区
+    :param stock_code: 如 588000 或 601398
+    :param start_date: 起始日期（含），只保留包含该日期之后数据的分区
+    :param end_date: 结束日期（含）
+    :return: 月份列表，如 ['2025-06', '2025-07']，升序
+    """
+    d = _symbol_dir(stock_code)
+    if not os.path.exists(d):
+        return []
+    months = sorted(f[:-4] for f in os.listdir(d) if f.endswith('.npz'))
+    if start_date is not None:
+        months = [m for m in months if m >= str(start_date)[:7]]
+    if end_date is not None:
+        months = [m for m in months if m <= str(end_date)[:7]]
+    return months
+
+
+def _read_partition(stock_code, month, columns):
+    with np.load(os.path.join(_symbol_dir(stock_code), f"{month}.npz")) as f:
+        return {col: f[col] for col in ["date"] + list(columns)}
+
+
+def append_minutes(stock_code, df):
+    """
+    分钟线按月写入分区，与已存储时间重叠的部分以新数据为准
+    每个分区先写临时文件再替换，写到一半中断不会破坏已有数据
+    :param stock_code: 如 588000 或 601398
+    :param df: 包含 date 和 COLUMNS 的 DataFrame
+    :return: 写入的根数
+    """
+    if df.empty:
+        return 0
+    times = pd.to_datetime(df["date"]).to_numpy().astype('datetime64[m]')
+    new = {"date": times}
+    for col in COLUMNS:
+        new[col] = df[col].to_numpy(dtype=float) if col in df else np.full(len(df), np.nan)
+
+    d = _symbol_dir(stock_code)
+    os.makedirs(d, exist_ok=True)
+    months = times.astype('datetime64[M]')
+    written = 0
+    with span("append_minutes", stock_code) as s:
+        for month in np.unique(months):
+            in_month = months == month
+            part = {col: values[in_month] for col, values in new.items()}
+            name = str(month)
+            path = os.path.join(d, f"{name}.npz")
+            if os.path.exists(path):
+                old = _read_partition(stock_code, name, COLUMNS)
+                keep = ~np.isin(old["date"], part["date"])
+                part = {col: np.concatenate([old[col][keep], part[col]]) for col in part}
+            order = np.argsort(part["date"], kind='stable')
+            part = {col: values[order] for col, values in part.items()}
+
+            tmp = f"{path}.tmp"
+            with open(tmp, 'wb') as f:
+                np.savez(f, **part)
+            os.replace(tmp, path)
+            written += sum(values.nbytes for values in part.values())
+        s.rows = len(times)
+        s.bytes_written = written
+    return len(times)
+
+
+def iter_minutes(stock_code, start_date=None, end_date=None, columns=("close", "volume")):
+    """
+    逐个分区读取分钟线
+    :param stock_code: 如 588000 或 601398
+    :param start_date: 起始日期（含），如 2025-01-01
+    :param end_date: 结束日期（含）
+    :param columns: 需要读取的列，npz 只解压用到的列
+    :return: 生成器，每个分区产出一个 DataFrame，列为 date 和 columns
+    """
+    lo = None if start_date is None else np.datetime64(start_date, 'D').astype('datetime64[m]')
+    hi = None if end_date is None else (np.datetime64(end_date, 'D') + 1).astype('datetime64[m]')
+    for month in partitions(stock_code, start_date, end_date):
+        with span("load_minutes", stock_code) as s:
+            part = _read_partition(stock_code, month, columns)
+            mask = np.ones(len(part["date"]), dtype=bool)
+            if lo is not None:
+                mask &= part["date"] >= lo
+            if hi is not None:
+                mask &= part["date"] < hi
+            s.rows = int(mask.sum())
+            s.bytes_read = sum(values.nbytes for values in part.values())
+        if not mask.any():
+            continue
+        df = pd.DataFrame({col: part[col][mask] for col in columns})
+        df.insert(0, "date", pd.DatetimeIndex(part["date"][mask].astype('datetime64[ns]')))
+        yield df
+
+
+def latest(stock_code):
+    """
+    已存储的最新分钟
+    :param stock_code: 如 588000 或 601398
+    :return: datetime64[m]，没有存储时返回 None
+    """
+    months = partitions(stock_code)
+    if not months:
+        return None
+    return _read_partition(stock_code, months[-1], ())["date"].max()
+
+
+def get_minute_data(stock_code, stock_name, period=MINUTE_PERIOD):
+    """
+    增量获取分钟线，从已存储的最新分钟所在交易日开始获取，当天盘中的数据会被覆盖
+    :param stock_code: 如 588000 或 601398
+    :param stock_name: 如 科创50 或 工商银行
+    :param period: 1、5、15、30 或 60 分钟
+    :return: 获取到的根数
+    """
+    last = latest(stock_code)
+    start = (np.datetime64(TODAY, 'D') - FIRST_FETCH_DAYS) if last is None else last.astype('datetime64[D]')
+    with span("fetch_minutes", stock_code) as s:
+        df = get_provider().get_minute_bars(stock_code, f"{start} 09:00:00", f"{TODAY} 15:30:00", period)
+        s.rows = len(df)
+    n = append_minutes(stock_code, df)
+    logger.info(f"{stock_code}_{stock_name} 获取分钟线 {n} 根，已存储 {len(partitions(stock_code))} 个月")
+    return n
+
+
+def minute_distribution(stock_code, start_date=None, end_date=None, bin_pct=BIN_PCT, coverage=VALUE_AREA):
+    """
+    分钟级价格分布，逐个分区流式计算，不把全部分钟线读入内存
+    :param stock_code: 如 588000 或 601398
+    :param start_date: 起始日期（含）
+    :param end_date: 结束日期（含）
+    :param bin_pct: bin 宽度占均价的比例
+    :param coverage: “价值区间”覆盖的 K 线比例
+    :return: dict，见 stream_distribution，停留时间按分钟计
+    """
+    def chunks():
+        for df in iter_minutes(stock_code, start_date, end_date, columns=("close", "volume")):
+            yield df["close"].to_numpy(), df["volume"].to_numpy()
+
+    return stream_distribution(chunks, bin_pct, coverage)
+
+
+if __name__ == '__main__':
+    # /home/rhino/s/a/app_YYYYMMDD.log
+    add_sink('app')
+    for comp in get_stocks():
+        cs_code = f"{comp.get('code')}"
+        cs_name = comp.get('name')
+        try:
+            get_minute_data(cs_code, cs_name)
+        except Exception as e:
+            logger.error(f"{cs_code}_{cs_name} 获取分钟线失败：{e}")
+        if not partitions(cs_code):
+            continue
+
+        dist = minute_distribution(cs_code)
+        logger.info(f"{cs_code}_{cs_name} 分钟级最密集价格区间：[{dist['top_left']}, {dist['top_right']})，"
+                    f"覆盖70%分钟的价值区间：[{dist['lowest_price']}, {dist['highest_price']})，"
+                    f"成交量最大的价格区间：[{dist['poc_left']}, {dist['poc_right']})，"
+                    f"当前价格位于第 {dist['percentile']:.2f} 百分位（共 {dist['total_days']} 分钟）")
+
+    write_summary()
@@ -0,0 +1,171 @@
+# -*- coding:utf-8 -*-
+"""
+蒙特卡洛稳健性检验
+get_return 只在一条历史路径上回溯，一次幸运的反弹就可能让某个目标买入价看起来很好
+- 从每个证券的历史日收益率中按块重抽样（块内保留相邻交易日的相关性，块长度为 1 即逐日独立重抽样），
+  从历史第一天的价格出发生成上万条价格路径
+- 所有路径作为矩阵的列，用 simulate_batch 一次推进，按块分批生成和模拟，内存只与每批路径数有关
+- 输出 总收益率、最大回撤、交易笔数 的分布，以及历史路径的结果在分布中的位置
+python montecarlo.py
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from backtrader import simulate, simulate_batch, get_max_drawdown
+from dataset import CACHE, resolve
+from fetcher import fetch_all
+from historical_range import compute_distribution, get_k_data, get_stocks
+from logs import add_sink
+from metrics import write_summary
+from settings import START_DATE, DUMP_DIR, STOCK_CODE, STOCK_NAME, TODAY, TAKE_PROFIT, MONTECARLO_PATHS, \
+    MONTECARLO_BLOCK, MONTECARLO_CHUNK, MONTECARLO_SEED
+from utils import clear_file
+
+# 分布输出的分位数
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def bootstrap_paths(close, n_paths, block=MONTECARLO_BLOCK, rng=None):
+    """
+    按块重抽样日对数收益率，生成价格路径
+    :param close: 历史收盘价数组，NaN（停牌）和非正的价格去掉后再计算收益率
+    :param n_paths: 路径数
+    :param block: 块长度，1 为逐日独立重抽样
+    :param rng: np.random.Generator
+    :return: 矩阵，形状为 (有效交易日数, 路径数)，第一行是历史第一个有效价格
+    """
+    rng = rng or np.random.default_rng()
+    close = np.asarray(close, dtype=float)
+    close = close[np.isfinite(close) & (close > 0)]
+    log_ret = np.diff(np.log(close))
+    n = len(log_ret)
+    block = max(1, block)
+    if n < block + 1:
+        raise ValueError(f"有效收益率只有 {n} 个，至少需要 {block + 1} 个（块长度 + 1）")
+
+    n_blocks = -(-n // block)
+    starts = rng.integers(0, n - block + 1, size=(n_blocks, n_paths))
+    idx = (starts[:, None, :] + np.arange(block)[None, :, None]).reshape(n_blocks * block, n_paths)[:n]
+
+    paths = np.empty((n + 1, n_paths))
+    paths[0] = close[0]
+    paths[1:] = close[0] * np.exp(np.cumsum(log_ret[idx], axis=0))
+    return paths
+
+
+def montecarlo(stock_code=STOCK_CODE,
+               stock_name=STOCK_NAME,
+               bid_price=None,
+               take_profit=TAKE_PROFIT,
+               n_paths=MONTECARLO_PATHS,
+               block=MONTECARLO_BLOCK,
+               chunk=MONTECARLO_CHUNK,
+               seed=MONTECARLO_SEED,
+               start_date=START_DATE,
+               data=None):
+    """
+    单个证券的蒙特卡洛检验
+    :param stock_code: 如 588000 或 601398
+    :param stock_name: 如 科创50 或 工商银行
+    :param bid_price: 目标买入价，为空时使用“价值区间”的最低价
+    :param take_profit: 止盈比例
+    :param n_paths: 路径数
+    :param block: 块长度
+    :param chunk: 每批生成和模拟的路径数
+    :param seed: 随机种子
+    :param start_date: 回溯开始时间
+    :param data: 日线 DataFrame 或 Dataset，为空时从缓存读取
+    :return: (每条路径的结果 DataFrame, 汇总 dict)
+    """
+    df = resolve(data, stock_code)
+    if bid_price is None:
+        bid_price = compute_distribution(df['close'])['lowest_price']
+    close = df.loc[df['date'] >= start_date, 'close'].dropna().to_numpy(dtype=float)
+
+    rng = np.random.default_rng(seed)
+    final = np.empty(n_paths)
+    max_dd = np.empty(n_paths)
+    trades = np.empty(n_paths, dtype=np.int64)
+    for lo in range(0, n_paths, chunk):
+        hi = min(lo + chunk, n_paths)
+        paths = bootstrap_paths(close, hi - lo, block, rng)
+        final[lo:hi], max_dd[lo:hi], trades[lo:hi] = simulate_batch(paths, bid_price, take_profit, batch_size=chunk)
+
+    paths_df = pd.DataFrame({"total_return": final - 1, "max_drawdown": max_dd, "trades": trades})
+
+    # 历史路径的结果在分布中的位置
+    equity, buy_idx, _ = simulate(close, bid_price, take_profit)
+    history = {
+        "total_return": float(equity[-1] - 1),
+        "max_drawdown": float(get_max_drawdown(pd.Series(equity))),
+        "trades": len(buy_idx),
+    }
+    summary = {
+        "code": stock_code,
+        "name": stock_name,
+        "bid_price": float(bid_price),
+        "take_profit": take_profit,
+        "paths": n_paths,
+        "block": block,
+        "loss_probability": float((final < 1).mean()),
+    }
+    for col in paths_df.columns:
+        summary[f"{col}_history"] = history[col]
+        summary[f"{col}_rank"] = float((paths_df[col] < history[col]).mean())
+        for q, v in zip(QUANTILES, paths_df[col].quantile(QUANTILES)):
+            summary[f"{col}_p{int(q * 100)}"] = v
+    return paths_df, summary
+
+
+def montecarlo_all(stocks, **kwargs):
+    """
+    多个证券的蒙特卡洛检验，每个证券一行汇总
+    :param stocks: [{"code": ..., "name": ...}]
+    :param kwargs: 透传给 montecarlo
+    :return: DataFrame
+    """
+    rows = []
+    for comp in stocks:
+        cs_code = comp.get('code')
+        cs_name = comp.get('name')
+        try:
+            _, summary = montecarlo(f"{cs_code}", cs_name, **kwargs)
+        except ValueError as e:
+            # 新上市等历史太短的证券跳过
+            logger.warning(f"{cs_code}_{cs_name} 跳过蒙特卡洛检验：{e}")
+            continue
+        logger.info(f"{cs_code}_{cs_name} {summary['paths']} 条路径，"
+                    f"亏损概率: {summary['loss_probability']:.2%}，"
+                    f"总收益率中位数: {summary['total_return_p50']:.2%}"
+                    f"（5%~95%: {summary['total_return_p5']:.2%} ~ {summary['total_return_p95']:.2%}），"
+                    f"最大回撤中位数: {summary['max_drawdown_p50']:.2%}，"
+                    f"历史路径的总收益率高于 {summary['total_return_rank']:.2%} 的模拟路径")
+        rows.append(summary)
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    # /home/rhino/s/a/app_YYYYMMDD.log
+    add_sink('app')
+    cs = get_stocks()
+
+    fetched = []
+    for comp, _, err in fetch_all(cs, lambda c: get_k_data(f"{c.get('code')}", c.get('name'))):
+        if err is not None:
+            logger.error(f"{comp.get('code')}_{comp.get('name')} 获取历史数据失败：{err}")
+            continue
+        fetched.append(comp)
+
+    result = montecarlo_all(fetched)
+
+    # 结果放在子目录中，不会被 clear_file 清理
+    montecarlo_dir = os.path.join(DUMP_DIR, 'montecarlo')
+    os.makedirs(montecarlo_dir, exist_ok=True)
+    result.to_csv(os.path.join(montecarlo_dir, f"montecarlo_{TODAY}.csv"), index=False)
+
+    CACHE.log_stats()
+    write_summary()
+    clear_file()
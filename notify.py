@@ -3,23 +3,27 @@
 从 hold.json 文件读取持仓证券代码
 根据 settings.py 中配置的止盈百分比，回溯每日收盘价格
 如果达到止盈位，则通过邮件和桌面文件进行提醒，希望他能看到
+持仓和自选统一转换成提醒规则（见 rules.py），合并去重后每个证券只获取一次
+python notify.py --daemon 常驻运行，交易时段内轮询实时报价
 """
-import json
+import argparse
 import os.path
+import time
+from datetime import datetime
 
-import pandas as pd
+import numpy as np
 from loguru import logger
 
-from historical_range import get_k_data
-from settings import STOCK_CODE, STOCK_NAME, DUMP_DIR, TAKE_PROFIT
-from utils import send_mail, dump_file, clear_file
-
-# /home/rhino/s/a/notify_YYYY-MM-DD_HH-mm-ss_ssssss.log
-logger.add(os.path.join(DUMP_DIR, 'notify_{time:YYYYMMDD}.log'),
-           rotation="50 MB",
-           retention="3 days",
-           compression="gz",
-           enqueue=True)
+from dataset import CACHE, resolve
+from fetcher import fetch_all
+from historical_range import get_k_data, get_spot_prices
+from logs import add_sink
+from metrics import enable, write_summary
+from providers import set_provider
+from registry import load_stocks
+from rules import build_rules, evaluate, symbols, latest_prices
+from settings import STOCK_CODE, STOCK_NAME, NOTIFY_POLL_SECONDS, TRADING_SESSIONS
+from utils import send_mail, dump_file, clear_file, AlertDispatcher
 
 
 def get_position():
@@ -27,8 +31,7 @@ def get_position():
     读取持仓文件，该文件手动维护，没有自动接口读取当前持仓
     :return:
     """
-    with open('json/position.json', encoding='utf-8') as f:
-        return json.loads(f.read())
+    return load_stocks('json/position.json')
 
 
 def get_watchlist():
@@ -36,79 +39,236 @@ def get_watchlist():
     读取自选文件，该文件手动维护
     :return:
     """
-    with open('json/watchlist.json', encoding='utf-8') as f:
-        return json.loads(f.read())
+    return load_stocks('json/watchlist.json')
+
+
+def _send(subject, content, alerts=None):
+    """
+    发出提醒，邮件和桌面文件
+    :param subject:
+    :param content:
+    :param alerts: AlertDispatcher，为空时直接发送邮件
+    :return:
+    """
+    if alerts is not None:
+        alerts.add(subject, content)
+    else:
+        send_mail(subject, content)
+    dump_file(subject, content)
+
+
+def _notify(rules, prices, alerts=None):
+    """
+    批量判断规则并发出触发的提醒
+    :param rules: build_rules 的结果
+    :param prices: dict，证券代码 -> 最新价
+    :param alerts: AlertDispatcher，为空时直接发送邮件
+    :return: 触发的规则
+    """
+    triggered = evaluate(rules, prices)
+    for subject, content in zip(triggered["subject"], triggered["content"]):
+        _send(subject, content, alerts)
+    return triggered
 
 
-def get_sell_notify(_stock_code=STOCK_CODE, _stock_name=STOCK_NAME, _hold_price=0.0):
+def get_sell_notify(_stock_code=STOCK_CODE, _stock_name=STOCK_NAME, _hold_price=0.0, data=None, alerts=None,
+                    close_price=None):
     """
     持仓卖出提醒
     :param _stock_code:
     :param _stock_name:
     :param _hold_price:
-    :return:
+    :param data: 日线 DataFrame 或 Dataset，为空时从缓存读取
+    :param alerts: AlertDispatcher，为空时直接发送邮件
+    :param close_price: 当前价格，为空时取日线最后一天的收盘价
+    :return: 是否触发提醒
     """
-    df = pd.read_csv(f"{os.path.join(DUMP_DIR, _stock_code)}_{_stock_name}.csv")
-    # 当天收盘价
-    close_price = df.iloc[-1]['close']
-    if close_price > _hold_price * TAKE_PROFIT:
-        # 邮件内容
-        subject = f"{_stock_code}_{_stock_name} 止盈提醒"
-        content = (f"{_stock_code}_{_stock_name} 已达到设定的止盈价格"
-                   f"\n持仓价格: {_hold_price}"
-                   f"\n止盈比例: {(TAKE_PROFIT - 1):.2%}"
-                   f"\n止盈价格: {_hold_price * TAKE_PROFIT}"
-                   f"\n当前价格: {close_price}")
-
-        send_mail(subject, content)
-        dump_file(subject, content)
+    if close_price is None:
+        # 当天收盘价
+        close_price = resolve(data, _stock_code).iloc[-1]['close']
+    rules = build_rules(position=[{"code": _stock_code, "name": _stock_name, "hold_price": _hold_price}])
+    return not _notify(rules, {_stock_code: close_price}, alerts).empty
 
 
-def get_bid_notify(_stock_code=STOCK_CODE, _stock_name=STOCK_NAME, _bid_price=0.0):
+def get_bid_notify(_stock_code=STOCK_CODE, _stock_name=STOCK_NAME, _bid_price=0.0, data=None, alerts=None,
+                   close_price=None):
     """
     自选买入提醒
     :param _stock_code:
     :param _stock_name:
     :param _bid_price:
+    :param data: 日线 DataFrame 或 Dataset，为空时从缓存读取
+    :param alerts: AlertDispatcher，为空时直接发送邮件
+    :param close_price: 当前价格，为空时取日线最后一天的收盘价
+    :return: 是否触发提醒
+    """
+    if close_price is None:
+        # 当天收盘价
+        close_price = resolve(data, _stock_code).iloc[-1]['close']
+    rules = build_rules(watchlist=[{"code": _stock_code, "name": _stock_name, "bid_price": _bid_price}])
+    return not _notify(rules, {_stock_code: close_price}, alerts).empty
+
+
+def _fetch(items):
+    """
+    获取日线，返回获取成功的证券代码
+    :param items: [{"code": ..., "name": ...}]
     :return:
     """
-    df = pd.read_csv(f"{os.path.join(DUMP_DIR, _stock_code)}_{_stock_name}.csv")
-    # 当天收盘价
-    close_price = df.iloc[-1]['close']
-    if close_price < _bid_price:
-        # 邮件内容
-        subject = f"{_stock_code}_{_stock_name} 买入提醒"
-        content = (f"{_stock_code}_{_stock_name} 已低于设定的买入价格"
-                   f"\n目标买入价格: {_bid_price}"
-                   f"\n当前价格: {close_price}")
+    fetched = set()
+    for item, _, err in fetch_all(items, lambda c: get_k_data(c['code'], c['name'])):
+        if err is not None:
+            logger.error(f"{item['code']}_{item['name']} 获取历史数据失败：{err}")
+            continue
+        fetched.add(item['code'])
+    return fetched
 
-        send_mail(subject, content)
-        dump_file(subject, content)
 
+class _WatchedFile:
+    """
+    只在文件修改时间变化时重新读取的 json 配置
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self._data = []
+
+    def load(self):
+        """
+        :return: (内容, 是否重新读取了)
+        """
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self._mtime:
+            return self._data, False
+        try:
+            data = load_stocks(self.path)
+        except ValueError as e:
+            # 手动编辑到一半等格式错误，沿用上次的内容，修改时间不记录，下一轮重新读取
+            logger.error(f"{self.path} 读取失败，沿用之前的 {len(self._data)} 个：{e}")
+            return self._data, False
+        self._data = data
+        self._mtime = mtime
+        return self._data, True
 
-if __name__ == '__main__':
-    # 持仓卖出
-    positions = get_position()
 
-    for hold in positions:
-        hold_code = hold.get('code')
-        hold_name = hold.get('name')
-        # hold_mkt = hold.get('market')
-        hold_price = hold.get('hold_price')
+def is_trading_time(now=None):
+    """
+    是否处于交易时段，只判断工作日和时间，不处理节假日
+    :param now: datetime，为空时取当前时间
+    :return:
+    """
+    now = now or datetime.now()
+    if now.weekday() >= 5:
+        return False
+    hm = now.strftime('%H:%M')
+    return any(start <= hm <= end for start, end in TRADING_SESSIONS)
+
+
+def _load_bars(rules, loaded):
+    """
+    获取并缓存还没有加载过的证券的日线，守护进程启动、配置变化和换日时执行
+    :param rules: build_rules 的结果
+    :param loaded: 已加载的证券代码，会被更新
+    :return:
+    """
+    todo = [item for item in symbols(rules) if item['code'] not in loaded]
+    for code in _fetch(todo):
+        CACHE.get(code)
+        loaded.add(code)
+
+
+def run_daemon(interval=NOTIFY_POLL_SECONDS):
+    """
+    常驻进程，代替定时任务每次冷启动
+    - 持仓和自选文件只在修改后重新读取，新增的证券才获取历史数据，每天只获取一次
+    - 交易时段内每 interval 秒获取一次实时报价，批量判断所有规则
+    - 同一证券的同一种规则每天只提醒一次
+    :param interval: 轮询间隔秒数
+    :return:
+    """
+    position_file = _WatchedFile('json/position.json')
+    watchlist_file = _WatchedFile('json/watchlist.json')
+    alerts = AlertDispatcher(digest=False)
+    notified = set()
+    loaded = set()
+    rules = build_rules()
+    day = None
+
+    try:
+        while True:
+            # 换日后提醒重新计数，日线重新获取
+            now = datetime.now()
+            if day != now.date():
+                day = now.date()
+                notified.clear()
+                loaded.clear()
+
+            start = time.perf_counter()
+            try:
+                positions, position_changed = position_file.load()
+                watchlist, watchlist_changed = watchlist_file.load()
+                if position_changed or watchlist_changed:
+                    rules = build_rules(positions, watchlist)
+                    logger.info(f"读取持仓 {len(positions)} 个，自选 {len(watchlist)} 个，规则 {len(rules)} 条")
+                _load_bars(rules, loaded)
 
-        get_k_data(f"{hold_code}", hold_name)
-        get_sell_notify(f"{hold_code}", hold_name, hold_price)
+                if is_trading_time(now) and not rules.empty:
+                    prices = get_spot_prices(rules["code"].unique())
 
-    # 自选买入
-    watchlist = get_watchlist()
+                    # 已经提醒过的规则今天不再判断
+                    mask = np.fromiter(((c, k) not in notified for c, k in zip(rules["code"], rules["kind"])),
+                                       bool, len(rules))
+                    triggered = _notify(rules.loc[mask], prices, alerts)
+                    notified.update(zip(triggered["code"], triggered["kind"]))
+                    logger.debug(f"报价 {len(prices)} 个，耗时 {time.perf_counter() - start:.3f} 秒")
+            except Exception as e:
+                # 配置文件读取、东财断连等错误只跳过本轮，下一轮继续
+                logger.error(f"本轮更新失败，{interval} 秒后重试：{e}")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        logger.info("守护进程退出")
+    finally:
+        alerts.close()
+        write_summary()
 
-    for watch in watchlist:
-        watch_code = watch.get('code')
-        watch_name = watch.get('name')
-        # watch_mkt = watch.get('market')
-        watch_price = watch.get('bid_price')
 
-        get_k_data(f"{watch_code}", watch_name)
-        get_bid_notify(f"{watch_code}", watch_name, watch_price)
+def run_once():
+    """
+    单次运行，持仓和自选合并去重后获取一次日线，按最后一天收盘价批量判断所有规则
+    :return:
+    """
+    rules = build_rules(get_position(), get_watchlist())
+    fetched = _fetch(symbols(rules))
+
+    # 所有提醒在后台统一发送
+    alerts = AlertDispatcher()
+    triggered = _notify(rules, latest_prices(fetched), alerts)
+    logger.info(f"规则 {len(rules)} 条，证券 {rules['code'].nunique()} 个，触发 {len(triggered)} 条")
 
+    alerts.close()
+    CACHE.log_stats()
+    write_summary()
     clear_file()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="持仓止盈和自选买入提醒")
+    parser.add_argument('--daemon', action='store_true', help="常驻运行，交易时段内轮询实时报价")
+    parser.add_argument('--interval', type=float, default=NOTIFY_POLL_SECONDS, help="轮询间隔秒数")
+    parser.add_argument('--metrics', action='store_true', help="统计各环节耗时，退出时写出汇总")
+    parser.add_argument('--provider', choices=["akshare", "baostock", "replay"],
+                        help="只使用指定的数据源，replay 读取录制的本地文件，不需要网络")
+    args = parser.parse_args()
+
+    # /home/rhino/s/a/notify_YYYYMMDD.log
+    add_sink('notify')
+    if args.metrics:
+        enable()
+    if args.provider:
+        set_provider(args.provider)
+
+    if args.daemon:
+        run_daemon(args.interval)
+    else:
+        run_once()
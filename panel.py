@@ -0,0 +1,263 @@
+# -*- coding:utf-8 -*-
+"""
+多证券行情面板
+全市场分析时逐个读取几千个证券的文件，打开文件的开销远大于计算本身
+面板把所有证券放进同一个日期轴上的矩阵，以内存映射方式打开，任意切片都不需要复制
+- meta.json       证券代码列表、有效行数、当前的数据目录
+- {数据目录}/dates.npy    交易日，datetime64[D]
+- {数据目录}/{field}.npy  矩阵，形状为 (交易日数, 证券数)，停牌或未上市为 NaN，价格为 float32，成交量和成交额为 float64
+每次更新写出新的数据目录，最后替换 meta.json 切换过去，更新中断时旧面板不受影响
+正在读取旧面板的进程继续使用旧文件，之后打开的进程读到新面板
+"""
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from numpy.lib.format import open_memmap
+
+from settings import PANEL_DIR
+from store import load_bars
+
+# 面板中的字段及类型，成交量和成交额超过 float32 的 7 位有效数字
+FIELDS = {
+    "open": np.float32,
+    "high": np.float32,
+    "low": np.float32,
+    "close": np.float32,
+    "volume": np.float64,
+    "amount": np.float64,
+}
+# 面板格式版本，变化后需要重新 build_panel
+PANEL_VERSION = 2
+
+
+def _read_meta(panel_dir):
+    with open(os.path.join(panel_dir, 'meta.json'), encoding='utf-8') as f:
+        return json.loads(f.read())
+
+
+class Panel:
+    """
+    以内存映射方式打开的面板，只读
+    """
+
+    def __init__(self, panel_dir=PANEL_DIR, mode='r'):
+        meta = _read_meta(panel_dir)
+        if meta.get("version") != PANEL_VERSION:
+            raise ValueError(f"面板 {panel_dir} 为旧版格式，请重新 build_panel")
+        self.symbols = meta["symbols"]
+        self.rows = meta["rows"]
+        self._index = {code: i for i, code in enumerate(self.symbols)}
+        data_dir = os.path.join(panel_dir, meta["data"])
+        self.dates = np.load(os.path.join(data_dir, 'dates.npy'), mmap_mode=mode)
+        self._fields = {field: np.load(os.path.join(data_dir, f'{field}.npy'), mmap_mode=mode) for field in FIELDS}
+
+    def __getitem__(self, field):
+        """
+        整个字段矩阵，形状为 (交易日数, 证券数)
+        :param field: FIELDS 中的一个
+        :return: 内存映射的 ndarray 视图
+        """
+        return self._fields[field]
+
+    def column(self, stock_code, field="close"):
+        """
+        单个证券的一列，内存映射的视图
+        :param stock_code: 如 588000 或 601398
+        :param field:
+        :return:
+        """
+        return self._fields[field][:, self._index[stock_code]]
+
+    def slice(self, field="close", stock_codes=None, start_date=None, end_date=None):
+        """
+        按证券和日期范围切片，日期范围内不复制，指定证券时按列取出
+        :param field:
+        :param stock_codes: 证券代码列表，为空时取全部
+        :param start_date: 起始日期（含）
+        :param end_date: 结束日期（含）
+        :return: (日期, 矩阵)
+        """
+        lo = 0 if start_date is None else np.searchsorted(self.dates, np.datetime64(start_date, 'D'), side='left')
+        hi = self.rows if end_date is None else np.searchsorted(self.dates, np.datetime64(end_date, 'D'), side='right')
+        values = self._fields[field][lo:hi]
+        if stock_codes is not None:
+            values = values[:, [self._index[code] for code in stock_codes]]
+        return self.dates[lo:hi], values
+
+    def frame(self, field="close"):
+        """
+        转成 DataFrame，会复制数据，只在需要 pandas 时使用
+        :param field:
+        :return:
+        """
+        return pd.DataFrame(np.asarray(self._fields[field]), index=pd.DatetimeIndex(np.asarray(self.dates)),
+                            columns=self.symbols)
+
+
+def _write(panel_dir, symbols, dates, fill):
+    """
+    写出新的数据目录，替换 meta.json 切换过去，再删除不再使用的数据目录
+    :param panel_dir:
+    :param symbols: 证券代码列表
+    :param dates: 日期轴
+    :param fill: fill(field, values)，在全部为 NaN 的新矩阵中写入数据
+    :return: Panel
+    """
+    name = f"data-{time.time_ns()}-{os.getpid()}"
+    data_dir = os.path.join(panel_dir, name)
+    os.makedirs(data_dir)
+    np.save(os.path.join(data_dir, 'dates.npy'), np.asarray(dates, dtype='datetime64[D]'))
+    for field, dtype in FIELDS.items():
+        values = open_memmap(os.path.join(data_dir, f'{field}.npy'), mode='w+', dtype=dtype,
+                             shape=(len(dates), len(symbols)))
+        values[:] = np.nan
+        fill(field, values)
+        values.flush()
+        del values
+
+    tmp = os.path.join(panel_dir, f'meta.json.{os.getpid()}.tmp')
+    with open(tmp, encoding='utf-8', mode='w') as f:
+        f.write(json.dumps({"symbols": symbols, "rows": len(dates), "version": PANEL_VERSION, "data": name},
+                           ensure_ascii=False))
+    os.replace(tmp, os.path.join(panel_dir, 'meta.json'))
+
+    # 旧版面板的文件和之前的数据目录，仍被其他进程映射时删除失败，下次更新时再删除
+    for entry in os.scandir(panel_dir):
+        if entry.name in ('meta.json', name) or entry.name.endswith('.tmp'):
+            continue
+        if entry.is_dir():
+            shutil.rmtree(entry.path, ignore_errors=True)
+        elif entry.name.endswith('.npy'):
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+    return Panel(panel_dir)
+
+
+def _fill_bars(values, field, axis, bars, columns):
+    """
+    日线按日期写入矩阵的对应列
+    :param bars: dict，证券代码 -> 日线
+    :param columns: dict，证券代码 -> 列号
+    """
+    for code, df in bars.items():
+        pos = np.searchsorted(axis, df["date"].to_numpy().astype('datetime64[D]'))
+        values[pos, columns[code]] = df[field].to_numpy(dtype=values.dtype)
+
+
+def _read_bars(stock_codes):
+    bars = {}
+    for code in stock_codes:
+        df = load_bars(code)
+        if df is not None and not df.empty:
+            bars[code] = df
+    return bars
+
+
+def _union_dates(frames, *dates):
+    return np.unique(np.concatenate([df["date"].to_numpy().astype('datetime64[D]') for df in frames]
+                                    + [np.asarray(d, dtype='datetime64[D]') for d in dates]
+                                    + [np.array([], dtype='datetime64[D]')]))
+
+
+def build_panel(stock_codes, panel_dir=PANEL_DIR):
+    """
+    从本地存储构建面板，日期轴为所有证券交易日的并集
+    :param stock_codes: 证券代码列表，没有本地行情的会被跳过
+    :param panel_dir:
+    :return: Panel
+    """
+    bars = _read_bars(stock_codes)
+    if not bars:
+        raise ValueError("没有本地行情，请先执行 get_k_data")
+    symbols = list(bars)
+    axis = _union_dates(bars.values())
+    columns = {code: j for j, code in enumerate(symbols)}
+
+    os.makedirs(panel_dir, exist_ok=True)
+    return _write(panel_dir, symbols, axis, lambda field, values: _fill_bars(values, field, axis, bars, columns))
+
+
+def update_panel(stock_codes=None, panel_dir=PANEL_DIR):
+    """
+    把本地存储中面板最后一个交易日之后的数据追加到面板
+    - 面板最后一个交易日也会重写，盘中写入的数据会被收盘后的数据覆盖
+    - 每个证券按它在面板中最后一个有数据的交易日（不含面板最后一天）判断本地存储是否重写了历史
+      （除权除息后前复权价格整体变化，或重新下载了全部历史），停牌的证券也会检查；
+      重写了历史、或本地存储有面板中缺少的交易日时，该证券的整列从本地存储重建
+    - stock_codes 中不在面板里的证券读取全部历史，加到最后几列
+    :param stock_codes: 面板应包含的证券代码，为空时只更新面板中已有的证券
+    :param panel_dir:
+    :return: Panel
+    """
+    meta = _read_meta(panel_dir)
+    if meta.get("version") != PANEL_VERSION:
+        logger.info(f"面板 {panel_dir} 为旧版格式，重新构建")
+        return build_panel(list(dict.fromkeys(meta["symbols"] + list(stock_codes or []))), panel_dir)
+
+    panel = Panel(panel_dir)
+    symbols, rows = panel.symbols, panel.rows
+    old_dates = np.array(panel.dates)
+    last = old_dates[-1] if rows else None
+    # 最后一个交易日可能是盘中数据，不参与判断；每列最后一个有数据的交易日及收盘价
+    close = np.asarray(panel["close"][:max(rows - 1, 0)])
+    valid = ~np.isnan(close)
+    ref_row = np.full(len(symbols), -1)
+    if len(close):
+        ref_row = np.where(valid.any(axis=0), len(close) - 1 - np.argmax(valid[::-1], axis=0), -1)
+    ref_close = close[ref_row, np.arange(len(symbols))] if len(close) else np.full(len(symbols), np.nan)
+    del panel, close, valid
+
+    new, stale = {}, []
+    for j, code in enumerate(symbols):
+        ref = old_dates[ref_row[j]] if ref_row[j] >= 0 else None
+        df = load_bars(code, start_date=None if ref is None else str(ref))
+        if df is None or df.empty:
+            continue
+        dates = df["date"].to_numpy().astype('datetime64[D]')
+        if last is not None:
+            before = dates[dates < last]
+            if ref is None:
+                rewritten = len(before) > 0
+            else:
+                rewritten = (dates[0] != ref
+                             or not np.isclose(np.float32(df["close"].to_numpy()[0]), ref_close[j], rtol=1e-6)
+                             or len(before) > 1)
+            if rewritten:
+                stale.append(code)
+                continue
+            df = df[dates >= last]
+        if not df.empty:
+            new[code] = df
+
+    added = [code for code in dict.fromkeys(stock_codes or []) if code not in set(symbols)]
+    history = _read_bars(stale + added)
+    added = [code for code in added if code in history]
+    if not new and not history:
+        return Panel(panel_dir)
+    if stale:
+        logger.info(f"本地存储重写了 {len(stale)} 个证券的历史，重建面板中的整列：{', '.join(stale[:10])}")
+    if added:
+        logger.info(f"面板新增 {len(added)} 个证券：{', '.join(added[:10])}")
+
+    symbols = symbols + added
+    columns = {code: j for j, code in enumerate(symbols)}
+    axis = _union_dates(list(new.values()) + list(history.values()), old_dates)
+    old_pos = np.searchsorted(axis, old_dates)
+    n_old = len(columns) - len(added)
+    data_dir = os.path.join(panel_dir, meta["data"])
+
+    def fill(field, values):
+        values[old_pos, :n_old] = np.load(os.path.join(data_dir, f'{field}.npy'), mmap_mode='r')
+        for code in history:
+            values[:, columns[code]] = np.nan
+        _fill_bars(values, field, axis, {**new, **history}, columns)
+
+    return _write(panel_dir, symbols, axis, fill)
+
@@ -0,0 +1,50 @@
+# -*- coding:utf-8 -*-
+"""
+图表
+matplotlib 和 pyplot 导入耗时较长，PLOT = False 时完全用不到，只在第一次画图时导入并设置字体
+- pyplot()  交互式画图，plt.show() 会阻塞
+- figure()  不经过 pyplot 直接创建 Figure，由 Agg 渲染成文件，不需要图形界面，可以在子进程中并发使用
+"""
+_plt = None
+_configured = False
+
+
+def configure():
+    """
+    导入 matplotlib 并设置中文字体，只设置一次
+    :return: matplotlib
+    """
+    global _configured
+    import matplotlib
+    if not _configured:
+        matplotlib.rcParams['font.sans-serif'] = ['SimHei']  # 设置中文字体
+        matplotlib.rcParams['axes.unicode_minus'] = False  # 正常显示负号
+        _configured = True
+    return matplotlib
+
+
+def pyplot():
+    """
+    第一次调用时导入 pyplot 并设置中文字体
+    :return: matplotlib.pyplot
+    """
+    global _plt
+    if _plt is None:
+        configure()
+        import matplotlib.pyplot as plt
+        _plt = plt
+    return _plt
+
+
+def figure(figsize=(12, 6)):
+    """
+    创建不依赖图形界面的 Figure，savefig 时按文件后缀用 Agg 或 SVG 渲染
+    :param figsize: 图表尺寸（英寸）
+    :return: matplotlib.figure.Figure
+    """
+    configure()
+    from matplotlib.figure import Figure
+    # 固定边距，不用 tight_layout，省去一次额外的绘制
+    fig = Figure(figsize=figsize)
+    fig.subplots_adjust(left=0.06, right=0.98, bottom=0.1, top=0.92)
+    return fig
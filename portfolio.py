@@ -0,0 +1,209 @@
+# -*- coding:utf-8 -*-
+"""
+组合回溯
+get_return 每个证券单独用 1.0 的资金回溯，看不到合起来的仓位、现金占用和组合回撤
+- 所有证券对齐到同一个交易日轴上（各证券交易日的并集），停牌或未上市的交易日不交易，按最后价格估值
+- 共用一份资金，每次买入不超过当时组合净值的 PORTFOLIO_MAX_WEIGHT，现金不够时按折价从大到小依次分配
+- 每个证券的买卖规则与 get_return 相同：低于目标买入价买入，达到止盈比例卖出
+逐日推进，每一步对所有证券做向量运算，证券数增加到几百个耗时也基本不变
+持仓股数按日记录成矩阵，组合净值、仓位、回撤都在矩阵上计算
+python portfolio.py              回溯 backtrader.json 中的证券
+python portfolio.py --position   回溯 position.json 中的证券
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from backtrader import get_max_drawdown
+from dataset import CACHE, resolve
+from fetcher import fetch_all
+from historical_range import compute_distribution, get_k_data, get_stocks
+from logs import add_sink
+from metrics import write_summary
+from registry import load_stocks
+from settings import START_DATE, TAKE_PROFIT, PORTFOLIO_MAX_WEIGHT
+from utils import clear_file
+
+
+def align(frames, start_date=START_DATE):
+    """
+    多个证券的收盘价对齐到交易日的并集
+    :param frames: dict，证券代码 -> 日线 DataFrame
+    :param start_date: 起始日期（含）
+    :return: (交易日数组, 收盘价矩阵)，矩阵形状为 (交易日数, 证券数)，没有交易的为 NaN
+    """
+    cols = {}
+    for code, df in frames.items():
+        df = df[df["date"] >= start_date]
+        cols[code] = (df["date"].to_numpy().astype('datetime64[D]'), df["close"].to_numpy(dtype=float))
+
+    dates = np.unique(np.concatenate([d for d, _ in cols.values()]))
+    close = np.full((len(dates), len(cols)), np.nan)
+    for j, (d, c) in enumerate(cols.values()):
+        close[np.searchsorted(dates, d), j] = c
+    return dates, close
+
+
+def simulate_portfolio(close, bid_prices, take_profit=TAKE_PROFIT, max_weight=PORTFOLIO_MAX_WEIGHT):
+    """
+    共用资金的组合模拟
+    :param close: 收盘价矩阵，形状为 (交易日数, 证券数)，NaN 表示当天没有交易
+    :param bid_prices: 每个证券的目标买入价
+    :param take_profit: 止盈比例
+    :param max_weight: 单个证券买入时最多占组合净值的比例
+    :return: (现金数组, 持仓股数矩阵, 交易列表)，交易为 (证券下标, 买入下标, 卖出下标, 买入金额)，未卖出的卖出下标为 -1
+    """
+    close = np.asarray(close, dtype=float)
+    bid = np.asarray(bid_prices, dtype=float)
+    n_days, n = close.shape
+
+    # 停牌按最后价格估值
+    mark = pd.DataFrame(close).ffill().to_numpy()
+
+    cash = 1.0
+    shares = np.zeros(n)
+    buy_price = np.zeros(n)
+    buy_day = np.full(n, -1, dtype=np.int64)
+    buy_amount = np.zeros(n)
+    cash_hist = np.empty(n_days)
+    shares_hist = np.empty((n_days, n))
+    trades = []
+
+    for t in range(n_days):
+        price = close[t]
+        traded = ~np.isnan(price)
+        holding = shares > 0
+
+        # 1. 持仓的先判断止盈，当天买入的不判断
+        sell = holding & traded & (price >= buy_price * take_profit)
+        if sell.any():
+            cash += float((shares[sell] * price[sell]).sum())
+            for j in np.flatnonzero(sell):
+                trades.append((j, buy_day[j], t, buy_amount[j]))
+            shares[sell] = 0
+
+        # 2. 买入，每个证券最多占当前净值的 max_weight，现金按折价从大到小分配
+        buy = ~holding & ~sell & traded & (price < bid)
+        if buy.any() and cash > 0:
+            equity = cash + float(np.nansum(shares * mark[t]))
+            idx = np.flatnonzero(buy)
+            idx = idx[np.argsort(price[idx] / bid[idx], kind='stable')]
+            target = max_weight * equity
+            before = np.concatenate([[0.0], np.cumsum(np.full(len(idx), target))[:-1]])
+            amount = np.clip(cash - before, 0, target)
+            idx, amount = idx[amount > 0], amount[amount > 0]
+
+            shares[idx] = amount / price[idx]
+            buy_price[idx] = price[idx]
+            buy_day[idx] = t
+            buy_amount[idx] = amount
+            cash -= float(amount.sum())
+
+        cash_hist[t] = cash
+        shares_hist[t] = shares
+
+    for j in np.flatnonzero(shares > 0):
+        trades.append((j, buy_day[j], -1, buy_amount[j]))
+    return cash_hist, shares_hist, trades
+
+
+def backtest_portfolio(stocks, bids=None, take_profit=TAKE_PROFIT, max_weight=PORTFOLIO_MAX_WEIGHT,
+                       start_date=START_DATE, data=None):
+    """
+    组合回溯
+    :param stocks: [{"code": ..., "name": ...}]，带 bid_price 的直接作为目标买入价
+    :param bids: dict，证券代码 -> 目标买入价，为空时使用“价值区间”的最低价
+    :param take_profit: 止盈比例
+    :param max_weight: 单个证券买入时最多占组合净值的比例
+    :param start_date: 回溯开始时间
+    :param data: dict，证券代码 -> 日线 DataFrame 或 Dataset，为空时从缓存读取
+    :return: (每日净值 DataFrame, 交易 DataFrame, 指标 dict)
+    """
+    codes = [f"{s.get('code')}" for s in stocks]
+    names = {f"{s.get('code')}": s.get('name') for s in stocks}
+    frames = {code: resolve((data or {}).get(code), code) for code in codes}
+
+    # 1. 目标买入价，与单个证券回溯一致，用整段历史的“价值区间”最低价
+    bids = dict(bids or {})
+    for s in stocks:
+        code = f"{s.get('code')}"
+        if code not in bids:
+            bids[code] = s.get('bid_price') or compute_distribution(frames[code]['close'])['lowest_price']
+
+    # 2. 对齐后一次模拟
+    dates, close = align(frames, start_date)
+    cash, shares, trades = simulate_portfolio(close, [bids[c] for c in codes], take_profit, max_weight)
+
+    # 3. 组合净值、仓位在矩阵上计算
+    mark = pd.DataFrame(close).ffill().to_numpy()
+    value = np.nan_to_num(shares * mark)
+    invested = value.sum(axis=1)
+    equity = cash + invested
+    daily = pd.DataFrame({
+        "cash": cash,
+        "invested": invested,
+        "equity": equity,
+        "exposure": invested / equity,
+        "positions": (shares > 0).sum(axis=1),
+    }, index=pd.DatetimeIndex(dates.astype('datetime64[ns]'), name="date"))
+
+    index = pd.DatetimeIndex(dates.astype('datetime64[ns]'))
+    trades_df = pd.DataFrame([{
+        "code": codes[j],
+        "name": names[codes[j]],
+        "buy_date": index[b],
+        "sell_date": index[s] if s >= 0 else pd.NaT,
+        "buy_price": close[b, j],
+        "sell_price": close[s, j] if s >= 0 else np.nan,
+        "amount": amount,
+        "pnl": amount * (close[s, j] / close[b, j] - 1) if s >= 0 else np.nan,
+    } for j, b, s, amount in trades], columns=["code", "name", "buy_date", "sell_date", "buy_price", "sell_price",
+                                               "amount", "pnl"])
+
+    trading_days = len(daily)
+    metrics = {
+        "total_return": float(equity[-1] - 1),
+        "annual_return": float(equity[-1] ** (252 / trading_days) - 1),
+        "max_drawdown": float(get_max_drawdown(daily["equity"])),
+        "avg_exposure": float(daily["exposure"].mean()),
+        "max_positions": int(daily["positions"].max()),
+        "trades": int(trades_df["sell_date"].notna().sum()),
+    }
+    return daily, trades_df, metrics
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="共用资金的组合回溯")
+    parser.add_argument('--position', action='store_true', help="回溯 position.json 中的证券，默认 backtrader.json")
+    parser.add_argument('--max-weight', type=float, default=PORTFOLIO_MAX_WEIGHT, help="单个证券最多占组合净值的比例")
+    args = parser.parse_args()
+
+    # /home/rhino/s/a/app_YYYYMMDD.log
+    add_sink('app')
+    if args.position:
+        cs = load_stocks('json/position.json')
+    else:
+        cs = get_stocks()
+
+    fetched = []
+    for comp, _, err in fetch_all(cs, lambda c: get_k_data(f"{c.get('code')}", c.get('name'))):
+        if err is not None:
+            logger.error(f"{comp.get('code')}_{comp.get('name')} 获取历史数据失败：{err}")
+            continue
+        fetched.append(comp)
+
+    daily, trades_df, result = backtest_portfolio(fetched, max_weight=args.max_weight)
+    logger.info(f"组合 {len(fetched)} 个证券，"
+                f"总收益率: {result['total_return']:.2%}，"
+                f"年化收益率: {result['annual_return']:.2%}，"
+                f"最大回撤: {result['max_drawdown']:.2%}，"
+                f"平均仓位: {result['avg_exposure']:.2%}，"
+                f"最多同时持有 {result['max_positions']} 个，"
+                f"完成交易 {result['trades']} 笔")
+    print(trades_df)
+
+    CACHE.log_stats()
+    write_summary()
+    clear_file()
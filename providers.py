@@ -0,0 +1,390 @@
+# -*- coding:utf-8 -*-
+"""
+行情数据源
+数据源已经换过一次（baostock -> akshare 东财），获取和列名转换不再写死在 get_k_data 中
+- AkshareProvider   东财，vpn 下会断连
+- BaostockProvider  不支持 ETF
+- ReplayProvider    从本地文件读取录制的日线，不需要网络，用于离线回溯和基准测试
+- RecordProvider    包装另一个数据源，获取到的日线同时录制到本地文件
+- FallbackProvider  依次尝试多个数据源，前一个失败时自动切换到下一个
+- FakeProvider      本地生成的模拟日线，可以注入延迟和失败，用于验证并发获取的重试、限速和部分失败
+所有数据源返回相同的列：date（datetime64）、open、high、low、close、volume（手）、amount（元）
+分钟线的列相同，date 精确到分钟，目前只有 akshare 支持
+"""
+import os
+import random
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from fetcher import throttle
+from registry import infer_market, is_fund, split_code
+from settings import PROVIDER, FALLBACK_PROVIDERS, REPLAY_DIR, RECORD_PROVIDER
+
+# 统一的列
+SCHEMA = ["date", "open", "high", "low", "close", "volume", "amount"]
+# 复权方式
+ADJUSTS = ("qfq", "hfq", "raw")
+
+
+class ProviderError(Exception):
+    """
+    数据源不支持该证券或该请求
+    """
+
+
+def _normalize(df):
+    """
+    统一列名顺序和类型，按日期升序
+    :param df: 已改成英文列名的 DataFrame
+    :return:
+    """
+    df = df.reindex(columns=SCHEMA)
+    df["date"] = pd.to_datetime(df["date"])
+    for col in SCHEMA[1:]:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df.sort_values("date", ignore_index=True)
+
+
+class Provider:
+    """
+    数据源接口
+    """
+    name = ""
+
+    def get_bars(self, stock_code, start_date, end_date, adjust="qfq"):
+        """
+        日线
+        :param stock_code: 如 588000 或 601398
+        :param start_date: 起始日期（含），如 2018-01-01
+        :param end_date: 结束日期（含）
+        :param adjust: qfq、hfq 或 raw
+        :return: DataFrame，列为 SCHEMA
+        """
+        raise NotImplementedError
+
+    def get_factor_bars(self, stock_code, start_date, end_date, qfq=False):
+        """
+        不复权日线和逐日的后复权收盘价，几次获取都来自同一个数据源
+        :param stock_code: 如 588000 或 601398
+        :param start_date: 起始日期（含），如 2018-01-01
+        :param end_date: 结束日期（含）
+        :param qfq: 是否同时获取前复权收盘价，用于校验由复权因子推算的前复权价
+        :return: DataFrame，列为 SCHEMA、hfq，qfq = True 时还有 qfq
+        """
+        df = self.get_bars(stock_code, start_date, end_date, adjust="raw")
+        adjusts = ["hfq", "qfq"] if qfq else ["hfq"]
+        for adjust in adjusts:
+            close = self.get_bars(stock_code, start_date, end_date, adjust=adjust).set_index('date')['close']
+            df[adjust] = close.reindex(df['date']).to_numpy()
+        return df
+
+    def get_minute_bars(self, stock_code, start_date, end_date, period="1"):
+        """
+        不复权分钟线
+        :param stock_code: 如 588000 或 601398
+        :param start_date: 起始时间（含），如 2025-07-17 09:30:00
+        :param end_date: 结束时间（含）
+        :param period: 1、5、15、30 或 60 分钟
+        :return: DataFrame，列为 SCHEMA
+        """
+        raise ProviderError(f"{self.name} 不支持分钟线")
+
+    def get_spot(self, stock_codes):
+        """
+        最新价
+        :param stock_codes: 证券代码列表
+        :return: dict，证券代码 -> 最新价，停牌或没有报价的不在其中
+        """
+        raise ProviderError(f"{self.name} 不支持实时报价")
+
+
+class AkshareProvider(Provider):
+    """
+    akshare 的东财接口
+    """
+    name = "akshare"
+
+    def get_bars(self, stock_code, start_date, end_date, adjust="qfq"):
+        throttle()
+        # akshare 导入需要数秒，只在真正获取时导入
+        import akshare as ak
+
+        df = ak.fund_etf_hist_em(symbol=stock_code,
+                                 start_date=start_date.replace('-', ''),
+                                 end_date=end_date.replace('-', ''),
+                                 period="daily",
+                                 adjust="" if adjust == "raw" else adjust)
+        return _normalize(df.rename(columns={"日期": "date", "开盘": "open", "收盘": "close", "最高": "high",
+                                             "最低": "low", "成交量": "volume", "成交额": "amount"}))
+
+    def get_minute_bars(self, stock_code, start_date, end_date, period="1"):
+        throttle()
+        import akshare as ak
+
+        # 东财只保留最近几个交易日的 1 分钟线，需要每天获取并保存
+        fetch = ak.fund_etf_hist_min_em if is_fund(stock_code) else ak.stock_zh_a_hist_min_em
+        df = fetch(symbol=stock_code, start_date=start_date, end_date=end_date, period=period, adjust="")
+        return _normalize(df.rename(columns={"时间": "date", "开盘": "open", "收盘": "close", "最高": "high",
+                                             "最低": "low", "成交量": "volume", "成交额": "amount"}))
+
+    def get_spot(self, stock_codes):
+        import akshare as ak
+
+        codes = set(stock_codes)
+        # 场内基金用基金接口，其余按个股获取
+        etf = {c for c in codes if is_fund(c)}
+
+        frames = []
+        if etf:
+            throttle()
+            frames.append(ak.fund_etf_spot_em())
+        if codes - etf:
+            throttle()
+            frames.append(ak.stock_zh_a_spot_em())
+
+        prices = {}
+        for df in frames:
+            df = df[df["代码"].isin(codes)]
+            prices.update({code: float(price) for code, price in zip(df["代码"], df["最新价"]) if pd.notna(price)})
+        return prices
+
+
+class BaostockProvider(Provider):
+    """
+    baostock，不支持 ETF，需要带市场前缀，同一时间只能有一个请求
+    """
+    name = "baostock"
+    _adjust_flags = {"hfq": "1", "qfq": "2", "raw": "3"}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._logged_in = False
+
+    def get_bars(self, stock_code, start_date, end_date, adjust="qfq"):
+        if is_fund(stock_code):
+            raise ProviderError(f"baostock 不支持 ETF：{stock_code}")
+        import baostock as bs
+
+        market = infer_market(stock_code)
+        if market not in ("sh", "sz"):
+            raise ProviderError(f"baostock 不支持该市场：{stock_code}")
+        stock_code = split_code(stock_code)[1]
+        throttle()
+        with self._lock:
+            if not self._logged_in:
+                bs.login()
+                self._logged_in = True
+            rs = bs.query_history_k_data_plus(f"{market}.{stock_code}",
+                                              "date,open,high,low,close,volume,amount",
+                                              start_date=start_date, end_date=end_date,
+                                              frequency="d", adjustflag=self._adjust_flags[adjust])
+            if rs.error_code != '0':
+                # 连接断开后重新登录
+                self._logged_in = False
+                raise ConnectionError(f"baostock 获取 {stock_code} 失败：{rs.error_msg}")
+            rows = []
+            while rs.next():
+                rows.append(rs.get_row_data())
+
+        df = _normalize(pd.DataFrame(rows, columns=rs.fields))
+        # baostock 的成交量单位是股，统一成手
+        df["volume"] = df["volume"] / 100
+        return df
+
+
+class ReplayProvider(Provider):
+    """
+    从 {root}/{adjust}/{证券代码}.csv 读取录制的日线
+    """
+    name = "replay"
+
+    def __init__(self, root=REPLAY_DIR):
+        self.root = root
+
+    def path(self, stock_code, adjust="qfq"):
+        return os.path.join(self.root, adjust, f"{stock_code}.csv")
+
+    def read(self, stock_code, adjust="qfq"):
+        path = self.path(stock_code, adjust)
+        if not os.path.exists(path):
+            raise ProviderError(f"没有录制 {stock_code} 的日线：{path}")
+        return _normalize(pd.read_csv(path, float_precision='round_trip'))
+
+    def get_bars(self, stock_code, start_date, end_date, adjust="qfq"):
+        df = self.read(stock_code, adjust)
+        mask = (df["date"] >= start_date) & (df["date"] <= end_date)
+        return df[mask].reset_index(drop=True)
+
+    def get_spot(self, stock_codes):
+        # 录制的最后一天收盘价作为最新价，实时报价不复权，没有录制不复权日线时用前复权的
+        prices = {}
+        for code in stock_codes:
+            adjust = "raw" if os.path.exists(self.path(code, "raw")) else "qfq"
+            try:
+                prices[code] = float(self.read(code, adjust)["close"].iloc[-1])
+            except (ProviderError, IndexError):
+                continue
+        return prices
+
+
+class RecordProvider(Provider):
+    """
+    包装另一个数据源，获取到的日线与已录制的合并后写入 ReplayProvider 的目录
+    """
+
+    def __init__(self, inner, root=REPLAY_DIR):
+        self.inner = inner
+        self.replay = ReplayProvider(root)
+        self.name = f"record({inner.name})"
+        self._lock = threading.Lock()
+
+    def get_bars(self, stock_code, start_date, end_date, adjust="qfq"):
+        df = self.inner.get_bars(stock_code, start_date, end_date, adjust)
+        path = self.replay.path(stock_code, adjust)
+        with self._lock:
+            try:
+                old = self.replay.read(stock_code, adjust)
+                merged = pd.concat([old[~old["date"].isin(df["date"])], df]).sort_values("date", ignore_index=True)
+            except ProviderError:
+                merged = df
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            merged.to_csv(path, index=False, date_format='%Y-%m-%d')
+        return df
+
+    def get_minute_bars(self, stock_code, start_date, end_date, period="1"):
+        # 分钟线由 minute.py 按月分区保存，不再录制
+        return self.inner.get_minute_bars(stock_code, start_date, end_date, period)
+
+    def get_spot(self, stock_codes):
+        return self.inner.get_spot(stock_codes)
+
+
+class FakeProvider(Provider):
+    """
+    不需要网络的模拟数据源，同一证券每次返回相同的随机游走日线，后复权价为不复权价的 2 倍
+    每次请求先调用 throttle 再等待 delay 秒，之后按 failure_rate 的概率失败，broken 中的证券每次都失败
+    calls 记录每次请求的 (证券代码, 复权方式, time.monotonic())
+    """
+    name = "fake"
+    first_date = "2015-01-01"
+
+    def __init__(self, delay=0.0, failure_rate=0.0, broken=(), seed=0):
+        """
+        :param delay: 每次请求的耗时秒数
+        :param failure_rate: 每次请求失败的概率
+        :param broken: 总是失败的证券代码
+        :param seed: 失败的随机种子
+        """
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.broken = set(broken)
+        self.calls = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def get_bars(self, stock_code, start_date, end_date, adjust="qfq"):
+        throttle()
+        with self._lock:
+            self.calls.append((stock_code, adjust, time.monotonic()))
+            fail = self._random.random() < self.failure_rate
+        if self.delay:
+            time.sleep(self.delay)
+        if stock_code in self.broken:
+            raise ProviderError(f"fake 不提供 {stock_code}")
+        if fail:
+            raise ConnectionError(f"fake 获取 {stock_code} 失败")
+
+        # 随机游走从固定的第一天开始，不同的日期范围取到的同一天价格相同
+        dates = pd.bdate_range(self.first_date, end_date)
+        rng = np.random.default_rng(zlib.crc32(stock_code.encode()))
+        close = np.round(10 * np.exp(np.cumsum(rng.normal(0, 0.01, len(dates)))), 2)
+        dates, close = dates[dates >= start_date], close[dates >= start_date]
+        df = pd.DataFrame({"date": dates, "open": close, "high": close, "low": close, "close": close,
+                           "volume": np.full(len(dates), 1000.0), "amount": close * 100_000})
+        if adjust == "hfq":
+            df[["open", "high", "low", "close"]] *= 2
+        return _normalize(df)
+
+
+class FallbackProvider(Provider):
+    """
+    依次尝试多个数据源，返回第一个成功的结果，全部失败时抛出主数据源的异常
+    """
+
+    def __init__(self, *providers):
+        self.providers = providers
+        self.name = " -> ".join(p.name for p in providers)
+
+    def _first(self, method, stock_code, *args):
+        error = None
+        for provider in self.providers:
+            try:
+                return getattr(provider, method)(*args)
+            except Exception as e:
+                error = error or e
+                if provider is not self.providers[-1]:
+                    logger.warning(f"{stock_code} 从 {provider.name} 获取失败，切换数据源：{e}")
+        raise error
+
+    def get_bars(self, stock_code, start_date, end_date, adjust="qfq"):
+        return self._first("get_bars", stock_code, stock_code, start_date, end_date, adjust)
+
+    def get_factor_bars(self, stock_code, start_date, end_date, qfq=False):
+        # 不复权和复权价必须来自同一个数据源，否则因子由两个数据源的价格拟合
+        return self._first("get_factor_bars", stock_code, stock_code, start_date, end_date, qfq)
+
+    def get_minute_bars(self, stock_code, start_date, end_date, period="1"):
+        return self._first("get_minute_bars", stock_code, stock_code, start_date, end_date, period)
+
+    def get_spot(self, stock_codes):
+        return self._first("get_spot", "实时报价", stock_codes)
+
+
+_PROVIDERS = {
+    "akshare": AkshareProvider,
+    "baostock": BaostockProvider,
+    "replay": ReplayProvider,
+}
+
+_provider = None
+
+
+def create_provider(name=PROVIDER, fallbacks=FALLBACK_PROVIDERS, record=RECORD_PROVIDER):
+    """
+    按名称创建数据源
+    :param name: akshare、baostock 或 replay
+    :param fallbacks: 主数据源失败时依次尝试的数据源名称
+    :param record: 是否把主数据源获取到的日线录制到 REPLAY_DIR
+    :return: Provider
+    """
+    primary = _PROVIDERS[name]()
+    if record and name != "replay":
+        primary = RecordProvider(primary)
+    chain = [primary] + [_PROVIDERS[n]() for n in fallbacks if n != name]
+    return chain[0] if len(chain) == 1 else FallbackProvider(*chain)
+
+
+def get_provider():
+    """
+    进程内共享的数据源，第一次使用时按 settings 创建
+    :return: Provider
+    """
+    global _provider
+    if _provider is None:
+        _provider = create_provider()
+    return _provider
+
+
+def set_provider(provider):
+    """
+    替换进程内共享的数据源，如离线运行时换成 ReplayProvider
+    :param provider: Provider 或数据源名称
+    :return:
+    """
+    global _provider
+    _provider = create_provider(provider, fallbacks=()) if isinstance(provider, str) else provider
@@ -0,0 +1,264 @@
+# -*- coding:utf-8 -*-
+"""
+证券代码注册表
+证券代码和名称原来分别手写在几个 json 文件里，名称写错时会当成另一个证券，生成另一份文件
+注册表从 json/all_stock.psv 构建，所有模块通过它查找证券
+- 第一次使用时把 psv 编译成 SYMBOL_INDEX（npz，定长字符串数组），之后直接读取，psv 修改后自动重建
+- 按代码 O(1) 查找，带不带 sh. / sz. 前缀都可以
+- 按代码或名称前缀查找，名称支持包含和近似匹配
+- 按代码推断市场：6/5/9 开头为 sh，0/3/1/2 开头为 sz，4/8 开头为 bj
+- json 文件中的 market 字段优先，不带市场的代码在多个市场都有时报错
+psv 中没有 ETF，ETF 只能推断市场，名称以 json 文件中的为准
+"""
+import difflib
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from settings import SYMBOL_SOURCE, SYMBOL_INDEX
+
+# 代码首位 -> 市场
+MARKETS = {"6": "sh", "5": "sh", "9": "sh", "0": "sz", "3": "sz", "1": "sz", "2": "sz", "4": "bj", "8": "bj"}
+# 场内基金（ETF、LOF）的代码前缀，1 和 5 开头的还有可转债、国债逆回购等，不能只看首位
+FUND_PREFIXES = ("15", "16", "18", "50", "51", "52", "56", "58")
+
+
+def split_code(code, pad=True):
+    """
+    拆出市场前缀和 6 位代码
+    :param code: 如 sh.600309、sh600309、600309.SH、600309 或 600309（int）
+    :param pad: 不足 6 位的数字代码是否在前面补 0，按前缀查找时不补
+    :return: (市场，没有前缀时为 None, 代码)
+    """
+    code = str(code).strip().lower()
+    if "." in code:
+        left, right = code.split(".", 1)
+        if left in ("sh", "sz", "bj"):
+            return left, right
+        if right in ("sh", "sz", "bj"):
+            return right, left
+    if code[:2] in ("sh", "sz", "bj") and code[2:].isdigit():
+        return code[:2], code[2:]
+    return None, code.zfill(6) if pad and code.isdigit() else code
+
+
+def infer_market(code):
+    """
+    按代码首位推断市场
+    :param code: 带不带前缀都可以，带前缀时以前缀为准
+    :return: sh、sz 或 bj，无法推断时为 None
+    """
+    market, code = split_code(code)
+    return market or MARKETS.get(code[:1])
+
+
+def is_fund(code):
+    """
+    是否为场内基金，akshare 用基金接口获取，baostock 不支持
+    :param code: 带不带前缀都可以
+    :return:
+    """
+    return split_code(code)[1].startswith(FUND_PREFIXES)
+
+
+def _build(source, index):
+    """
+    解析 psv，写出 npz 索引
+    沪市 000 开头、深市 399 开头的是指数，去掉市场前缀后会和个股代码重复
+    """
+    df = pd.read_csv(source, dtype={"code": str, "tradeStatus": str, "code_name": str})
+    market = df["code"].str[:2]
+    code = df["code"].str[3:]
+    is_index = ((market == "sh") & code.str.startswith("000")) | ((market == "sz") & code.str.startswith("399"))
+
+    st = os.stat(source)
+    arrays = {
+        "code": code.to_numpy(dtype=str),
+        "market": market.to_numpy(dtype=str),
+        "name": df["code_name"].fillna("").to_numpy(dtype=str),
+        "trading": (df["tradeStatus"] == "1").to_numpy(),
+        "index": is_index.to_numpy(),
+        "source": np.array([st.st_mtime_ns, st.st_size], dtype=np.int64),
+    }
+    os.makedirs(os.path.dirname(index), exist_ok=True)
+    tmp = f"{index}.tmp"
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, index)
+    logger.info(f"证券注册表已从 {source} 重建，共 {len(code)} 个证券")
+    return arrays
+
+
+class Registry:
+    """
+    证券注册表，数组按 psv 顺序保存，查找用两个 dict：带前缀的完整代码、不带前缀的代码
+    不带前缀时代码可能重复（sh.000001 上证指数和 sz.000001 平安银行），lookup 优先取非指数，resolve 报错
+    """
+
+    def __init__(self, source=SYMBOL_SOURCE, index=SYMBOL_INDEX):
+        arrays = None
+        if os.path.exists(index):
+            with np.load(index) as f:
+                arrays = {key: f[key] for key in f.files}
+            st = os.stat(source) if os.path.exists(source) else None
+            if st is not None and list(arrays["source"]) != [st.st_mtime_ns, st.st_size]:
+                arrays = None
+        if arrays is None:
+            arrays = _build(source, index)
+
+        self.codes = arrays["code"]
+        self.markets = arrays["market"]
+        self.names = arrays["name"]
+        self.trading = arrays["trading"]
+        self.is_index = arrays["index"]
+
+        codes, markets = self.codes.tolist(), self.markets.tolist()
+        self._full = {f"{m}.{c}": i for i, (m, c) in enumerate(zip(markets, codes))}
+        self._bare = {}
+        self._ambiguous = set()
+        for i in np.argsort(~self.is_index, kind='stable'):
+            # 指数在前、非指数在后，后写入的覆盖先写入的
+            if codes[i] in self._bare:
+                self._ambiguous.add(codes[i])
+            self._bare[codes[i]] = int(i)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _position(self, code):
+        market, bare = split_code(code)
+        if market is not None:
+            return self._full.get(f"{market}.{bare}")
+        return self._bare.get(bare)
+
+    def _record(self, i):
+        return {
+            "code": str(self.codes[i]),
+            "name": str(self.names[i]),
+            "market": str(self.markets[i]),
+            "trading": bool(self.trading[i]),
+            "index": bool(self.is_index[i]),
+        }
+
+    def is_ambiguous(self, code):
+        """
+        不带前缀的代码是否在多个市场都有
+        :param code: 如 000001
+        :return:
+        """
+        return split_code(code)[1] in self._ambiguous
+
+    def lookup(self, code):
+        """
+        按代码查找
+        :param code: 如 sh.600309、600309
+        :return: dict，列为 code（不带前缀）、name、market、trading、index，注册表中没有时返回 None
+        """
+        i = self._position(code)
+        return None if i is None else self._record(i)
+
+    def search(self, text, limit=10):
+        """
+        按代码前缀、名称前缀、名称包含依次查找，都没有时按名称近似匹配
+        :param text: 如 600、sh.6003、万华、万化化学
+        :param limit: 最多返回的个数
+        :return: [dict]，同一证券只出现一次
+        """
+        market, bare = split_code(text, pad=False)
+        hits = []
+        if bare.isdigit():
+            match = np.char.startswith(self.codes, bare)
+            if market is not None:
+                match &= self.markets == market
+            hits.extend(np.flatnonzero(match).tolist())
+        else:
+            text = str(text).strip()
+            hits.extend(np.flatnonzero(np.char.startswith(self.names, text)).tolist())
+            hits.extend(np.flatnonzero(np.char.find(self.names, text) >= 0).tolist())
+            if not hits:
+                names = self.names.tolist()
+                close = difflib.get_close_matches(text, names, n=limit, cutoff=0.5)
+                hits.extend(names.index(name) for name in close)
+
+        seen, result = set(), []
+        for i in hits:
+            if i not in seen:
+                seen.add(i)
+                result.append(self._record(i))
+            if len(result) >= limit:
+                break
+        return result
+
+    def universe(self):
+        """
+        全市场可交易的个股，去掉停牌和指数
+        :return: DataFrame，列为 code（不带市场前缀）、market、name
+        """
+        keep = self.trading & ~self.is_index
+        return pd.DataFrame({"code": self.codes[keep], "market": self.markets[keep], "name": self.names[keep]})
+
+
+_registry = None
+_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    进程内共享的注册表，第一次使用时加载
+    :return: Registry
+    """
+    global _registry
+    if _registry is None:
+        with _lock:
+            if _registry is None:
+                _registry = Registry()
+    return _registry
+
+
+def lookup(code):
+    return get_registry().lookup(code)
+
+
+def search(text, limit=10):
+    return get_registry().search(text, limit)
+
+
+def resolve(code, name=None, market=None):
+    """
+    证券代码统一成 6 位，名称以注册表为准，市场依次以代码前缀、market、注册表为准，注册表中没有时按代码推断
+    :param code: 如 sh.600309、600309
+    :param name: json 文件中的名称，与注册表不一致时告警并使用注册表中的名称
+    :param market: json 文件中的市场，如 sh
+    :return: dict，列为 code、name、market
+    """
+    prefix, bare = split_code(code)
+    market = market.strip().lower() if market else None
+    if prefix is not None and market is not None and prefix != market:
+        raise ValueError(f"{code} 的市场前缀与 market {market} 不一致")
+    market = prefix or market
+    registry = get_registry()
+    if market is None and registry.is_ambiguous(bare):
+        raise ValueError(f"{bare} 在多个市场都有（如上证指数和平安银行），需要写明 market 或带市场前缀")
+
+    record = registry.lookup(bare if market is None else f"{market}.{bare}")
+    if record is None:
+        # ETF 等注册表中没有的证券
+        return {"code": bare, "name": name, "market": market or MARKETS.get(bare[:1])}
+    if name is not None and name != record["name"]:
+        logger.warning(f"{record['code']} 的名称 {name} 与注册表不一致，使用 {record['name']}")
+    return {"code": record["code"], "name": record["name"], "market": record["market"]}
+
+
+def load_stocks(path):
+    """
+    读取手动维护的证券 json 文件，每一项的代码、名称、市场通过注册表统一，其余字段保留
+    :param path: 如 json/backtrader.json
+    :return: [dict]，代码在多个市场都有又没有写明市场时抛出 ValueError
+    """
+    with open(path, encoding='utf-8') as f:
+        stocks = json.loads(f.read())
+    return [{**comp, **resolve(comp.get('code'), comp.get('name'), comp.get('market'))} for comp in stocks]
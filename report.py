@@ -0,0 +1,223 @@
+# -*- coding:utf-8 -*-
+"""
+批量图表报告
+PLOT = True 时每张图都要 plt.show()，批量运行时每个证券、每个目标买入价都会阻塞，没有图形界面的服务器上也无法使用
+REPORT = True 时改为报告模式：
+- 价格分布柱状图、收盘价与策略净值对比图提交到进程池，由 Agg 渲染成 PNG 或 SVG，分析流程不等待渲染
+- 每次运行一个目录 REPORT_DIR/YYYYMMDD_HHMMSS，运行结束时汇总成一个静态 index.html
+- 进程用 spawn 启动，不继承主进程中获取数据的线程和日志队列
+"""
+import html
+import multiprocessing
+import os
+import threading
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from loguru import logger
+
+from settings import REPORT_DIR, REPORT_FORMAT, REPORT_WORKERS, START_DATE
+
+
+def _init_worker():
+    """
+    子进程启动时导入 matplotlib，缺少中文字体时的告警不输出
+    """
+    import logging
+    from plotting import configure
+
+    configure()
+    logging.getLogger('matplotlib.font_manager').setLevel(logging.ERROR)
+    warnings.filterwarnings('ignore', message='Glyph .* missing')
+
+
+def _render_distribution(path, title, edges, counts):
+    """
+    价格分布柱状图，用一条填充的阶梯线画出所有 bin，不为每个 bin 创建一个矩形
+    :param path: 输出文件，后缀决定格式
+    :param title: 标题
+    :param edges: bin 边界
+    :param counts: 每个 bin 的停留天数
+    :return: path
+    """
+    from plotting import figure
+
+    fig = figure((16, 6))
+    ax = fig.subplots()
+    ax.stairs(counts, edges, fill=True)
+    ax.set_title(title)
+    ax.set_xlabel("价格区间（元）")
+    ax.set_ylabel("停留天数")
+    ax.grid(True)
+    fig.savefig(path)
+    return path
+
+
+def _render_equity(path, title, dates, close, equity):
+    """
+    收盘价与策略净值对比图
+    :param path: 输出文件，后缀决定格式
+    :param title: 标题
+    :param dates: 交易日数组
+    :param close: 收盘价数组
+    :param equity: 资金曲线数组
+    :return: path
+    """
+    from plotting import figure
+
+    fig = figure((12, 6))
+    ax = fig.subplots()
+    ax.plot(dates, close, label="close")
+    ax.plot(dates, equity, label="equity")
+    ax.set_title(title)
+    ax.set_ylabel("价格 / 策略净值")
+    ax.legend()
+    ax.grid(True)
+    fig.savefig(path)
+    return path
+
+
+class Report:
+    """
+    一次运行的图表报告，add_* 只提交渲染任务立即返回，close 时等待渲染完成并写出 index.html
+    """
+
+    def __init__(self, title, report_dir=None, fmt=REPORT_FORMAT, workers=REPORT_WORKERS):
+        """
+        :param title: 报告标题
+        :param report_dir: 输出目录，为空时为 REPORT_DIR/YYYYMMDD_HHMMSS
+        :param fmt: png 或 svg
+        :param workers: 渲染进程数，为空时为 CPU 核数
+        """
+        self.title = title
+        self.report_dir = report_dir or os.path.join(REPORT_DIR, time.strftime('%Y%m%d_%H%M%S'))
+        self.fmt = fmt
+        os.makedirs(self.report_dir, exist_ok=True)
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=_init_worker)
+        self._lock = threading.Lock()
+        # 证券代码 -> {"name", "charts": [(说明, 文件名, future)], "rows": [指标 dict]}
+        self._sections = {}
+
+    def _section(self, stock_code, stock_name):
+        if stock_code not in self._sections:
+            self._sections[stock_code] = {"name": stock_name, "charts": [], "rows": []}
+        return self._sections[stock_code]
+
+    def _submit(self, stock_code, stock_name, caption, fn, *args):
+        with self._lock:
+            section = self._section(stock_code, stock_name)
+            filename = f"{stock_code}_{len(section['charts'])}.{self.fmt}"
+            future = self._pool.submit(fn, os.path.join(self.report_dir, filename), *args)
+            section["charts"].append((caption, filename, future))
+
+    def add_distribution(self, stock_code, stock_name, dist):
+        """
+        提交价格分布柱状图
+        :param stock_code: 如 588000 或 601398
+        :param stock_name: 如 科创50 或 工商银行
+        :param dist: compute_distribution 的结果
+        :return:
+        """
+        self._submit(stock_code, stock_name, "价格分布", _render_distribution,
+                     f"{stock_code}_{stock_name} 自 {START_DATE} 日股价停留分布",
+                     np.asarray(dist['edges'], dtype=float), np.asarray(dist['counts']))
+
+    def add_backtest(self, result, close):
+        """
+        提交收盘价与策略净值对比图，指标加入该证券的汇总表
+        :param result: BacktestResult
+        :param close: 与 result.equity 等长的收盘价数组
+        :return:
+        """
+        title = (f"{result.stock_code}_{result.stock_name} "
+                 f"策略回测（<{result.bid_label} 买，+{result.take_profit - 1:.0%} 卖）")
+        self._submit(result.stock_code, result.stock_name, f"目标买入价 {result.bid_label}", _render_equity,
+                     title, result.dates, np.asarray(close, dtype=float), result.equity)
+        with self._lock:
+            self._section(result.stock_code, result.stock_name)["rows"].append(result.metrics())
+
+    def close(self):
+        """
+        等待全部渲染完成，写出 index.html
+        :return: index.html 路径
+        """
+        self._pool.shutdown(wait=True)
+        parts = [f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>{html.escape(self.title)}</title>",
+                 "<style>body{font-family:sans-serif;margin:2em}img{max-width:100%}"
+                 "table{border-collapse:collapse}td,th{border:1px solid #ccc;padding:2px 8px;text-align:right}"
+                 "</style></head><body>",
+                 f"<h1>{html.escape(self.title)}</h1><p>{time.strftime('%Y-%m-%d %H:%M:%S')}，"
+                 f"{len(self._sections)} 个证券</p>",
+                 "<ul>" + "".join(f"<li><a href='#{code}'>{html.escape(code + '_' + str(s['name']))}</a></li>"
+                                  for code, s in self._sections.items()) + "</ul>"]
+        failed = 0
+        for code, section in self._sections.items():
+            parts.append(f"<h2 id='{code}'>{html.escape(code + '_' + str(section['name']))}</h2>")
+            if section["rows"]:
+                parts.append(_table(section["rows"]))
+            for caption, filename, future in section["charts"]:
+                err = future.exception()
+                if err is not None:
+                    failed += 1
+                    logger.error(f"{code}_{section['name']} {caption} 渲染失败：{err}")
+                    parts.append(f"<p>{html.escape(caption)}：渲染失败</p>")
+                    continue
+                parts.append(f"<figure><img src='{filename}' alt='{html.escape(caption)}'>"
+                             f"<figcaption>{html.escape(caption)}</figcaption></figure>")
+        parts.append("</body></html>")
+
+        path = os.path.join(self.report_dir, 'index.html')
+        with open(path, encoding='utf-8', mode='w') as f:
+            f.write("\n".join(parts))
+        charts = sum(len(s["charts"]) for s in self._sections.values())
+        logger.info(f"报告已写入 {path}，图表 {charts} 张，失败 {failed} 张")
+        return path
+
+
+def _table(rows):
+    """
+    指标表，收益率和回撤按百分比显示
+    """
+    cols = ["bid", "take_profit", "total_return", "annual_return", "max_drawdown", "trades", "days"]
+    pct = {"total_return", "annual_return", "max_drawdown"}
+    head = "".join(f"<th>{c}</th>" for c in cols)
+    body = "".join("<tr>" + "".join(f"<td>{row[c]:.2%}</td>" if c in pct else f"<td>{html.escape(str(row[c]))}</td>"
+                                    for c in cols) + "</tr>" for row in rows)
+    return f"<table><tr>{head}</tr>{body}</table>"
+
+
+# 当前运行的报告，REPORT = False 时为空
+_report = None
+
+
+def start(title="价格分布与策略回测"):
+    """
+    开始一次运行的报告，之后 get_distribution、get_return 的图表都提交到该报告
+    :param title: 报告标题
+    :return: Report
+    """
+    global _report
+    _report = Report(title)
+    return _report
+
+
+def current():
+    """
+    :return: 当前的 Report，没有开始时为 None
+    """
+    return _report
+
+
+def finish():
+    """
+    等待渲染完成并写出 index.html
+    :return: index.html 路径，没有开始时为 None
+    """
+    global _report
+    if _report is None:
+        return None
+    report, _report = _report, None
+    return report.close()
@@ -0,0 +1,157 @@
+# -*- coding:utf-8 -*-
+"""
+回溯结果
+get_return 的结果不再只是打印，而是返回 BacktestResult，调用方可以比较、汇总、保存
+- 资金曲线和交易日为 float64 / datetime64[D] 数组
+- 交易按列存储：买入下标、卖出下标、买入价、卖出价各一个数组，不为每笔交易创建对象
+- 指标在创建时计算一次
+内存占用只与数组长度有关，批量回溯大量证券和参数时只保留这些数组
+单个结果保存为 npz，多个结果的指标用 summarize 汇总成 DataFrame 后可以写 parquet
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+# 年化按每年 252 个交易日计算
+TRADING_DAYS_PER_YEAR = 252
+
+
+def max_drawdown(equity):
+    """
+    最大回撤，口径与 backtrader.get_max_drawdown 一致
+    :param equity: 资金曲线数组
+    :return:
+    """
+    equity = np.asarray(equity, dtype=float)
+    return float((equity / np.maximum.accumulate(equity) - 1).min())
+
+
+class BacktestResult:
+    """
+    单次回溯的结果
+    """
+    __slots__ = ("stock_code", "stock_name", "bid_label", "take_profit", "dates", "equity",
+                 "buy_idx", "sell_idx", "buy_price", "sell_price", "periods_per_year",
+                 "total_return", "annual_return", "max_drawdown")
+
+    def __init__(self, stock_code, stock_name, bid_label, take_profit, dates, equity,
+                 buy_idx, sell_idx, buy_price, sell_price, periods_per_year=TRADING_DAYS_PER_YEAR):
+        """
+        :param stock_code: 如 588000 或 601398
+        :param stock_name: 如 科创50 或 工商银行
+        :param bid_label: 目标买入价的说明，如 10.75 或 滚动（最新 10.8）
+        :param take_profit: 止盈比例
+        :param dates: 交易日数组
+        :param equity: 资金曲线数组
+        :param buy_idx: 已完成交易的买入下标
+        :param sell_idx: 已完成交易的卖出下标
+        :param buy_price: 已完成交易的买入价
+        :param sell_price: 已完成交易的卖出价
+        :param periods_per_year: 每年的 K 线数量，日线 252，周线 52，月线 12
+        """
+        self.stock_code = stock_code
+        self.stock_name = stock_name
+        self.bid_label = str(bid_label)
+        self.take_profit = float(take_profit)
+        self.dates = np.asarray(dates).astype('datetime64[D]')
+        self.equity = np.asarray(equity, dtype=np.float64)
+        self.buy_idx = np.asarray(buy_idx, dtype=np.int64)
+        self.sell_idx = np.asarray(sell_idx, dtype=np.int64)
+        self.buy_price = np.asarray(buy_price, dtype=np.float64)
+        self.sell_price = np.asarray(sell_price, dtype=np.float64)
+        self.periods_per_year = int(periods_per_year)
+
+        n = len(self.equity)
+        final = float(self.equity[-1]) if n else 1.0
+        self.total_return = final - 1
+        self.annual_return = final ** (self.periods_per_year / n) - 1 if n else 0.0
+        self.max_drawdown = max_drawdown(self.equity) if n else 0.0
+
+    @classmethod
+    def from_simulation(cls, stock_code, stock_name, bid_label, take_profit, dates, close, equity, buy_idx, sell_idx,
+                        periods_per_year=TRADING_DAYS_PER_YEAR):
+        """
+        由 simulate 的输出构造，收盘价只用于取出买卖价格，不保留
+        :param close: 收盘价数组
+        :return: BacktestResult
+        """
+        close = np.asarray(close, dtype=np.float64)
+        return cls(stock_code, stock_name, bid_label, take_profit, dates, equity,
+                   buy_idx, sell_idx, close[buy_idx], close[sell_idx], periods_per_year)
+
+    @property
+    def trades(self):
+        return len(self.buy_idx)
+
+    @property
+    def hold_days(self):
+        return self.sell_idx - self.buy_idx + 1
+
+    def metrics(self):
+        return {
+            "code": self.stock_code,
+            "name": self.stock_name,
+            "bid": self.bid_label,
+            "take_profit": self.take_profit,
+            "total_return": self.total_return,
+            "annual_return": self.annual_return,
+            "max_drawdown": self.max_drawdown,
+            "trades": self.trades,
+            "days": len(self.equity),
+        }
+
+    def trades_frame(self):
+        """
+        交易明细，只在需要查看时构造
+        :return: DataFrame，列为 buy_date、sell_date、buy_price、sell_price、hold_days
+        """
+        return pd.DataFrame({
+            "buy_date": pd.DatetimeIndex(self.dates[self.buy_idx].astype('datetime64[ns]')),
+            "sell_date": pd.DatetimeIndex(self.dates[self.sell_idx].astype('datetime64[ns]')),
+            "buy_price": self.buy_price,
+            "sell_price": self.sell_price,
+            "hold_days": self.hold_days,
+        })
+
+    def equity_series(self):
+        return pd.Series(self.equity, index=pd.DatetimeIndex(self.dates.astype('datetime64[ns]')), name="equity")
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ("dates", "equity", "buy_idx", "sell_idx",
+                                                           "buy_price", "sell_price"))
+
+    def save(self, path):
+        """
+        保存为 npz，数组原样写入，其余字段写成 json
+        :param path: 如 /home/rhino/s/a/result/600309.npz
+        :return:
+        """
+        meta = {"stock_code": self.stock_code, "stock_name": self.stock_name,
+                "bid_label": self.bid_label, "take_profit": self.take_profit,
+                "periods_per_year": self.periods_per_year}
+        np.savez(path, dates=self.dates, equity=self.equity, buy_idx=self.buy_idx, sell_idx=self.sell_idx,
+                 buy_price=self.buy_price, sell_price=self.sell_price,
+                 meta=np.array(json.dumps(meta, ensure_ascii=False)))
+
+    @classmethod
+    def load(cls, path):
+        """
+        读取 save 保存的结果
+        :param path:
+        :return: BacktestResult
+        """
+        with np.load(path) as f:
+            meta = json.loads(str(f["meta"]))
+            return cls(meta["stock_code"], meta["stock_name"], meta["bid_label"], meta["take_profit"],
+                       f["dates"], f["equity"], f["buy_idx"], f["sell_idx"], f["buy_price"], f["sell_price"],
+                       meta.get("periods_per_year", TRADING_DAYS_PER_YEAR))
+
+
+def summarize(results):
+    """
+    多个结果的指标汇总成一张表，每个结果一行
+    :param results: BacktestResult 列表
+    :return: DataFrame，可以直接 to_parquet 或 to_csv
+    """
+    return pd.DataFrame([r.metrics() for r in results])
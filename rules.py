@@ -0,0 +1,151 @@
+# -*- coding:utf-8 -*-
+"""
+提醒规则
+把持仓和自选文件统一转换成 (证券代码, 规则类型, 阈值) 的规则表
+- 两个文件中的证券合并去重后只获取一次
+- 所有规则在同一个最新价向量上按规则类型批量判断
+新增规则类型只需要在 RULES 中登记判断函数和邮件内容，不需要新的获取循环
+"""
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from dataset import CACHE
+from settings import TAKE_PROFIT
+
+
+def _take_profit_check(prices, thresholds, codes):
+    return prices > thresholds * TAKE_PROFIT
+
+
+def _take_profit_message(code, name, threshold, price):
+    subject = f"{code}_{name} 止盈提醒"
+    content = (f"{code}_{name} 已达到设定的止盈价格"
+               f"\n持仓价格: {threshold}"
+               f"\n止盈比例: {(TAKE_PROFIT - 1):.2%}"
+               f"\n止盈价格: {threshold * TAKE_PROFIT}"
+               f"\n当前价格: {price}")
+    return subject, content
+
+
+def _bid_check(prices, thresholds, codes):
+    return prices < thresholds
+
+
+def _bid_message(code, name, threshold, price):
+    subject = f"{code}_{name} 买入提醒"
+    content = (f"{code}_{name} 已低于设定的买入价格"
+               f"\n目标买入价格: {threshold}"
+               f"\n当前价格: {price}")
+    return subject, content
+
+
+def _percentile(code, price):
+    """
+    当前价格在历史收盘价分布中的百分位，历史数据来自进程内缓存
+    没有本地日线（如当天获取失败）时为 NaN，该规则不触发
+    """
+    try:
+        close = CACHE.get(code)['close'].to_numpy()
+    except FileNotFoundError:
+        logger.warning(f"{code} 没有本地日线，跳过百分位规则")
+        return np.nan
+    return (close < price).mean() * 100
+
+
+def _percentile_check(prices, thresholds, codes):
+    percentiles = np.array([_percentile(code, price) for code, price in zip(codes, prices)], dtype=float)
+    return percentiles < thresholds
+
+
+def _percentile_message(code, name, threshold, price):
+    subject = f"{code}_{name} 低百分位提醒"
+    content = (f"{code}_{name} 当前价格已低于历史分布的设定百分位"
+               f"\n设定百分位: {threshold}"
+               f"\n当前价格: {price}")
+    return subject, content
+
+
+# 规则类型 -> 来源文件、阈值字段、批量判断函数、邮件内容
+# 判断函数参数为 (最新价数组, 阈值数组, 证券代码数组)，返回是否触发的布尔数组
+RULES = {
+    "take_profit": {"source": "position", "field": "hold_price",
+                    "check": _take_profit_check, "message": _take_profit_message},
+    "bid": {"source": "watchlist", "field": "bid_price",
+            "check": _bid_check, "message": _bid_message},
+    "percentile": {"source": "watchlist", "field": "percentile",
+                   "check": _percentile_check, "message": _percentile_message},
+}
+
+
+def build_rules(position=(), watchlist=()):
+    """
+    持仓和自选转换成规则表，某一项没有对应阈值字段时不生成该规则
+    :param position: position.json 的内容
+    :param watchlist: watchlist.json 的内容
+    :return: DataFrame，列为 code、name、kind、threshold
+    """
+    sources = {"position": position, "watchlist": watchlist}
+    rows = []
+    for kind, spec in RULES.items():
+        for item in sources[spec["source"]]:
+            threshold = item.get(spec["field"])
+            if threshold is None:
+                continue
+            rows.append({
+                "code": f"{item.get('code')}",
+                "name": item.get('name'),
+                "kind": kind,
+                "threshold": float(threshold),
+            })
+    return pd.DataFrame(rows, columns=["code", "name", "kind", "threshold"])
+
+
+def symbols(rules):
+    """
+    规则涉及的证券，去重
+    :param rules: build_rules 的结果
+    :return: [{"code": ..., "name": ...}]
+    """
+    return rules.drop_duplicates("code")[["code", "name"]].to_dict('records')
+
+
+def latest_prices(stock_codes):
+    """
+    每个证券日线最后一天的收盘价
+    :param stock_codes:
+    :return: dict，证券代码 -> 收盘价，缓存中没有的不在其中
+    """
+    prices = {}
+    for code in stock_codes:
+        try:
+            prices[code] = float(CACHE.get(code).iloc[-1]['close'])
+        except FileNotFoundError:
+            continue
+    return prices
+
+
+def evaluate(rules, prices):
+    """
+    在最新价向量上批量判断所有规则
+    :param rules: build_rules 的结果
+    :param prices: dict，证券代码 -> 最新价
+    :return: DataFrame，触发的规则，多出 price、subject、content 三列
+    """
+    price = rules["code"].map(prices).to_numpy(dtype=float)
+    threshold = rules["threshold"].to_numpy(dtype=float)
+    kinds = rules["kind"].to_numpy()
+    codes = rules["code"].to_numpy()
+
+    hit = np.zeros(len(rules), dtype=bool)
+    has_price = ~np.isnan(price)
+    for kind, spec in RULES.items():
+        mask = (kinds == kind) & has_price
+        if mask.any():
+            hit[mask] = spec["check"](price[mask], threshold[mask], codes[mask])
+
+    triggered = rules[hit].assign(price=price[hit])
+    messages = [RULES[kind]["message"](code, name, thr, p)
+                for code, name, kind, thr, p in zip(triggered["code"], triggered["name"], triggered["kind"],
+                                                    triggered["threshold"], triggered["price"])]
+    return triggered.assign(subject=[m[0] for m in messages], content=[m[1] for m in messages])
@@ -0,0 +1,135 @@
+# -*- coding:utf-8 -*-
+"""
+全市场筛选
+从证券注册表（由 all_stock.psv 构建）读取全部证券，跳过停牌（tradeStatus != 1）和指数
+基于本地存储的日线，用进程池在所有 CPU 核上计算
+- 停留时间最多的区间
+- 覆盖70%时间的“价值区间”
+- 当前价格在历史分布的百分位
+输出按当前价格相对“价值区间”最低价的折价排序的结果表，低于“价值区间”的排在最前
+"""
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from fetcher import fetch_all
+from historical_range import compute_distribution, get_k_data
+from logs import add_sink
+from metrics import write_summary
+from panel import Panel
+from registry import get_registry
+from settings import DUMP_DIR, TODAY, BIN_PCT, VALUE_AREA, SCREENER_CHUNK_SIZE, PANEL_DIR
+from store import load_column
+
+
+def get_universe():
+    """
+    全市场证券，去掉停牌和指数，来自证券注册表
+    :return: DataFrame，列为 code（不带市场前缀）、market、name
+    """
+    return get_registry().universe()
+
+
+# 子进程中打开的面板，每个子进程只打开一次
+_panel = None
+
+
+def _load_close(code, panel_dir):
+    """
+    读取收盘价，有面板时从内存映射的面板中取一列，否则读取该证券的本地存储
+    :param code:
+    :param panel_dir:
+    :return: ndarray，去掉 NaN（停牌），没有本地行情时返回 None
+    """
+    global _panel
+    if panel_dir is None:
+        close = load_column(code, "close")
+    else:
+        if _panel is None:
+            _panel = Panel(panel_dir)
+        if code not in _panel.symbols:
+            return None
+        close = _panel.column(code, "close")
+    if close is None:
+        return None
+    close = np.asarray(close, dtype=float)
+    return close[~np.isnan(close)]
+
+
+def _screen_one(args):
+    """
+    单个证券的分布指标，在子进程中执行
+    :param args: (code, name, bin_pct, coverage, panel_dir)
+    :return: dict，没有本地行情或没有有效收盘价时返回 None
+    """
+    code, name, bin_pct, coverage, panel_dir = args
+    close = _load_close(code, panel_dir)
+    if close is None or not len(close):
+        return None
+
+    dist = compute_distribution(close, bin_pct, coverage)
+    return {
+        "code": code,
+        "name": name,
+        "current_price": dist["current_price"],
+        "percentile": dist["percentile"],
+        "top_left": dist["top_left"],
+        "top_right": dist["top_right"],
+        "lowest_price": dist["lowest_price"],
+        "highest_price": dist["highest_price"],
+        "discount": dist["current_price"] / dist["lowest_price"] - 1,
+        "below_value_area": dist["current_price"] < dist["lowest_price"],
+        "days": len(close),
+    }
+
+
+def screen(universe=None, bin_pct=BIN_PCT, coverage=VALUE_AREA, workers=None, panel_dir=None):
+    """
+    全市场筛选
+    :param universe: get_universe 的结果，为空时读取 all_stock.psv
+    :param bin_pct: bin 宽度占均价的比例
+    :param coverage: “价值区间”覆盖的交易日比例
+    :param workers: 进程数，为空时使用全部 CPU 核
+    :param panel_dir: 行情面板目录，为空时逐个读取本地存储
+    :return: DataFrame，按折价从大到小排序
+    """
+    if universe is None:
+        universe = get_universe()
+
+    tasks = [(code, name, bin_pct, coverage, panel_dir) for code, name in zip(universe["code"], universe["name"])]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = [r for r in pool.map(_screen_one, tasks, chunksize=SCREENER_CHUNK_SIZE) if r is not None]
+
+    logger.info(f"全市场 {len(tasks)} 个证券，有本地行情的 {len(rows)} 个")
+    if not rows:
+        return pd.DataFrame()
+    return pd.DataFrame(rows).sort_values("discount", ignore_index=True)
+
+
+if __name__ == '__main__':
+    # /home/rhino/s/a/app_YYYYMMDD.log
+    add_sink('app')
+    stocks = get_universe()
+
+    # python screener.py --fetch 先增量更新全市场的本地行情
+    if '--fetch' in sys.argv:
+        for comp, _, err in fetch_all(stocks.to_dict('records'), lambda c: get_k_data(c['code'], c['name'])):
+            if err is not None:
+                logger.error(f"{comp['code']}_{comp['name']} 获取历史数据失败：{err}")
+
+    # python screener.py --panel 从行情面板读取，需要先 build_panel
+    result = screen(stocks, panel_dir=PANEL_DIR if '--panel' in sys.argv else None)
+    if not result.empty:
+        below = result[result["below_value_area"]]
+        logger.info(f"低于“价值区间”的证券共 {len(below)} 个：\n{below.head(20).to_string()}")
+
+        # 结果放在子目录中，不会被 clear_file 清理
+        screener_dir = os.path.join(DUMP_DIR, 'screener')
+        os.makedirs(screener_dir, exist_ok=True)
+        result.to_csv(os.path.join(screener_dir, f"screener_{TODAY}.csv"), index=False)
+
+    write_summary()
@@ -6,6 +6,39 @@ DUMP_DIR = '/home/rhino/s/a'
 if not os.path.exists(DUMP_DIR):
     os.makedirs(DUMP_DIR)
 
+# 证券注册表的来源和编译后的索引，psv 修改后索引自动重建
+SYMBOL_SOURCE = 'json/all_stock.psv'
+SYMBOL_INDEX = os.path.join(DUMP_DIR, 'symbols.npz')
+
+# 本地行情存储目录，不会被 clear_file 清理
+STORE_DIR = os.path.join(DUMP_DIR, 'store')
+# 本地存储保存不复权价格和后复权因子，读取时默认的复权方式：qfq、hfq 或 raw
+ADJUST = "qfq"
+# 最小价位（元），后复权因子由取整的价格相除得到，按最小价位估计取整误差，误差范围内的变化不记为新的因子
+PRICE_TICK = 0.01
+# 场内基金（ETF、LOF）的最小价位
+FUND_PRICE_TICK = 0.001
+# 全量下载时推算的前复权收盘价与数据源前复权收盘价最多相差的最小价位个数，超过时报错
+ADJUST_CHECK_TICKS = 3
+
+# 分钟线目录，每个证券每月一个分区文件，不会被 clear_file 清理
+MINUTE_DIR = os.path.join(DUMP_DIR, 'minute')
+# 分钟线周期：1、5、15、30 或 60
+MINUTE_PERIOD = "1"
+
+# 多证券行情面板目录
+PANEL_DIR = os.path.join(DUMP_DIR, 'panel')
+
+# 进程内行情缓存的内存上限
+DATASET_CACHE_BYTES = 512 * 1024 * 1024
+
+# 是否缓存分布和回溯结果，输入和参数不变时直接返回上次的结果
+MEMO_ENABLED = True
+# 结果缓存目录，不会被 clear_file 清理
+MEMO_DIR = os.path.join(DUMP_DIR, 'memo')
+# 结果缓存的磁盘占用上限，超过时按最近使用时间淘汰
+MEMO_MAX_BYTES = 256 * 1024 * 1024
+
 # 2025-07-17
 TODAY = time.strftime('%Y-%m-%d', time.localtime())
 
@@ -15,6 +48,20 @@ PLOT = False
 # 是否留存数据
 SAVE_DATA = False
 
+# 报告模式：图表由进程池渲染成文件，运行结束时汇总成一个 HTML，不调用 plt.show()
+REPORT = False
+# 报告目录，每次运行一个子目录，不会被 clear_file 清理
+REPORT_DIR = os.path.join(DUMP_DIR, 'report')
+# 图表格式：png 或 svg
+REPORT_FORMAT = "png"
+# 渲染进程数，为空时为 CPU 核数
+REPORT_WORKERS = None
+
+# 是否统计各环节耗时，运行结束时写出汇总
+METRICS_ENABLED = False
+# 汇总中列出最慢的环节个数
+METRICS_TOP_N = 20
+
 # 2001年科技股泡沫破裂&国有股坚持
 # 2008年次贷危机：
 # 2015年杠杆股灾
@@ -29,6 +76,35 @@ CRASHES = [
     ("2020-01-01", "2020-04-01"),
     ("2022-02-01", "2022-12-01"),
 ]
+# 压力测试获取行情的起始日期，早于第一个暴跌时段，时段开始前有基准日
+# 只用于 stress.py，不写入本地存储，其余分析仍从 START_DATE 开始
+STRESS_START_DATE = "2001-01-01"
+
+# 行情数据源：akshare、baostock 或 replay（读取录制的本地文件，不需要网络）
+PROVIDER = "akshare"
+# 主数据源失败时依次尝试的数据源
+FALLBACK_PROVIDERS = ["baostock"]
+# 是否把主数据源获取到的日线录制到 REPLAY_DIR，供 replay 数据源离线使用
+RECORD_PROVIDER = False
+# 录制的日线目录
+REPLAY_DIR = os.path.join(DUMP_DIR, 'replay')
+
+# 行情获取最多同时在途的请求数
+FETCH_CONCURRENCY = 4
+# 行情获取每秒最多发起的请求数，东财请求太密集会断连
+FETCH_RATE = 0.5
+# 行情获取允许的突发请求数
+FETCH_BURST = 2
+# 行情获取失败后最多重试次数
+FETCH_RETRIES = 3
+# 行情获取首次重试前等待的秒数，之后每次翻倍
+FETCH_BACKOFF = 5.0
+
+# 全市场筛选时每个子进程一次处理的证券数
+SCREENER_CHUNK_SIZE = 64
+
+# 分析的 K 线周期：daily、weekly 或 monthly，周线、月线由本地日线重采样
+TIMEFRAME = "daily"
 
 # 回溯开始时间
 START_DATE = "2018-01-01"
@@ -43,11 +119,53 @@ BID_PRICE = 35.36
 # 上涨 20% 卖出
 TAKE_PROFIT = 1.2
 
+# 价格分布的 bin 宽度，均价的 2%
+BIN_PCT = 0.02
+
+# “价值区间”覆盖的交易日比例
+VALUE_AREA = 0.7
+
+# 滚动“价值区间”的窗口交易日数，None 为扩展窗口
+ROLLING_WINDOW = 750
+# 滚动“价值区间”至少需要的交易日数，同时用于确定 bin 宽度
+ROLLING_MIN_PERIODS = 250
+
+# 参数扫描的 bin 宽度百分比
+SWEEP_BIN_PCTS = [0.01, 0.02, 0.03, 0.05]
+# 参数扫描的止盈比例，1.05 ~ 1.54
+SWEEP_TAKE_PROFITS = [round(1 + i / 100, 2) for i in range(5, 55)]
+# 参数扫描在历史最低价和最高价之间均匀取的目标买入价个数
+SWEEP_BID_STEPS = 100
+# 参数扫描每批同时模拟的参数组合数
+SWEEP_BATCH_SIZE = 8192
+
+# 蒙特卡洛检验每个证券生成的价格路径数
+MONTECARLO_PATHS = 10000
+# 重抽样的块长度（交易日），保留块内相邻交易日的相关性，1 为逐日独立重抽样
+MONTECARLO_BLOCK = 20
+# 每批生成和模拟的路径数，决定内存占用
+MONTECARLO_CHUNK = 1000
+# 随机种子，相同种子结果可复现
+MONTECARLO_SEED = 0
+
+# 组合回溯中单个证券买入时最多占组合净值的比例
+PORTFOLIO_MAX_WEIGHT = 0.2
+
+# 提醒守护进程轮询实时报价的间隔秒数
+NOTIFY_POLL_SECONDS = 30
+# 交易时段
+TRADING_SESSIONS = [("09:30", "11:30"), ("13:00", "15:00")]
+
 # 是否启用文件提醒
 ENABLE_FILE_NOTIFY = False
 
 # 是否启用邮件提醒
 ENABLE_MAIL_NOTIFY = True
+# 一次运行的所有提醒合并成一封邮件，否则每条提醒一封，复用同一个连接
+MAIL_DIGEST = True
+# 合并模式下攒够这么多条，或第一条提醒等待超过这么多秒时先发出一封，不等到运行结束
+MAIL_DIGEST_MAX_ALERTS = 20
+MAIL_DIGEST_SECONDS = 60
 # QQ 邮箱的 SMTP 服务器地址
 QQ_SMTP_SERVER = "smtp.qq.com"
 # QQ 邮箱的 SMTP 服务器端口
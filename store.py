@@ -0,0 +1,472 @@
+# -*- coding:utf-8 -*-
+"""
+本地行情存储
+每个证券一个目录，每列一个 .npy 文件，日期为 datetime64[D]，价格和成交量为 float64
+meta.json 中记录证券名称和已存储的最新交易日（高水位）
+- 读取时直接得到类型化的列，不需要解析 CSV
+- 增量更新时只追加高水位之后的交易日
+价格按不复权存储，另存复权因子的变化点，每一段内 后复权价 = a * 不复权价 + b：
+- factor_date.npy 因子开始生效的交易日
+- factor.npy      a，按比例复权的数据源每次除权除息变化
+- offset.npy      b，先减去现金分红的数据源每次分红变化，按比例复权时为 0
+- hfq.npy         数据源的后复权收盘价，增量更新时最后一段连同新的交易日重新拟合，不读取
+除权除息只会在末尾增加一段，已存储的历史不需要重新下载
+a、b 由数据源的不复权收盘价和后复权收盘价逐段拟合，两个价格都按最小价位取整，误差范围内的波动不记为新的一段
+读取时按需复权，一次向量乘加：后复权为 a * 价格 + b，前复权再按最新一段反算（见 adjust_coefficients）
+"""
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from metrics import span
+from registry import is_fund
+from settings import STORE_DIR, ADJUST, PRICE_TICK, FUND_PRICE_TICK
+
+# 存储的列，date 之外都是 float64
+COLUMNS = ["open", "high", "low", "close", "volume", "amount"]
+# 需要复权的列，成交量和成交额不复权
+PRICE_COLUMNS = ["open", "high", "low", "close"]
+# 复权因子的存储格式版本，变化后已有存储重新下载一次
+FACTOR_VERSION = 2
+
+
+# 已检查过中断残留的存储目录
+_recovered = set()
+_recover_lock = threading.Lock()
+
+
+def _recover():
+    """
+    进程中第一次访问本地存储时检查上次 append_bars 的中断残留
+    在两次替换之间中断时只剩 {证券代码}.old，改回原名；原目录已存在时 .old 是过期的，删除
+    """
+    if STORE_DIR in _recovered:
+        return
+    with _recover_lock:
+        if STORE_DIR in _recovered:
+            return
+        if os.path.isdir(STORE_DIR):
+            for entry in os.scandir(STORE_DIR):
+                if not entry.name.endswith('.old') or not entry.is_dir():
+                    continue
+                live = entry.path[:-len('.old')]
+                if os.path.exists(live):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.replace(entry.path, live)
+                    logger.warning(f"{os.path.basename(live)} 上次更新中断，已恢复更新前的本地存储")
+        _recovered.add(STORE_DIR)
+
+
+def _symbol_dir(stock_code):
+    _recover()
+    return os.path.join(STORE_DIR, stock_code)
+
+
+def _read_meta(stock_code):
+    path = os.path.join(_symbol_dir(stock_code), 'meta.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.loads(f.read())
+
+
+def high_water(stock_code):
+    """
+    已存储的最新交易日
+    :param stock_code: 如 588000 或 601398
+    :return: 如 2025-07-17，没有存储时返回 None
+    """
+    meta = _read_meta(stock_code)
+    return meta.get('high_water') if meta else None
+
+
+def is_legacy(stock_code):
+    """
+    是否为旧版存储：直接保存前复权价格，或复权因子为旧版格式（只有比例，没有偏移）
+    :param stock_code: 如 588000 或 601398
+    :return:
+    """
+    meta = _read_meta(stock_code)
+    return meta is not None and (meta.get('adjust') != 'raw' or meta.get('factor_version') != FACTOR_VERSION)
+
+
+def price_tick(stock_code):
+    """
+    最小价位，场内基金为 0.001 元，其余为 0.01 元
+    :param stock_code: 如 588000 或 601398
+    :return:
+    """
+    return FUND_PRICE_TICK if is_fund(stock_code) else PRICE_TICK
+
+
+def hfq_tolerance(tick, raw, hfq):
+    """
+    由不复权价推算后复权价的容差
+    两个价格各有最多半个价位的取整误差，不复权价的误差按 后复权价 / 不复权价 放大，再留一倍余量
+    :param tick: 最小价位
+    :param raw: 不复权价
+    :param hfq: 后复权价
+    :return: 与 raw 等长的数组，单位与后复权价相同
+    """
+    raw = np.asarray(raw, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return tick * (1 + np.abs(np.asarray(hfq, dtype=float) / raw))
+
+
+class _Segment:
+    """
+    拟合中的一段，保存各点和累加和，hfq = a * raw + b 的参数随新的交易日用全部点重新估计
+    三种形式：
+    - proportional 沿用上一段的 b 只拟合 a（按比例复权）
+    - additive     沿用上一段的 a 只拟合 b（先减去现金分红）
+    - linear       a 和 b 都拟合（先减去现金分红的数据源遇到送转股），价格范围窄时外推误差大，只作为最后的选择
+    """
+
+    def __init__(self, date, prev):
+        """
+        :param date: 变化点日期
+        :param prev: 上一段的 (a, b)，第一段为 None
+        """
+        self.date = date
+        self.prev = (1.0, 0.0) if prev is None else prev
+        # 第一段，或之前没有任何复权（后复权价等于不复权价），还看不出数据源的复权方式
+        self.free = prev is None or (abs(prev[0] - 1) < 1e-9 and abs(prev[1]) < 1e-9)
+        self.kind = None
+        self.a, self.b = self.prev
+        self.raw, self.hfq = [], []
+        # n、Σr、Σh、Σ1/r、Σh/r、Σr²、Σrh
+        self.sums = np.zeros(7)
+
+    def add(self, r, h):
+        self.raw.append(r)
+        self.hfq.append(h)
+        self.sums += (1, r, h, 1 / r, h / r, r * r, r * h)
+
+    def params(self, kind):
+        n, sr, sh, sinv, sratio, srr, srh = self.sums
+        a0, b0 = self.prev
+        if kind == "proportional":
+            return (sratio - b0 * sinv) / n, b0
+        if kind == "additive":
+            return a0, (sh - a0 * sr) / n
+        a = (n * srh - sr * sh) / (n * srr - sr * sr)
+        return a, (sh - a * sr) / n
+
+    def refit(self, tick):
+        """
+        用全部点重新选择形式，都不满足容差时返回 False
+        同一个数据源每次除权除息的复权方式相同，低价股两种形式可能都在容差内，按已知的复权方式拟合：
+        上一段 b 为 0 时只按比例复权，否则只按差值复权，遇到送转股时用 linear；
+        还看不出复权方式时两种都尝试，都满足时取残差平方和较小的
+        :return: 是否拟合成功
+        """
+        raw, hfq = np.array(self.raw), np.array(self.hfq)
+        tol = hfq_tolerance(tick, raw, hfq)
+        if self.free:
+            kinds = ["proportional", "additive"]
+        else:
+            kinds = ["proportional"] if self.prev[1] == 0 else ["additive"]
+        fits = []
+        for kind in kinds:
+            a, b = self.params(kind)
+            residual = a * raw + b - hfq
+            if np.all(np.abs(residual) <= tol):
+                fits.append((np.sum(residual ** 2), kind))
+        if not fits and "additive" in kinds and len(raw) >= 2 and np.ptp(raw) > 0:
+            a, b = self.params("linear")
+            if np.all(np.abs(a * raw + b - hfq) <= tol):
+                fits.append((0, "linear"))
+        if not fits:
+            return False
+        self.kind = min(fits)[1]
+        self.a, self.b = self.params(self.kind)
+        return True
+
+    def update(self):
+        """
+        形式不变，用全部点重新估计参数
+        """
+        self.a, self.b = self.params(self.kind)
+
+
+def fit_factors(dates, raw, hfq, tick, start=None, prev=None):
+    """
+    逐日的不复权收盘价和后复权收盘价拟合成复权因子的变化点
+    每一段内 hfq = a * raw + b：按比例复权的数据源 b = 0，先减去现金分红的数据源 a = 1，送转股时 a 变化
+    新的交易日不满足当前一段，且加入后整段也无法重新拟合时，从这一天开始新的一段，没有除权除息时只有一段
+    :param dates: 交易日数组，升序
+    :param raw: 不复权收盘价
+    :param hfq: 后复权收盘价，NaN 的交易日忽略
+    :param tick: 最小价位，见 price_tick
+    :param start: 已存储的最后一段 (变化点日期, a, b, 这一段已存储的不复权收盘价, 后复权收盘价)，新的交易日接在这一段之后
+    :param prev: start 之前一段的 (a, b)，start 为第一段或没有 start 时为 None
+    :return: (变化点日期数组, a 数组, b 数组)
+    """
+    dates = np.asarray(dates).astype('datetime64[D]')
+    raw = np.asarray(raw, dtype=float)
+    hfq = np.asarray(hfq, dtype=float)
+    valid = (raw > 0) & np.isfinite(hfq)
+
+    segments = []
+    if start is not None:
+        date, a, b, raws, hfqs = start
+        seg = _Segment(date, prev)
+        for r, h in zip(raws, hfqs):
+            if r > 0:
+                # 没有存储后复权价的交易日按已存储的参数推算
+                seg.add(float(r), float(h) if np.isfinite(h) else a * r + b)
+        if not seg.raw or not seg.refit(tick):
+            seg.kind = None
+            seg.a, seg.b = a, b
+        segments.append(seg)
+    for date, r, h in zip(dates[valid], raw[valid], hfq[valid]):
+        if segments:
+            seg = segments[-1]
+            if abs(seg.a * r + seg.b - h) <= hfq_tolerance(tick, r, h):
+                seg.add(r, h)
+                if seg.kind is None:
+                    seg.refit(tick)
+                else:
+                    seg.update()
+                continue
+            seg.add(r, h)
+            if seg.refit(tick):
+                continue
+            # 加入后无法拟合，撤销这个点，从这一天开始新的一段
+            seg.raw.pop()
+            seg.hfq.pop()
+            seg.sums -= (1, r, h, 1 / r, h / r, r * r, r * h)
+            seg.refit(tick)
+            prev = (seg.a, seg.b)
+        seg = _Segment(date, prev)
+        seg.add(r, h)
+        seg.refit(tick)
+        segments.append(seg)
+    return (np.array([seg.date for seg in segments], dtype='datetime64[D]'),
+            np.array([seg.a for seg in segments], dtype=float),
+            np.array([seg.b for seg in segments], dtype=float))
+
+
+def _read_factors(stock_code):
+    d = _symbol_dir(stock_code)
+    path = os.path.join(d, 'factor.npy')
+    if not os.path.exists(path):
+        return None
+    factors = np.load(path)
+    offset = os.path.join(d, 'offset.npy')
+    offsets = np.load(offset) if os.path.exists(offset) else np.zeros(len(factors))
+    return np.load(os.path.join(d, 'factor_date.npy')), factors, offsets
+
+
+def _expand_factors(factor_dates, factors, dates):
+    """
+    变化点展开成逐日的值，早于第一个变化点的交易日使用第一个值
+    """
+    idx = np.searchsorted(factor_dates, np.asarray(dates).astype('datetime64[D]'), side='right') - 1
+    return factors[np.clip(idx, 0, None)]
+
+
+def adjust_coefficients(stock_code, dates, adjust=ADJUST):
+    """
+    不复权价格换算成 adjust 复权价格的系数，复权价 = 不复权价 * scale + offset
+    - 后复权：scale = a，offset = b
+    - 前复权：后复权价按最新一段反算回不复权价的口径，scale = a / 最新 a，offset = (b - 最新 b) / 最新 a，
+      最新一段的前复权价等于不复权价，与数据源的 qfq 口径一致（全量下载时校验，见 historical_range.get_k_data）
+    :param stock_code: 如 588000 或 601398
+    :param dates: 交易日数组
+    :param adjust: qfq、hfq 或 raw
+    :return: (scale, offset)，与 dates 等长的数组，不需要换算（raw 或没有复权因子）时返回 None
+    """
+    if adjust not in ("qfq", "hfq", "raw"):
+        raise ValueError(f"不支持的复权方式：{adjust}")
+    if adjust == "raw":
+        return None
+    stored = _read_factors(stock_code)
+    if stored is None or not len(stored[1]):
+        return None
+    factor_dates, factors, offsets = stored
+    scale = _expand_factors(factor_dates, factors, dates)
+    offset = _expand_factors(factor_dates, offsets, dates)
+    if adjust == "qfq":
+        return scale / factors[-1], (offset - offsets[-1]) / factors[-1]
+    return scale, offset
+
+
+def _read_columns(stock_code, mmap_mode=None):
+    d = _symbol_dir(stock_code)
+    cols = {"date": np.load(os.path.join(d, 'date.npy'), mmap_mode=mmap_mode)}
+    for col in COLUMNS:
+        cols[col] = np.load(os.path.join(d, f'{col}.npy'), mmap_mode=mmap_mode)
+    return cols
+
+
+def load_bars(stock_code, start_date=None, end_date=None, adjust=ADJUST):
+    """
+    读取本地存储的日线
+    :param stock_code: 如 588000 或 601398
+    :param start_date: 起始日期（含），如 2018-01-01
+    :param end_date: 结束日期（含）
+    :param adjust: qfq、hfq 或 raw
+    :return: DataFrame，列为 date 和 COLUMNS，没有存储时返回 None
+    """
+    if high_water(stock_code) is None:
+        return None
+
+    with span("load_bars", stock_code) as s:
+        cols = _read_columns(stock_code, mmap_mode='r')
+        dates = cols["date"]
+        lo = 0 if start_date is None else np.searchsorted(dates, np.datetime64(start_date, 'D'), side='left')
+        hi = len(dates) if end_date is None else np.searchsorted(dates, np.datetime64(end_date, 'D'), side='right')
+
+        dates = np.array(dates[lo:hi])
+        df = pd.DataFrame({col: np.array(cols[col][lo:hi]) for col in COLUMNS})
+        coefficients = adjust_coefficients(stock_code, dates, adjust)
+        if coefficients is not None:
+            scale, offset = coefficients
+            df[PRICE_COLUMNS] = df[PRICE_COLUMNS].to_numpy() * scale[:, None] + offset[:, None]
+        df.insert(0, "date", pd.DatetimeIndex(dates.astype('datetime64[ns]')))
+        s.rows = hi - lo
+        s.bytes_read = sum(cols[col][lo:hi].nbytes for col in cols)
+    return df
+
+
+def load_column(stock_code, col="close", adjust=ADJUST):
+    """
+    只读取一列，全市场批量计算时避免构造 DataFrame
+    :param stock_code: 如 588000 或 601398
+    :param col: date 或 COLUMNS 中的一列
+    :param adjust: 价格列的复权方式：qfq、hfq 或 raw
+    :return: ndarray，没有存储时返回 None
+    """
+    path = os.path.join(_symbol_dir(stock_code), f'{col}.npy')
+    if not os.path.exists(path):
+        return None
+    with span("load_column", stock_code) as s:
+        values = np.load(path)
+        s.rows = len(values)
+        s.bytes_read = values.nbytes
+        if col in PRICE_COLUMNS:
+            coefficients = adjust_coefficients(stock_code,
+                                               np.load(os.path.join(_symbol_dir(stock_code), 'date.npy')), adjust)
+            if coefficients is not None:
+                values = values * coefficients[0] + coefficients[1]
+    return values
+
+
+def tail(stock_code, n=2):
+    """
+    读取最后 n 个交易日的不复权价格，以及由复权因子推算的后复权收盘价
+    :param stock_code: 如 588000 或 601398
+    :param n:
+    :return: DataFrame，列为 date、COLUMNS 和 hfq，没有存储时返回 None
+    """
+    if high_water(stock_code) is None:
+        return None
+
+    cols = _read_columns(stock_code, mmap_mode='r')
+    dates = np.array(cols["date"][-n:])
+    df = pd.DataFrame({col: np.array(cols[col][-n:]) for col in COLUMNS})
+    coefficients = adjust_coefficients(stock_code, dates, "hfq")
+    df["hfq"] = np.nan if coefficients is None else df["close"].to_numpy() * coefficients[0] + coefficients[1]
+    df.insert(0, "date", pd.DatetimeIndex(dates.astype('datetime64[ns]')))
+    return df
+
+
+def append_bars(stock_code, df, stock_name=None):
+    """
+    追加日线，与已存储日期重叠的部分以新数据为准（盘中获取的当天数据会在下次更新时被覆盖）
+    先写临时目录再整体替换，写到一半中断不会破坏已有数据
+    :param stock_code: 如 588000 或 601398
+    :param df: 包含 date 和 COLUMNS 的不复权日线，hfq 列为逐日的后复权收盘价，没有时沿用已存储的因子
+    :param stock_name: 如 科创50 或 工商银行
+    :return:
+    """
+    new_dates = pd.to_datetime(df["date"]).to_numpy().astype('datetime64[D]')
+    order = np.argsort(new_dates, kind='stable')
+    new = {"date": new_dates[order]}
+    for col in COLUMNS:
+        values = df[col].to_numpy(dtype=float) if col in df else np.full(len(df), np.nan)
+        new[col] = values[order]
+
+    if not len(new["date"]):
+        return
+
+    fresh = new["date"]
+    new["hfq"] = df["hfq"].to_numpy(dtype=float)[order] if "hfq" in df else np.full(len(df), np.nan)
+    new_hfq = new["hfq"]
+    no_factors = np.isnan(new_hfq).all()
+    empty = np.array([], dtype=float)
+    kept, start, prev = (fresh[:0], empty, empty), None, None
+
+    meta = _read_meta(stock_code)
+    if meta is not None:
+        old = _read_columns(stock_code)
+        path = os.path.join(_symbol_dir(stock_code), 'hfq.npy')
+        old["hfq"] = np.load(path) if os.path.exists(path) else np.full(len(old["date"]), np.nan)
+        keep = old["date"] < fresh[0]
+        new = {col: np.concatenate([old[col][keep], new[col]]) for col in new}
+
+        # 新数据之前的因子保留，新数据没有后复权价时沿用全部已存储的因子
+        stored = _read_factors(stock_code)
+        if stored is not None:
+            prior = np.ones(len(stored[0]), dtype=bool) if no_factors else stored[0] < fresh[0]
+            kept = tuple(values[prior] for values in stored)
+            if len(kept[0]) and not no_factors:
+                # 最后一段连同已存储的不复权价继续接收新的交易日，同一段不会重复记录
+                rows = keep & (old["date"] >= kept[0][-1])
+                start = (kept[0][-1], kept[1][-1], kept[2][-1], old["close"][rows], old["hfq"][rows])
+                if len(kept[0]) > 1:
+                    prev = (kept[1][-2], kept[2][-2])
+                kept = tuple(values[:-1] for values in kept)
+
+    fitted = fit_factors(fresh, new["close"][-len(fresh):], new_hfq, price_tick(stock_code), start, prev)
+    factor_dates, factors, offsets = (np.concatenate([k, f]) for k, f in zip(kept, fitted))
+
+    d = _symbol_dir(stock_code)
+    tmp = f"{d}.tmp"
+    # 上次中断留下的临时目录可能有多余的文件
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    with span("append_bars", stock_code) as s:
+        for col, values in new.items():
+            np.save(os.path.join(tmp, f'{col}.npy'), values)
+        np.save(os.path.join(tmp, 'factor_date.npy'), factor_dates)
+        np.save(os.path.join(tmp, 'factor.npy'), factors)
+        np.save(os.path.join(tmp, 'offset.npy'), offsets)
+        s.rows = len(new["date"])
+        s.bytes_written = sum(values.nbytes for values in new.values())
+
+    meta = {
+        "code": stock_code,
+        "name": stock_name or (meta or {}).get('name'),
+        "high_water": str(new["date"][-1]),
+        "rows": len(new["date"]),
+        "adjust": "raw",
+        "factor_version": FACTOR_VERSION,
+        "factors": len(factors),
+    }
+    with open(os.path.join(tmp, 'meta.json'), encoding='utf-8', mode='w') as f:
+        f.write(json.dumps(meta, ensure_ascii=False))
+
+    # 过期的 .old 非空时无法替换，先删除；两次替换之间中断时由 _recover 恢复
+    old_dir = f"{d}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(d):
+        os.replace(d, old_dir)
+    os.replace(tmp, d)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def reset(stock_code):
+    """
+    删除某个证券的本地存储，下次更新时重新下载全部历史
+    :param stock_code:
+    :return:
+    """
+    shutil.rmtree(_symbol_dir(stock_code), ignore_errors=True)
@@ -0,0 +1,251 @@
+# -*- coding:utf-8 -*-
+"""
+暴跌时段压力测试
+从 backtrader.json 文件读取需要分析的证券代码，每个证券只回溯一次整段历史，
+再按 settings.CRASHES 中的时间段，用 searchsorted 在日期轴上切出每个时段，计算
+- 时段收益率（以时段开始前一个交易日的净值为基准）
+- 时段内最大回撤及最低点日期
+- 从最低点回到之前高点所需的交易日数，时段结束后仍未回到的继续向后查找，到最后也没回到的为空
+- 时段内持仓的交易日占比
+策略和买入持有作为资金曲线矩阵的两列一起计算
+行情从 STRESS_START_DATE 开始单独获取，覆盖所有时段，不写入本地存储
+没有行情覆盖的时段（早于上市日期，或获取失败改用本地存储时早于 START_DATE）结果为空，按证券告警
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from backtrader import simulate
+from dataset import CACHE, resolve
+from fetcher import fetch_all
+from historical_range import compute_distribution, rolling_distribution, get_k_data, get_stocks
+from logs import add_sink
+from metrics import span, write_summary
+from providers import get_provider
+from settings import CRASHES, STRESS_START_DATE, DUMP_DIR, STOCK_CODE, STOCK_NAME, TODAY, TAKE_PROFIT
+from utils import clear_file
+
+# 资金曲线矩阵的列
+CURVES = ["strategy", "buy_hold"]
+# stress 结果的列
+COLUMNS = ["code", "name", "window", "curve", "days", "return", "max_drawdown", "trough_date", "recover_days",
+           "recovered_date", "in_market"]
+
+
+def in_market(close, bid_price, buy_idx, sell_idx):
+    """
+    每个交易日是否持仓，买入当天到卖出前一天记为持仓
+    simulate 不返回最后未卖出的一笔，按同样的规则从最后一次卖出之后找买点
+    :param close: 收盘价数组
+    :param bid_price: 目标买入价，标量或与 close 等长的数组
+    :param buy_idx: simulate 返回的买入下标
+    :param sell_idx: simulate 返回的卖出下标
+    :return: 布尔数组
+    """
+    n = len(close)
+    delta = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(delta, buy_idx, 1)
+    np.add.at(delta, sell_idx, -1)
+
+    pos = int(sell_idx[-1]) + 1 if len(sell_idx) else 0
+    bid = np.broadcast_to(bid_price, close.shape)
+    entries = np.flatnonzero(close[pos:] < bid[pos:])
+    if entries.size:
+        delta[pos + entries[0]] += 1
+    return np.cumsum(delta[:n]) > 0
+
+
+def window_metrics(dates, equity, holding, windows=CRASHES):
+    """
+    在资金曲线矩阵上按时段切片计算指标，不重新回溯
+    :param dates: 交易日数组，升序
+    :param equity: 资金曲线矩阵，形状为 (交易日数, 曲线数)
+    :param holding: 持仓矩阵，形状与 equity 相同
+    :param windows: [(开始日期, 结束日期)]，结束日期不含
+    :return: dict，每个指标一个 (时段数, 曲线数) 矩阵，以及每个时段的交易日数
+    """
+    dates = np.asarray(dates).astype('datetime64[D]')
+    starts = np.searchsorted(dates, np.array([w[0] for w in windows], dtype='datetime64[D]'), side='left')
+    ends = np.searchsorted(dates, np.array([w[1] for w in windows], dtype='datetime64[D]'), side='left')
+
+    shape = (len(windows), equity.shape[1])
+    result = {name: np.full(shape, np.nan) for name in ["return", "max_drawdown", "recover_days", "in_market"]}
+    result["trough"] = np.full(shape, -1, dtype=np.int64)
+    result["days"] = ends - starts
+
+    for w, (lo, hi) in enumerate(zip(starts, ends)):
+        if hi - lo < 1:
+            continue
+        # 以时段开始前一个交易日的净值为基准，第一天的涨跌也计入
+        base = equity[lo - 1] if lo else equity[lo]
+        seg = np.vstack([base, equity[lo:hi]])
+        peak = np.maximum.accumulate(seg, axis=0)
+        dd = seg / peak - 1
+        trough = dd.argmin(axis=0)
+        # seg 的第 0 行是基准日，对应 lo - 1，时段从第一个交易日开始时对应 lo
+        trough_idx = np.maximum(lo + trough - 1, 0)
+
+        result["return"][w] = seg[-1] / base - 1
+        result["max_drawdown"][w] = dd.min(axis=0)
+        result["in_market"][w] = holding[lo:hi].mean(axis=0)
+        result["trough"][w] = trough_idx
+
+        for j in range(equity.shape[1]):
+            if dd[trough[j], j] == 0:
+                result["recover_days"][w, j] = 0
+                continue
+            t = trough_idx[j]
+            hit = np.flatnonzero(equity[t:, j] >= peak[trough[j], j])
+            if hit.size:
+                result["recover_days"][w, j] = hit[0]
+    return result
+
+
+def fetch_history(stock_code, start_date=STRESS_START_DATE):
+    """
+    获取压力测试用的前复权日线，本地存储只保存 START_DATE 之后的历史，早期的暴跌时段需要单独获取
+    :param stock_code: 如 588000 或 601398
+    :param start_date: 起始日期，早于第一个暴跌时段
+    :return: DataFrame，列为 providers.SCHEMA
+    """
+    with span("fetch_history", stock_code) as s:
+        df = get_provider().get_bars(stock_code, start_date, TODAY, adjust="qfq")
+        s.rows = len(df)
+    return df
+
+
+def _bid_price(df, bid_source):
+    """
+    策略的目标买入价
+    :param df: 日线
+    :param bid_source: top_zone、value_area 或 rolling（滚动“价值区间”最低价，只用之前的数据）
+    :return: 标量或与 df 等长的数组
+    """
+    prices = df['close'].to_numpy(dtype=float)
+    if bid_source == "rolling":
+        return rolling_distribution(prices)['lowest_price'].shift(1).to_numpy(dtype=float)
+    dist = compute_distribution(prices)
+    return dist['top_left'] if bid_source == "top_zone" else dist['lowest_price']
+
+
+def stress(stock_code=STOCK_CODE,
+           stock_name=STOCK_NAME,
+           bid_source="value_area",
+           take_profit=TAKE_PROFIT,
+           windows=CRASHES,
+           data=None):
+    """
+    单个证券在每个暴跌时段的表现，策略与买入持有对比
+    :param stock_code: 如 588000 或 601398
+    :param stock_name: 如 科创50 或 工商银行
+    :param bid_source: top_zone、value_area 或 rolling
+    :param take_profit: 止盈比例
+    :param windows: [(开始日期, 结束日期)]
+    :param data: 日线 DataFrame 或 Dataset，为空时从缓存读取
+    :return: DataFrame，每行一个 (时段, 曲线)
+    """
+    df = resolve(data, stock_code)
+    dates = df['date'].to_numpy()
+    close = df['close'].to_numpy(dtype=float)
+    bid = _bid_price(df, bid_source)
+
+    # 1. 整段历史只回溯一次
+    strategy, buy_idx, sell_idx = simulate(close, bid, take_profit)
+    equity = np.column_stack([strategy, close / close[0]])
+    holding = np.column_stack([in_market(close, bid, buy_idx, sell_idx), np.ones(len(close), dtype=bool)])
+
+    # 2. 所有时段、两条曲线一起计算
+    m = window_metrics(dates, equity, holding, windows)
+
+    # 行情没有覆盖或只覆盖了部分的时段
+    first = np.datetime64(dates[0], 'D')
+    for (start, end), days in zip(windows, m["days"]):
+        if days == 0:
+            logger.warning(f"{stock_code}_{stock_name} 行情从 {first} 开始，时段 {start}~{end} 没有数据")
+        elif np.datetime64(start, 'D') <= first:
+            logger.warning(f"{stock_code}_{stock_name} 行情从 {first} 开始，时段 {start}~{end} 之前没有基准日，"
+                           f"只覆盖了部分时段")
+
+    n_w, n_c = m["return"].shape
+    trough = m["trough"].ravel()
+    recover = m["recover_days"].ravel()
+    trough_dates = np.where(trough >= 0, dates[np.clip(trough, 0, None)], np.datetime64('NaT'))
+    recovered = trough + np.nan_to_num(recover, nan=-1).astype(np.int64)
+    recovered_dates = np.where((trough >= 0) & ~np.isnan(recover),
+                               dates[np.clip(recovered, 0, len(dates) - 1)], np.datetime64('NaT'))
+    return pd.DataFrame({
+        "code": stock_code,
+        "name": stock_name,
+        "window": np.repeat([f"{s}~{e}" for s, e in windows], n_c),
+        "curve": np.tile(CURVES, n_w),
+        "days": np.repeat(m["days"], n_c),
+        "return": m["return"].ravel(),
+        "max_drawdown": m["max_drawdown"].ravel(),
+        "trough_date": pd.to_datetime(trough_dates),
+        "recover_days": recover,
+        "recovered_date": pd.to_datetime(recovered_dates),
+        "in_market": m["in_market"].ravel(),
+    })
+
+
+def stress_all(stocks, frames=None, **kwargs):
+    """
+    多个证券的压力测试，结果合并成一张表，并按时段汇总策略与买入持有的平均表现
+    :param stocks: [{"code": ..., "name": ...}]
+    :param frames: dict，证券代码 -> 日线 DataFrame，没有的从缓存读取
+    :param kwargs: 透传给 stress
+    :return: DataFrame，列为 COLUMNS，没有证券或全部失败时为空表
+    """
+    frames = frames or {}
+    tables = []
+    for comp in stocks:
+        code, name = f"{comp.get('code')}", comp.get('name')
+        try:
+            tables.append(stress(code, name, data=frames.get(code), **kwargs))
+        except Exception as e:
+            logger.error(f"{code}_{name} 压力测试失败：{e}")
+    if not tables:
+        logger.warning("没有可以压力测试的证券")
+        return pd.DataFrame(columns=COLUMNS)
+    result = pd.concat(tables, ignore_index=True)
+
+    covered = result[result["days"] > 0]
+    if not covered.empty:
+        summary = covered.pivot_table(index="window", columns="curve",
+                                      values=["return", "max_drawdown", "in_market"], aggfunc="mean")
+        logger.info(f"各暴跌时段的平均表现（{covered['code'].nunique()} 个证券）：\n{summary.to_string()}")
+    return result
+
+
+if __name__ == '__main__':
+    # /home/rhino/s/a/app_YYYYMMDD.log
+    add_sink('app')
+    cs = get_stocks()
+
+    fetched, frames = [], {}
+    for comp, df, err in fetch_all(cs, lambda c: fetch_history(f"{c.get('code')}")):
+        code, name = f"{comp.get('code')}", comp.get('name')
+        if err is None and not df.empty:
+            frames[code] = df
+            fetched.append(comp)
+            continue
+        # 获取失败时改用本地存储，早于 START_DATE 的时段没有数据
+        logger.error(f"{code}_{name} 获取 {STRESS_START_DATE} 以来的历史数据失败，改用本地存储：{err}")
+        try:
+            get_k_data(code, name)
+            fetched.append(comp)
+        except Exception as e:
+            logger.error(f"{code}_{name} 获取历史数据失败：{e}")
+
+    result = stress_all(fetched, frames)
+
+    # 结果放在子目录中，不会被 clear_file 清理
+    stress_dir = os.path.join(DUMP_DIR, 'stress')
+    os.makedirs(stress_dir, exist_ok=True)
+    result.to_csv(os.path.join(stress_dir, f"stress_{TODAY}.csv"), index=False)
+
+    CACHE.log_stats()
+    write_summary()
+    clear_file()
@@ -0,0 +1,128 @@
+# -*- coding:utf-8 -*-
+"""
+参数扫描
+从 backtrader.json 文件读取需要分析的证券代码，每个证券只读取一次收盘价
+在 目标买入价 × 止盈比例 × bin 宽度 的参数网格上批量回溯，输出一张结果表
+- bin 宽度决定 停留时间最多的区间 和 覆盖70%时间的“价值区间” 的最低价，作为两类目标买入价
+- 另外在历史最低价和最高价之间均匀取一组目标买入价
+每个格子的 总收益率、年化收益率、最大回撤 与 get_return 口径一致
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from backtrader import simulate_batch
+from dataset import CACHE, resolve
+from fetcher import fetch_all
+from historical_range import compute_distribution, get_k_data, get_stocks
+from logs import add_sink
+from metrics import write_summary
+from settings import START_DATE, DUMP_DIR, STOCK_CODE, STOCK_NAME, TODAY, SWEEP_BIN_PCTS, SWEEP_TAKE_PROFITS, \
+    SWEEP_BID_STEPS
+from utils import clear_file
+
+
+def sweep(stock_code=STOCK_CODE,
+          stock_name=STOCK_NAME,
+          bid_prices=None,
+          take_profits=SWEEP_TAKE_PROFITS,
+          bin_pcts=SWEEP_BIN_PCTS,
+          start_date=START_DATE,
+          data=None):
+    """
+    单个证券的参数扫描
+    :param stock_code: 如 588000 或 601398
+    :param stock_name: 如 科创50 或 工商银行
+    :param bid_prices: 目标买入价列表，为空则在历史最低价和最高价之间均匀取 SWEEP_BID_STEPS 个
+    :param take_profits: 止盈比例列表
+    :param bin_pcts: bin 宽度占均价的比例列表
+    :param start_date: 回溯开始时间
+    :param data: 日线 DataFrame 或 Dataset，为空时从缓存读取
+    :return: DataFrame，每行一个参数组合
+    """
+    df = resolve(data, stock_code)
+    prices = df['close'].to_numpy(dtype=float)
+    close = df.loc[df['date'] >= start_date, 'close'].to_numpy(dtype=float)
+
+    # 1. 每个 bin 宽度对应两个目标买入价
+    bin_pct_col, source_col, bid_col = [], [], []
+    for bin_pct in bin_pcts:
+        dist = compute_distribution(prices, bin_pct)
+        bin_pct_col += [bin_pct, bin_pct]
+        source_col += ['top_zone', 'value_area']
+        bid_col += [dist['top_left'], dist['lowest_price']]
+
+    # 2. 均匀网格上的目标买入价，与 bin 宽度无关
+    if bid_prices is None:
+        bid_prices = np.linspace(np.nanmin(prices), np.nanmax(prices), SWEEP_BID_STEPS)
+    bin_pct_col += [np.nan] * len(bid_prices)
+    source_col += ['grid'] * len(bid_prices)
+    bid_col += list(bid_prices)
+
+    # 3. 与止盈比例做笛卡尔积，一次批量模拟
+    n_tp = len(take_profits)
+    bids = np.repeat(np.asarray(bid_col, dtype=float), n_tp)
+    tps = np.tile(np.asarray(take_profits, dtype=float), len(bid_col))
+    final, max_dd, trades = simulate_batch(close, bids, tps)
+
+    trading_days = len(close)
+    return pd.DataFrame({
+        "code": stock_code,
+        "name": stock_name,
+        "bin_pct": np.repeat(bin_pct_col, n_tp),
+        "source": np.repeat(source_col, n_tp),
+        "bid_price": bids,
+        "take_profit": tps,
+        "total_return": final - 1,
+        "annual_return": final ** (252 / trading_days) - 1,
+        "max_drawdown": max_dd,
+        "trades": trades,
+    })
+
+
+def sweep_all(stocks, **kwargs):
+    """
+    多个证券的参数扫描，结果合并成一张表
+    :param stocks: [{"code": ..., "name": ...}]
+    :param kwargs: 透传给 sweep
+    :return: DataFrame
+    """
+    tables = []
+    for comp in stocks:
+        cs_code = comp.get('code')
+        cs_name = comp.get('name')
+        table = sweep(f"{cs_code}", cs_name, **kwargs)
+        best = table.loc[table['total_return'].idxmax()]
+        logger.info(f"{cs_code}_{cs_name} 共 {len(table)} 组参数，"
+                    f"最优目标买入价：{best['bid_price']:.3f}，"
+                    f"止盈比例：{best['take_profit']}，"
+                    f"总收益率: {best['total_return']:.2%}，"
+                    f"最大回撤: {best['max_drawdown']:.2%}")
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+
+if __name__ == '__main__':
+    # /home/rhino/s/a/app_YYYYMMDD.log
+    add_sink('app')
+    cs = get_stocks()
+
+    fetched = []
+    for comp, _, err in fetch_all(cs, lambda c: get_k_data(f"{c.get('code')}", c.get('name'))):
+        if err is not None:
+            logger.error(f"{comp.get('code')}_{comp.get('name')} 获取历史数据失败：{err}")
+            continue
+        fetched.append(comp)
+
+    result = sweep_all(fetched)
+
+    # 结果放在子目录中，不会被 clear_file 清理
+    sweep_dir = os.path.join(DUMP_DIR, 'sweep')
+    os.makedirs(sweep_dir, exist_ok=True)
+    result.to_csv(os.path.join(sweep_dir, f"sweep_{TODAY}.csv"), index=False)
+
+    CACHE.log_stats()
+    write_summary()
+    clear_file()
@@ -0,0 +1,8 @@
+# -*- coding:utf-8 -*-
+"""
+测试直接导入仓库根目录下的模块
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,84 @@
+# -*- coding:utf-8 -*-
+"""
+并发获取：用 FakeProvider 注入延迟和失败，验证重试退避、按请求限速和部分失败
+"""
+import time
+
+import pytest
+
+import fetcher
+from fetcher import fetch_all, call_with_retry, TokenBucket
+from providers import FakeProvider, ProviderError
+
+START, END = "2024-01-01", "2024-03-31"
+CODES = [f"6000{i:02d}" for i in range(10)]
+
+
+def _bars(provider):
+    return lambda code: provider.get_bars(code, START, END, adjust="raw")
+
+
+def test_retry_backs_off_exponentially(monkeypatch):
+    waits = []
+    monkeypatch.setattr(fetcher.time, "sleep", waits.append)
+    provider = FakeProvider(failure_rate=1.0)
+    with pytest.raises(ConnectionError):
+        call_with_retry(_bars(provider), "600000", retries=3, backoff=1.0)
+    assert len(provider.calls) == 4
+    # 第 n 次重试等待 backoff * 2^n，最多再加一半的随机抖动
+    for attempt, wait in enumerate(waits):
+        assert 2 ** attempt <= wait <= 1.5 * 2 ** attempt
+
+
+def test_transient_failures_are_retried():
+    provider = FakeProvider(failure_rate=0.5, seed=1)
+    results = list(fetch_all(CODES, _bars(provider), concurrency=1, rate=1000, burst=1000,
+                             retries=10, backoff=0.001))
+    assert sorted(item for item, _, _ in results) == CODES
+    assert all(err is None and not df.empty for _, df, err in results)
+    assert len(provider.calls) > len(CODES)
+
+
+def test_partial_failure_reports_each_symbol():
+    provider = FakeProvider(broken={"600003", "600007"})
+    results = {item: (df, err) for item, df, err in fetch_all(CODES, _bars(provider), rate=1000, burst=1000,
+                                                               retries=1, backoff=0.001)}
+    assert set(results) == set(CODES)
+    failed = {item for item, (_, err) in results.items() if err is not None}
+    assert failed == {"600003", "600007"}
+    assert all(isinstance(results[item][1], ProviderError) for item in failed)
+    assert all(results[item][0] is not None for item in set(CODES) - failed)
+
+
+def test_rate_limits_every_request():
+    # 每个证券发起不复权和后复权两次请求，每次请求都要取令牌
+    provider = FakeProvider()
+    rate, burst = 50, 1
+    start = time.monotonic()
+    results = list(fetch_all(CODES, lambda c: provider.get_factor_bars(c, START, END), concurrency=4,
+                             rate=rate, burst=burst))
+    elapsed = time.monotonic() - start
+    assert all(err is None for _, _, err in results)
+    assert len(provider.calls) == 2 * len(CODES)
+    assert elapsed >= (len(provider.calls) - burst) / rate * 0.9
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(rate=100, capacity=1)
+    start = time.monotonic()
+    for _ in range(21):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.2 * 0.9
+
+
+def test_consumer_break_cancels_pending():
+    provider = FakeProvider(delay=0.2)
+    start = time.monotonic()
+    results = fetch_all([f"6001{i:02d}" for i in range(40)], _bars(provider), concurrency=2,
+                        rate=1000, burst=1000)
+    next(results)
+    results.close()
+    # 不取消时要等 40 个请求依次完成，约 4 秒
+    assert time.monotonic() - start < 1.5
+    time.sleep(0.3)
+    assert len(provider.calls) <= 4
@@ -0,0 +1,77 @@
+# -*- coding:utf-8 -*-
+"""
+行情面板：增量更新、停牌证券的历史重写、新增证券、成交量精度
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import store
+from panel import Panel, build_panel, update_panel
+
+DATES = pd.bdate_range("2024-01-01", periods=60)
+
+
+def _append(code, dates, close, volume=1000.0):
+    close = np.asarray(close, dtype=float)
+    store.append_bars(code, pd.DataFrame({"date": dates, "open": close, "high": close, "low": close,
+                                          "close": close, "volume": volume, "amount": close * volume,
+                                          "hfq": close}))
+
+
+@pytest.fixture
+def panel_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, "STORE_DIR", str(tmp_path / "store"))
+    return str(tmp_path / "panel")
+
+
+def test_update_appends_new_days(panel_dir):
+    _append("600000", DATES[:40], np.linspace(10, 11, 40))
+    _append("600001", DATES[:40], np.linspace(20, 21, 40))
+    build_panel(["600000", "600001"], panel_dir)
+    _append("600000", DATES[39:], np.linspace(11, 12, 21))
+
+    panel = update_panel(panel_dir=panel_dir)
+    assert panel.rows == 60
+    assert np.isnan(panel.column("600001")[40:]).all()
+    np.testing.assert_allclose(panel.column("600000")[-1], 12, rtol=1e-6)
+
+
+def test_suspended_symbol_history_rewrite(panel_dir):
+    _append("600000", DATES[:40], np.linspace(10, 11, 40))
+    _append("600001", DATES[:20], np.linspace(20, 21, 20))
+    build_panel(["600000", "600001"], panel_dir)
+
+    # 停牌证券在面板最后一天之前没有数据，它的历史被重新下载
+    store.reset("600001")
+    _append("600001", DATES[:20], np.linspace(30, 31, 20))
+    panel = update_panel(panel_dir=panel_dir)
+    np.testing.assert_allclose(panel.column("600001")[:20], np.linspace(30, 31, 20), rtol=1e-6)
+
+
+def test_new_symbols_are_added(panel_dir):
+    _append("600000", DATES[:40], np.linspace(10, 11, 40))
+    build_panel(["600000"], panel_dir)
+    _append("600002", DATES[10:40], np.linspace(5, 6, 30))
+
+    panel = update_panel(["600000", "600002"], panel_dir)
+    assert panel.symbols == ["600000", "600002"]
+    assert np.isnan(panel.column("600002")[:10]).all()
+    np.testing.assert_allclose(panel.column("600002")[10:], np.linspace(5, 6, 30), rtol=1e-6)
+
+
+def test_volume_is_exact(panel_dir):
+    volume = 123_456_789.0
+    _append("600000", DATES[:5], np.full(5, 10.0), volume)
+    panel = build_panel(["600000"], panel_dir)
+    assert panel["volume"].dtype == np.float64
+    assert panel.column("600000", "volume")[0] == volume
+
+
+def test_readers_keep_old_panel(panel_dir):
+    _append("600000", DATES[:40], np.linspace(10, 11, 40))
+    old = build_panel(["600000"], panel_dir)
+    _append("600000", DATES[39:], np.linspace(11, 12, 21))
+    update_panel(panel_dir=panel_dir)
+    assert old.rows == 40 and len(old.column("600000")) == 40
+    assert Panel(panel_dir).rows == 60
@@ -0,0 +1,52 @@
+# -*- coding:utf-8 -*-
+"""
+数据源：录制后离线回放得到相同的日线，主数据源失败时切换到下一个
+"""
+import pandas as pd
+import pytest
+
+from providers import FakeProvider, RecordProvider, ReplayProvider, FallbackProvider, ProviderError, SCHEMA
+
+START, END = "2024-01-01", "2024-03-31"
+
+
+def test_record_then_replay(tmp_path):
+    fake = FakeProvider()
+    recorder = RecordProvider(fake, root=str(tmp_path))
+    recorded = recorder.get_factor_bars("601398", START, END)
+
+    replay = ReplayProvider(root=str(tmp_path))
+    replayed = replay.get_factor_bars("601398", START, END)
+    pd.testing.assert_frame_equal(recorded, replayed)
+    assert list(replayed.columns) == SCHEMA + ["hfq"]
+
+    # 回放的最后一天收盘价作为最新价
+    assert replay.get_spot(["601398", "600000"]) == {"601398": recorded["close"].iloc[-1]}
+
+
+def test_record_merges_overlapping_ranges(tmp_path):
+    recorder = RecordProvider(FakeProvider(), root=str(tmp_path))
+    recorder.get_bars("601398", START, "2024-02-15", adjust="raw")
+    recorder.get_bars("601398", "2024-02-01", END, adjust="raw")
+    replayed = ReplayProvider(root=str(tmp_path)).get_bars("601398", START, END, adjust="raw")
+    assert replayed["date"].is_unique
+    pd.testing.assert_frame_equal(replayed, FakeProvider().get_bars("601398", START, END, adjust="raw"))
+
+
+def test_replay_without_recording(tmp_path):
+    with pytest.raises(ProviderError):
+        ReplayProvider(root=str(tmp_path)).get_bars("601398", START, END)
+
+
+def test_fallback_switches_provider():
+    primary, secondary = FakeProvider(broken={"601398"}), FakeProvider()
+    df = FallbackProvider(primary, secondary).get_factor_bars("601398", START, END, qfq=True)
+    assert {"hfq", "qfq"} <= set(df.columns)
+    # 不复权和复权价都来自同一个数据源
+    assert len(primary.calls) == 1 and len(secondary.calls) == 3
+
+
+def test_fallback_raises_primary_error():
+    primary, secondary = FakeProvider(broken={"601398"}), FakeProvider(failure_rate=1.0)
+    with pytest.raises(ProviderError):
+        FallbackProvider(primary, secondary).get_bars("601398", START, END)
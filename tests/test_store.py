@@ -0,0 +1,94 @@
+# -*- coding:utf-8 -*-
+"""
+本地存储的复权因子：按比例复权和按差值复权的数据源，每次除权除息只记录一段
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import store
+
+EX_DATES = [150, 330, 480]
+
+
+def _series(mode, n=600, price=30.0, seed=0):
+    """
+    模拟数据源的不复权价、后复权价和前复权价，三个价格都按 0.01 元取整
+    :param mode: proportional 按比例复权，additive 先减去现金分红
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range("2023-01-02", periods=n)
+    true = price * np.exp(np.cumsum(rng.normal(0, 0.012, n)))
+    dividend, ratio = np.zeros(n), np.ones(n)
+    for e, d in zip(EX_DATES, [0.4, 0.9, 0.2]):
+        ratio[e:] *= true[e - 1] / (true[e - 1] - d)
+        true[e:] -= d
+        dividend[e:] += d
+    if mode == "additive":
+        hfq, qfq = true + dividend, true + dividend - dividend[-1]
+    else:
+        hfq, qfq = true * ratio, true * ratio / ratio[-1]
+    return dates, np.round(true, 2), np.round(hfq, 2), np.round(qfq, 2)
+
+
+def _frame(dates, raw, hfq):
+    return pd.DataFrame({"date": dates, "open": raw, "high": raw, "low": raw, "close": raw,
+                         "volume": 1.0, "amount": 1.0, "hfq": hfq})
+
+
+@pytest.fixture
+def store_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, "STORE_DIR", str(tmp_path))
+    return tmp_path
+
+
+@pytest.mark.parametrize("mode", ["proportional", "additive"])
+def test_unchanged_segment_is_one_row(mode):
+    dates, raw, hfq, _ = _series(mode)
+    n = EX_DATES[0]
+    factor_dates, _, _ = store.fit_factors(dates[:n], raw[:n], hfq[:n], 0.01)
+    assert len(factor_dates) == 1
+
+
+@pytest.mark.parametrize("mode", ["proportional", "additive"])
+def test_one_row_per_ex_date(mode):
+    dates, raw, hfq, _ = _series(mode)
+    factor_dates, _, _ = store.fit_factors(dates, raw, hfq, 0.01)
+    assert list(factor_dates) == [dates[0]] + [dates[e] for e in EX_DATES]
+
+
+@pytest.mark.parametrize("mode", ["proportional", "additive"])
+def test_incremental_append_matches_source(store_dir, mode):
+    dates, raw, hfq, qfq = _series(mode)
+    store.append_bars("600001", _frame(dates[:100], raw[:100], hfq[:100]))
+    # 每次从倒数第二个交易日开始追加，与 get_k_data 的增量获取一致
+    for end in range(101, len(dates) + 1):
+        store.append_bars("600001", _frame(dates[end - 2:end], raw[end - 2:end], hfq[end - 2:end]))
+
+    factor_dates, _, _ = store._read_factors("600001")
+    assert list(factor_dates) == [dates[0]] + [dates[e] for e in EX_DATES]
+    derived = store.load_bars("600001", adjust="qfq")["close"].to_numpy()
+    assert np.abs(derived - qfq).max() <= 0.03
+
+
+def test_swap_replaces_stale_old(store_dir):
+    dates, raw, hfq, _ = _series("proportional")
+    store.append_bars("600000", _frame(dates[:20], raw[:20], hfq[:20]))
+    # 之前中断留下的 .old 和临时目录
+    (store_dir / "600000.old").mkdir()
+    (store_dir / "600000.old" / "close.npy").write_bytes(b"")
+    (store_dir / "600000.tmp").mkdir()
+    (store_dir / "600000.tmp" / "stray.npy").write_bytes(b"")
+    store.append_bars("600000", _frame(dates[20:40], raw[20:40], hfq[20:40]))
+    assert len(store.load_bars("600000", adjust="raw")) == 40
+    assert sorted(p.name for p in store_dir.iterdir()) == ["600000"]
+
+
+def test_interrupted_swap_is_recovered(store_dir, monkeypatch):
+    dates, raw, hfq, _ = _series("proportional")
+    store.append_bars("600000", _frame(dates[:20], raw[:20], hfq[:20]))
+    # 模拟在两次替换之间中断：原目录已改名为 .old，新目录还没有换上
+    (store_dir / "600000").rename(store_dir / "600000.old")
+    monkeypatch.setattr(store, "_recovered", set())
+    assert store.high_water("600000") == str(dates[19].date())
+    assert not (store_dir / "600000.old").exists()
@@ -0,0 +1,91 @@
+# -*- coding:utf-8 -*-
+"""
+邮件提醒：用本地的 SMTP 替身代替 QQ 邮箱，验证连接复用、断线重连、合并模式的分批
+"""
+import smtplib
+import time
+from email import message_from_string
+from email.header import decode_header, make_header
+
+import pytest
+
+import utils
+from utils import AlertDispatcher
+
+
+class FakeSMTP:
+    """
+    记录发出的邮件，disconnect_after 封之后断开一次
+    """
+    connections = 0
+
+    def __init__(self, outbox, disconnect_after=None):
+        FakeSMTP.connections += 1
+        self.outbox = outbox
+        self.disconnect_after = disconnect_after
+
+    def sendmail(self, sender, receivers, msg):
+        if self.disconnect_after is not None and len(self.outbox) >= self.disconnect_after:
+            self.disconnect_after = None
+            raise smtplib.SMTPServerDisconnected("连接已断开")
+        message = message_from_string(msg)
+        self.outbox.append((str(make_header(decode_header(message["Subject"]))),
+                            message.get_payload(decode=True).decode('utf-8')))
+
+    def quit(self):
+        pass
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    sent = []
+    FakeSMTP.connections = 0
+    monkeypatch.setattr(utils, "ENABLE_MAIL_NOTIFY", True)
+    monkeypatch.setattr(utils, "_connect", lambda *args: FakeSMTP(sent))
+    return sent
+
+
+def test_each_alert_reuses_connection(outbox):
+    with AlertDispatcher(digest=False) as alerts:
+        for i in range(3):
+            alerts.add(f"提醒 {i}", "内容")
+    assert [s for s, _ in outbox] == ["提醒 0", "提醒 1", "提醒 2"]
+    assert FakeSMTP.connections == 1
+
+
+def test_reconnects_after_disconnect(monkeypatch, outbox):
+    # 第一个连接发出一封后断开
+    monkeypatch.setattr(utils, "_connect",
+                        lambda *args: FakeSMTP(outbox, disconnect_after=1 if not FakeSMTP.connections else None))
+    with AlertDispatcher(digest=False) as alerts:
+        alerts.add("提醒 0", "内容")
+        alerts.add("提醒 1", "内容")
+    assert [s for s, _ in outbox] == ["提醒 0", "提醒 1"]
+    assert FakeSMTP.connections == 2
+
+
+def test_digest_flushes_by_count(outbox):
+    alerts = AlertDispatcher(digest=True, max_alerts=2, max_seconds=60)
+    for i in range(5):
+        alerts.add(f"提醒 {i}", f"内容 {i}")
+    alerts.close()
+    assert [s for s, _ in outbox] == [f"{utils.TODAY} 共 2 条提醒", f"{utils.TODAY} 共 2 条提醒",
+                                      f"{utils.TODAY} 共 1 条提醒"]
+    assert "提醒 0" in outbox[0][1] and "内容 1" in outbox[0][1]
+
+
+def test_digest_flushes_by_time(outbox):
+    alerts = AlertDispatcher(digest=True, max_alerts=100, max_seconds=0.1)
+    alerts.add("提醒 0", "内容")
+    time.sleep(0.5)
+    # 不等 close，超时后已经发出
+    assert [s for s, _ in outbox] == [f"{utils.TODAY} 共 1 条提醒"]
+    alerts.close()
+    assert len(outbox) == 1
+
+
+def test_disabled_sends_nothing(monkeypatch, outbox):
+    monkeypatch.setattr(utils, "ENABLE_MAIL_NOTIFY", False)
+    with AlertDispatcher() as alerts:
+        alerts.add("提醒", "内容")
+    assert outbox == []
@@ -1,6 +1,9 @@
 # -*- coding:utf-8 -*-
 import os.path
+import queue
 import smtplib
+import threading
+import time
 from email.header import Header
 from email.mime.text import MIMEText
 from email.utils import formataddr
@@ -8,8 +11,36 @@ from pathlib import Path
 
 from loguru import logger
 
+from metrics import span
 from settings import QQ_EMAIL, QQ_SMTP_SERVER, QQ_SMTP_PORT, QQ_AUTH_CODE, DUMP_DIR, ENABLE_MAIL_NOTIFY, \
-    ENABLE_FILE_NOTIFY, SAVE_DATA, ICLOUD_EMAIL
+    ENABLE_FILE_NOTIFY, SAVE_DATA, ICLOUD_EMAIL, MAIL_DIGEST, MAIL_DIGEST_MAX_ALERTS, MAIL_DIGEST_SECONDS, TODAY
+
+
+def _build_message(subject, content, sender=QQ_EMAIL, receiver=ICLOUD_EMAIL):
+    """
+    构建 MIME 邮件对象
+    :param subject:
+    :param content:
+    :param sender:
+    :param receiver:
+    :return:
+    """
+    msg = MIMEText(content, "plain", "utf-8")
+    msg["From"] = formataddr((str(Header("自己", "utf-8")), sender))
+    msg["To"] = formataddr((str(Header("自己", "utf-8")), receiver))
+    msg["Subject"] = Header(subject, "utf-8")
+    return msg
+
+
+def _connect(host=QQ_SMTP_SERVER, port=QQ_SMTP_PORT, use_ssl=True, user=QQ_EMAIL, password=QQ_AUTH_CODE):
+    """
+    建立 SMTP 连接并登录，password 为空时不登录（本地测试用的 SMTP 服务）
+    :return:
+    """
+    server = smtplib.SMTP_SSL(host, port) if use_ssl else smtplib.SMTP(host, port)
+    if password:
+        server.login(user, password)
+    return server
 
 
 def send_mail(subject="", content=""):
@@ -24,20 +55,143 @@ def send_mail(subject="", content=""):
         return
 
     # 构建 MIME 邮件对象
-    msg = MIMEText(content, "plain", "utf-8")
-    msg["From"] = formataddr((str(Header("自己", "utf-8")), QQ_EMAIL))
-    msg["To"] = formataddr((str(Header("自己", "utf-8")), ICLOUD_EMAIL))
-    msg["Subject"] = Header(subject, "utf-8")
+    msg = _build_message(subject, content)
 
     # 发送邮件
     try:
-        server = smtplib.SMTP_SSL(QQ_SMTP_SERVER, QQ_SMTP_PORT)
-        server.login(QQ_EMAIL, QQ_AUTH_CODE)
-        server.sendmail(QQ_EMAIL, [ICLOUD_EMAIL], msg.as_string())
-        server.quit()
+        with span("send_mail") as s:
+            server = _connect()
+            server.sendmail(QQ_EMAIL, [ICLOUD_EMAIL], msg.as_string())
+            server.quit()
+            s.bytes_written = len(msg.as_bytes())
         logger.info("邮件发送成功！")
     except Exception as e:
-        logger.error("邮件发送失败：", e)
+        logger.error(f"邮件发送失败：{e}")
+
+
+class AlertDispatcher:
+    """
+    一次运行中的邮件提醒统一发送
+    - 合并模式：攒够 max_alerts 条，或第一条等待超过 max_seconds 秒时合并成一封邮件，close 时发出剩余的
+      中途崩溃最多丢失最近一批，标题固定为 “日期 共 N 条提醒”，每条提醒的标题和内容放在正文中
+    - 逐封模式：每条提醒一封邮件，全部复用同一个连接
+    发送在后台线程中进行，不阻塞行情获取和分析
+    """
+
+    def __init__(self, digest=MAIL_DIGEST,
+                 host=QQ_SMTP_SERVER,
+                 port=QQ_SMTP_PORT,
+                 use_ssl=True,
+                 user=QQ_EMAIL,
+                 password=QQ_AUTH_CODE,
+                 sender=QQ_EMAIL,
+                 receiver=ICLOUD_EMAIL,
+                 max_alerts=MAIL_DIGEST_MAX_ALERTS,
+                 max_seconds=MAIL_DIGEST_SECONDS):
+        self.digest = digest
+        self._server_args = (host, port, use_ssl, user, password)
+        self.sender = sender
+        self.receiver = receiver
+        self.max_alerts = max_alerts
+        self.max_seconds = max_seconds
+        self._queue = queue.Queue()
+        self._thread = None
+        self._server = None
+        self.sent = 0
+
+    def add(self, subject="", content=""):
+        """
+        加入一条提醒
+        :param subject:
+        :param content:
+        :return:
+        """
+        if not ENABLE_MAIL_NOTIFY:
+            logger.warning("邮件提醒未启用！")
+            return
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._queue.put((subject, content))
+
+    def close(self):
+        """
+        发出剩余的提醒，等待后台线程发送完毕
+        :return:
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        """
+        后台线程，合并模式下按条数和等待时间分批，逐封模式下逐条发送
+        :return:
+        """
+        pending, deadline = [], None
+        while True:
+            try:
+                item = self._queue.get(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                # 第一条提醒等待超时
+                item = ()
+            if item is None:
+                break
+            if not self.digest:
+                self._send(*item)
+                continue
+            if item:
+                pending.append(item)
+                deadline = deadline or time.monotonic() + self.max_seconds
+            if pending and (not item or len(pending) >= self.max_alerts):
+                self._send_digest(pending)
+                pending, deadline = [], None
+
+        if pending:
+            self._send_digest(pending)
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def _send_digest(self, alerts):
+        subject = f"{TODAY} 共 {len(alerts)} 条提醒"
+        content = "\n".join(s for s, _ in alerts) + "\n\n" + "\n\n".join(f"【{s}】\n{c}" for s, c in alerts)
+        self._send(subject, content)
+
+    def _send(self, subject, content):
+        """
+        第一封邮件时建立连接，之后一直复用，断开时重连一次
+        :return:
+        """
+        msg = _build_message(subject, content, sender=self.sender, receiver=self.receiver).as_string()
+        for attempt in range(2):
+            try:
+                with span("send_mail") as s:
+                    if self._server is None:
+                        self._server = _connect(*self._server_args)
+                    self._server.sendmail(self.sender, [self.receiver], msg)
+                    s.bytes_written = len(msg.encode('utf-8'))
+                self.sent += 1
+                logger.info(f"邮件发送成功！{subject}")
+                return
+            except smtplib.SMTPServerDisconnected as e:
+                self._server = None
+                if attempt:
+                    logger.error(f"邮件发送失败：{e}")
+            except Exception as e:
+                logger.error(f"邮件发送失败：{e}")
+                return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 def dump_file(title="", content=""):
@@ -54,8 +208,9 @@ def dump_file(title="", content=""):
     filepath = os.path.join(r"C:/Users/Administrator/Desktop", f"{title}.text")
 
     try:
-        with open(filepath, encoding='utf-8', mode='w') as f:
+        with span("dump_file") as s, open(filepath, encoding='utf-8', mode='w') as f:
             f.write(content)
+            s.bytes_written = len(content.encode('utf-8'))
             logger.info("文件提醒生成成功！")
     except Exception as e:
         logger.error("文件提醒生成失败：", e)